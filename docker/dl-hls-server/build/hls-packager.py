@@ -0,0 +1,1271 @@
+import os
+import re
+import json
+import math
+import time
+import bisect
+import shutil
+import hashlib
+import threading
+import asyncio
+import argparse
+import datetime
+import tempfile
+import collections
+import subprocess
+import urllib.parse
+
+# Camera stream (or the restreamer's shared stream) to package
+RTSP_URL = os.getenv("RTSP_URL")
+
+# Name of the master playlist the website loads (<STREAM_NAME>.m3u8)
+STREAM_NAME = os.getenv("STREAM_NAME")
+
+# Video bitrate advertised in the playlists
+VIDEO_KBPS = os.getenv("VIDEO_KBPS")
+
+# Directory served by nginx
+HLS_DIR = os.getenv("HLS_DIR", "/hls")
+
+# standard: ffmpeg's own fMP4 HLS output. low-latency: LL-HLS with partial segments, served by this process
+HLS_MODE = os.getenv("HLS_MODE", "standard")
+
+# Segment duration and playlist length in standard mode
+HLS_TIME = int(os.getenv("HLS_TIME", "6"))
+HLS_LIST_SIZE = int(os.getenv("HLS_LIST_SIZE", "60"))
+
+# Transcoded rungs offered below the camera's own stream in standard mode, e.g. "1080p,720p,480p"
+# (unset to serve the camera's stream only)
+ABR_RUNGS = [rung.strip() for rung in os.getenv("ABR_RUNGS", "").split(",") if rung.strip()]
+
+# x264 preset the rungs are encoded with; slower presets need more CPU per rung
+ABR_PRESET = os.getenv("ABR_PRESET", "veryfast")
+
+# Height and video bitrate (kbps) of each rung that can be listed in ABR_RUNGS
+LADDER = {"1080p": (1080, 5000), "720p": (720, 2800), "480p": (480, 1200), "360p": (360, 700)}
+
+# Segment and partial segment durations in low-latency mode (segments still end on a keyframe)
+LL_SEGMENT_TIME = float(os.getenv("LL_SEGMENT_TIME", "2"))
+LL_PART_TIME = float(os.getenv("LL_PART_TIME", "0.5"))
+
+# Segments kept in the low-latency playlist
+LL_LIST_SIZE = int(os.getenv("LL_LIST_SIZE", "30"))
+
+# Directory on disk that finished segments are archived to for rewinding (unset to disable)
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR")
+
+# Size the archive is kept under; the oldest segments are deleted first
+ARCHIVE_MAX_GB = float(os.getenv("ARCHIVE_MAX_GB", "50"))
+
+# Seconds between snapshots taken from the newest keyframe of the stream (0 to disable)
+SNAPSHOT_INTERVAL = int(os.getenv("SNAPSHOT_INTERVAL", "10"))
+
+# Formats each scaled snapshot is written in (jpg, webp, avif); the full-size one is always a JPEG
+SNAPSHOT_FORMATS = [fmt.strip() for fmt in os.getenv("SNAPSHOT_FORMATS", "jpg,webp,avif").split(",") if fmt.strip()]
+
+# Scaled snapshots, written as <STREAM_NAME>-<name>.<format>, and their heights
+SNAPSHOT_SIZES = {"1080": 1080, "thumb": 360}
+
+# Encoder settings and muxer for each snapshot format
+SNAPSHOT_ENCODERS = {
+    "jpg": ["-c:v", "mjpeg", "-q:v", "3", "-f", "mjpeg"],
+    "webp": ["-c:v", "libwebp", "-quality", "75", "-f", "webp"],
+    "avif": ["-c:v", "libaom-av1", "-still-picture", "1", "-cpu-used", "8", "-crf", "35", "-f", "avif"],
+}
+
+# Port the low-latency and archive playlists are served on (nginx proxies /ll/ and /dvr/ to it)
+PACKAGER_PORT = int(os.getenv("PACKAGER_PORT", "8088"))
+
+# Seconds without a new segment before ffmpeg is treated as stalled and restarted
+STALL_TIMEOUT = int(os.getenv("STALL_TIMEOUT", "30"))
+
+# Extra seconds a freshly started ffmpeg has to write its first segment
+STALL_STARTUP_GRACE = 15
+
+# Delay before restarting ffmpeg after it exits, doubled after each quick exit up to RESTART_DELAY_MAX
+RESTART_DELAY = float(os.getenv("RESTART_DELAY", "1"))
+RESTART_DELAY_MAX = float(os.getenv("RESTART_DELAY_MAX", "30"))
+
+# Seconds between segment cadence reports (0 to disable)
+STATS_INTERVAL = int(os.getenv("STATS_INTERVAL", "300"))
+
+# fMP4 sample flag marking a sample that is not a sync sample (keyframe)
+SAMPLE_IS_NON_SYNC = 0x10000
+
+def input_args(source_url):
+    # The source is either the camera itself or the restreamer's shared stream over HTTP
+    transport = ["-rtsp_transport", "udp"] if source_url.startswith("rtsp://") else []
+    return ["-timeout", "5000000", *transport, "-i", source_url]
+
+def rung_args(index, rung):
+    """x264 settings for output video stream `index`. Keyframes are forced wherever the camera's
+    fall, so every rung is cut into segments at the same times as the copied stream."""
+    kbps = LADDER[rung][1]
+    return [
+        f"-c:v:{index}", "libx264", f"-preset:v:{index}", ABR_PRESET,
+        f"-b:v:{index}", f"{kbps}k", f"-maxrate:v:{index}", f"{kbps}k", f"-bufsize:v:{index}", f"{kbps * 2}k",
+        f"-force_key_frames:v:{index}", "source",
+    ]
+
+def ladder_filter(rungs):
+    """Decodes the camera's stream once and scales a copy of it to each rung."""
+    split = f"[0:v]split={len(rungs)}" + "".join(f"[s{index}]" for index in range(len(rungs)))
+    scales = [f"[s{index}]scale=-2:{LADDER[rung][0]},format=yuv420p[rung{index}]" for index, rung in enumerate(rungs)]
+    return ";".join([split, *scales])
+
+def encode_args(rungs=()):
+    """Video copied as HEVC plus a silent AAC track, shared by both modes, and any transcoded rungs."""
+    args = ["-f", "lavfi", "-i", "anullsrc=r=44100:cl=mono", "-dn", "-sn"]
+    if rungs:
+        args += ["-filter_complex", ladder_filter(rungs)]
+    args += ["-map", "0:v:0", "-tag:v:0", "hvc1", "-c:v:0", "copy", "-b:v:0", f"{VIDEO_KBPS}k"]
+    for index, rung in enumerate(rungs):
+        args += ["-map", f"[rung{index}]", *rung_args(index + 1, rung)]
+    # Each variant carries its own copy of the silent audio
+    args += ["-map", "1:0"] * (len(rungs) + 1)
+    return args + [
+        "-filter:a", "aresample=osr=44100", "-c:a", "aac", "-b:a", "8k",
+        "-shortest", "-bsf:a", "aac_adtstoasc", "-flags", "+low_delay",
+    ]
+
+def standard_command(source, rungs=ABR_RUNGS):
+    """ffmpeg's own fMP4 HLS output. With rungs, each variant gets its own directory
+    (source/ for the camera's stream) and the master playlist lists them all."""
+    if rungs:
+        names = ["source", *rungs]
+        variants = [
+            "-hls_fmp4_init_filename", "output_%v.mp4", "-hls_segment_filename", f"{HLS_DIR}/%v/output-%d.m4s",
+            "-var_stream_map", " ".join(f"v:{index},a:{index},name:{name}" for index, name in enumerate(names)),
+            "-master_pl_name", f"{STREAM_NAME}.m3u8", "-master_pl_publish_rate", "6",
+            # Encode speed for the stats; below 1x the rungs can't keep up with the camera
+            "-progress", "pipe:1", "-stats_period", "5",
+            f"{HLS_DIR}/%v/output.m3u8",
+        ]
+    else:
+        variants = [
+            "-hls_fmp4_init_filename", "output.mp4", "-hls_segment_filename", f"{HLS_DIR}/output-%d.m4s",
+            "-master_pl_name", f"{STREAM_NAME}.m3u8", "-master_pl_publish_rate", "6",
+            f"{HLS_DIR}/output.m3u8",
+        ]
+    return [
+        "ffmpeg", "-loglevel", "level+info", "-err_detect", "ignore_err", "-y", "-fflags", "+genpts",
+        "-thread_queue_size", "512", "-probesize", "5000000", "-analyzeduration", "5000000",
+        *source, *encode_args(rungs),
+        "-f", "hls", "-start_number", "0", "-hls_time", str(HLS_TIME), "-hls_list_size", str(HLS_LIST_SIZE),
+        "-hls_flags", "append_list+delete_segments+program_date_time+independent_segments+temp_file",
+        "-hls_delete_threshold", "4", "-hls_segment_type", "fmp4", "-hls_fmp4_init_resend", "1",
+        *variants,
+    ]
+
+def media_playlist(rungs=ABR_RUNGS):
+    """Standard mode playlist of the camera's own stream, which the stall check and archive follow."""
+    return f"{HLS_DIR}/source/output.m3u8" if rungs else f"{HLS_DIR}/output.m3u8"
+
+def low_latency_command(source):
+    # Fragments are cut at every keyframe and whenever they reach 90% of the part target, so
+    # no part runs over the target by the frame that ends it
+    return [
+        "ffmpeg", "-loglevel", "level+info", "-err_detect", "ignore_err", "-fflags", "+genpts",
+        "-thread_queue_size", "512", "-probesize", "5000000", "-analyzeduration", "5000000",
+        *source, *encode_args(),
+        "-f", "mp4", "-movflags", "empty_moov+default_base_moof+frag_keyframe",
+        "-frag_duration", str(int(LL_PART_TIME * 0.9 * 1e6)), "pipe:1",
+    ]
+
+def boxes(data, start=0, end=None):
+    """Yields (type, body_start, box_end) for the MP4 boxes in data[start:end]."""
+    end = len(data) if end is None else end
+    while start + 8 <= end:
+        size = int.from_bytes(data[start:start + 4], "big")
+        kind = bytes(data[start + 4:start + 8]).decode("latin-1")
+        header = 8
+        if size == 1:
+            size = int.from_bytes(data[start + 8:start + 16], "big")
+            header = 16
+        elif size == 0:
+            size = end - start
+        yield kind, start + header, start + size
+        start += size
+
+def child(data, start, end, kind):
+    return next(((s, e) for k, s, e in boxes(data, start, end) if k == kind), (None, None))
+
+def u32(data, pos):
+    return int.from_bytes(data[pos:pos + 4], "big")
+
+def parse_init(moov):
+    """Returns the video track's (track_id, timescale, trex default duration, trex default flags)."""
+    defaults = {}
+    start, end = child(moov, 0, len(moov), "mvex")
+    for kind, s, e in boxes(moov, start or 0, end or 0):
+        if kind == "trex":
+            defaults[u32(moov, s + 4)] = (u32(moov, s + 12), u32(moov, s + 20))
+    for kind, s, e in boxes(moov):
+        if kind != "trak":
+            continue
+        tkhd, _ = child(moov, s, e, "tkhd")
+        track_id = u32(moov, tkhd + (20 if moov[tkhd] == 1 else 12))
+        mdia, mdia_end = child(moov, s, e, "mdia")
+        hdlr, _ = child(moov, mdia, mdia_end, "hdlr")
+        if moov[hdlr + 8:hdlr + 12] != b"vide":
+            continue
+        mdhd, _ = child(moov, mdia, mdia_end, "mdhd")
+        timescale = u32(moov, mdhd + (20 if moov[mdhd] == 1 else 12))
+        return (track_id, timescale, *defaults.get(track_id, (0, 0)))
+    raise ValueError("No video track in the fMP4 stream")
+
+def fragment_info(moof, track):
+    """Returns (duration in seconds, starts with a keyframe) of the video track in a moof."""
+    track_id, timescale, default_duration, default_flags = track
+    for kind, s, e in boxes(moof):
+        if kind != "traf":
+            continue
+        tfhd, _ = child(moof, s, e, "tfhd")
+        flags = u32(moof, tfhd) & 0xFFFFFF
+        if u32(moof, tfhd + 4) != track_id:
+            continue
+        pos = tfhd + 8 + (8 if flags & 0x1 else 0) + (4 if flags & 0x2 else 0)
+        if flags & 0x8:
+            default_duration = u32(moof, pos)
+            pos += 4
+        pos += 4 if flags & 0x10 else 0
+        if flags & 0x20:
+            default_flags = u32(moof, pos)
+        duration = 0
+        first_flags = None
+        for kind, ts, te in boxes(moof, s, e):
+            if kind != "trun":
+                continue
+            trun_flags = u32(moof, ts) & 0xFFFFFF
+            count = u32(moof, ts + 4)
+            pos = ts + 8 + (4 if trun_flags & 0x1 else 0)
+            if trun_flags & 0x4:
+                first_flags = u32(moof, pos) if first_flags is None else first_flags
+                pos += 4
+            for index in range(count):
+                if trun_flags & 0x100:
+                    duration += u32(moof, pos)
+                    pos += 4
+                else:
+                    duration += default_duration
+                pos += 4 if trun_flags & 0x200 else 0
+                if trun_flags & 0x400:
+                    if first_flags is None:
+                        first_flags = u32(moof, pos)
+                    pos += 4
+                pos += 4 if trun_flags & 0x800 else 0
+        if first_flags is None:
+            first_flags = default_flags
+        return duration / timescale, not first_flags & SAMPLE_IS_NON_SYNC
+    return 0, False
+
+class Fmp4Splitter:
+    """Splits fragmented MP4 from ffmpeg into its init section (ftyp+moov) and moof+mdat fragments."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.init = bytearray()
+        self.track = None
+        self.moof = None
+
+    def feed(self, chunk):
+        """Returns new ("init", bytes) and ("fragment", bytes, duration, keyframe) pieces."""
+        self.buffer += chunk
+        pieces = []
+        start = 0
+        for kind, body, end in boxes(self.buffer):
+            if end > len(self.buffer):
+                break
+            box = bytes(self.buffer[start:end])
+            if self.track is None and kind in ("ftyp", "moov"):
+                self.init += box
+                if kind == "moov":
+                    self.track = parse_init(box[8:])
+                    pieces.append(("init", bytes(self.init)))
+            elif kind == "moof":
+                self.moof = box
+            elif kind == "mdat" and self.moof:
+                duration, keyframe = fragment_info(self.moof[8:], self.track)
+                pieces.append(("fragment", self.moof + box, duration, keyframe))
+                self.moof = None
+            start = end
+        del self.buffer[:start]
+        return pieces
+
+class Cadence:
+    """Times between new segments and the age of the newest one."""
+
+    def __init__(self):
+        self.segments = collections.deque(maxlen=1000)
+        self.restarts = 0
+        self.stalls = 0
+        # Latest encode speed ffmpeg reported, as a multiple of real time
+        self.speed = None
+
+    def segment(self, duration=None):
+        self.segments.append((time.time(), duration))
+
+    def age(self):
+        return time.time() - self.segments[-1][0] if self.segments else None
+
+    def summary(self, window):
+        recent = [t for t, _ in self.segments if t >= time.time() - window]
+        gaps = [b - a for a, b in zip(recent, recent[1:])]
+        return {
+            "segments": len(recent),
+            "interval_avg": sum(gaps) / len(gaps) if gaps else None,
+            "interval_max": max(gaps) if gaps else None,
+            "age": self.age(),
+            "restarts": self.restarts,
+            "stalls": self.stalls,
+            "speed": self.speed,
+        }
+
+def format_cadence(summary, window):
+    def value(key):
+        return "n/a" if summary[key] is None else f"{summary[key]:.1f}s"
+    return (f"HLS: {summary['segments']} segments in the last {window}s, interval {value('interval_avg')} "
+            f"average / {value('interval_max')} max, newest {value('age')} old, "
+            f"{summary['restarts']} restarts ({summary['stalls']} stalls)"
+            + (f", encoding at {summary['speed']:.2f}x real time" if summary["speed"] is not None else ""))
+
+class LowLatencyPlaylist:
+    """LL-HLS media playlist built from fMP4 fragments, one partial segment per fragment.
+
+    A segment is closed when a keyframe fragment arrives once it has reached LL_SEGMENT_TIME,
+    so every segment starts independently. Parts and segments are kept in memory for the last
+    LL_LIST_SIZE segments. Waiters for a blocking playlist reload or a preload-hinted part are
+    woken as each part lands.
+    """
+
+    def __init__(self, segment_time, part_time, list_size):
+        self.segment_time = segment_time
+        self.part_time = part_time
+        self.list_size = list_size
+        self.segments = []
+        self.inits = {}
+        self.init_id = -1
+        self.next_msn = 0
+        self.discontinuity = False
+        self.longest = segment_time
+        self.changed = asyncio.Condition()
+        # Called with each finished segment and its init section, e.g. to archive it
+        self.on_segment = None
+
+    async def set_init(self, init):
+        """Starts a new ffmpeg run: the open segment is closed, and the next follows a discontinuity."""
+        async with self.changed:
+            self.close_segment()
+            self.init_id += 1
+            self.inits[self.init_id] = init
+            self.discontinuity = bool(self.segments)
+            self.changed.notify_all()
+
+    def close_segment(self, cadence=None):
+        if self.segments and not self.segments[-1]["complete"]:
+            segment = self.segments[-1]
+            segment["complete"] = True
+            self.longest = max(self.longest, segment["duration"])
+            if cadence:
+                cadence.segment(segment["duration"])
+            if self.on_segment:
+                self.on_segment(segment, self.inits[segment["init"]])
+
+    async def add(self, data, duration, keyframe, cadence=None):
+        async with self.changed:
+            current = self.segments[-1] if self.segments and not self.segments[-1]["complete"] else None
+            # Fragment durations only add up to the segment time give or take a frame
+            if current and keyframe and current["duration"] >= self.segment_time - self.part_time / 2:
+                self.close_segment(cadence)
+                current = None
+            if current is None:
+                if not keyframe:
+                    # Wait for a keyframe to start the first segment of a run
+                    return
+                current = {"msn": self.next_msn, "parts": [], "duration": 0.0, "complete": False,
+                           "init": self.init_id, "discontinuity": self.discontinuity,
+                           "date": datetime.datetime.now(datetime.timezone.utc)}
+                self.next_msn += 1
+                self.discontinuity = False
+                self.segments.append(current)
+                del self.segments[:-self.list_size]
+                self.inits = {i: init for i, init in self.inits.items() if i >= self.segments[0]["init"]}
+            current["parts"].append({"data": data, "duration": duration, "independent": keyframe})
+            current["duration"] += duration
+            self.changed.notify_all()
+
+    def find(self, msn):
+        return next((segment for segment in self.segments if segment["msn"] == msn), None)
+
+    def has(self, msn, part=None):
+        """Whether a blocking reload for _HLS_msn/_HLS_part can be answered."""
+        if not self.segments:
+            return False
+        last = self.segments[-1]
+        if msn < last["msn"]:
+            return True
+        if msn > last["msn"]:
+            return False
+        # A part past the end of a finished segment means the first part of the next one
+        return len(last["parts"]) > part if part is not None else last["complete"]
+
+    async def wait_for(self, condition, timeout):
+        async with self.changed:
+            try:
+                await asyncio.wait_for(self.changed.wait_for(condition), timeout)
+                return True
+            except asyncio.TimeoutError:
+                return False
+
+    def render(self):
+        target = math.ceil(self.longest)
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:9",
+            f"#EXT-X-TARGETDURATION:{target}",
+            f"#EXT-X-PART-INF:PART-TARGET={self.part_time:.3f}",
+            f"#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK={3 * self.part_time:.3f}",
+            f"#EXT-X-MEDIA-SEQUENCE:{self.segments[0]['msn'] if self.segments else 0}",
+            "#EXT-X-INDEPENDENT-SEGMENTS",
+        ]
+        init = None
+        for index, segment in enumerate(self.segments):
+            if segment["discontinuity"] and index:
+                lines.append("#EXT-X-DISCONTINUITY")
+            if segment["init"] != init:
+                init = segment["init"]
+                lines.append(f'#EXT-X-MAP:URI="init-{init}.mp4"')
+            lines.append(f"#EXT-X-PROGRAM-DATE-TIME:{segment['date'].isoformat(timespec='milliseconds')}")
+            # Parts are only listed for the last few segments, where a player at the live edge needs them
+            if index >= len(self.segments) - 3:
+                for number, part in enumerate(segment["parts"]):
+                    independent = ",INDEPENDENT=YES" if part["independent"] else ""
+                    lines.append(f'#EXT-X-PART:DURATION={part["duration"]:.3f},'
+                                 f'URI="seg-{segment["msn"]}.{number}.m4s"{independent}')
+            if segment["complete"]:
+                lines += [f"#EXTINF:{segment['duration']:.3f},", f"seg-{segment['msn']}.m4s"]
+        if self.segments:
+            msn, part = self.next_part()
+            lines.append(f'#EXT-X-PRELOAD-HINT:TYPE=PART,URI="seg-{msn}.{part}.m4s"')
+        return "\n".join(lines) + "\n"
+
+    def next_part(self):
+        last = self.segments[-1]
+        return (last["msn"], len(last["parts"])) if not last["complete"] else (last["msn"] + 1, 0)
+
+class Archive:
+    """Finished segments on disk, with a time index so any window can be listed without scanning.
+
+    Segments are stored as <root>/YYYY/MM/DD/HH/<start ms>.m4s and init sections once each,
+    under init/<hash>.mp4. index.tsv lists every segment's start, duration, size, init and path
+    in the order they were added; it is loaded once at start and kept in memory as a sorted
+    list, so a window is two bisections. Once the archive grows past max_bytes, the oldest
+    segments are deleted down to 95% of it, the index is rewritten and init sections no
+    remaining segment uses are removed.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = []
+        self.starts = []
+        self.size = 0
+        self.longest = 0.0
+        self.inits = set()
+        self.queue = asyncio.Queue()
+        os.makedirs(os.path.join(root, "init"), exist_ok=True)
+        index = os.path.join(root, "index.tsv")
+        if os.path.exists(index):
+            with open(index) as f:
+                for line in f:
+                    start, duration, size, init, path = line.rstrip("\n").split("\t")
+                    self.entries.append((int(start), float(duration), int(size), init, path))
+            self.entries.sort()
+            self.starts = [entry[0] for entry in self.entries]
+            self.size = sum(entry[2] for entry in self.entries)
+            self.longest = max((entry[1] for entry in self.entries), default=0.0)
+            print(f"Archive holds {len(self.entries)} segments, {self.size / 1e9:.2f} GB")
+
+    def store_init(self, init):
+        name = hashlib.sha1(init).hexdigest()[:16]
+        if name not in self.inits:
+            path = os.path.join(self.root, "init", f"{name}.mp4")
+            if not os.path.exists(path):
+                with open(f"{path}.tmp", "wb") as f:
+                    f.write(init)
+                os.replace(f"{path}.tmp", path)
+            self.inits.add(name)
+        return name
+
+    def add(self, start, duration, source, init):
+        """Archives one segment, given as bytes or the path of a file to copy. Blocks on disk I/O."""
+        init_name = self.store_init(init)
+        start_ms = int(start.timestamp() * 1000)
+        relative = start.astimezone(datetime.timezone.utc).strftime("%Y/%m/%d/%H/") + f"{start_ms}.m4s"
+        path = os.path.join(self.root, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(source, bytes):
+            with open(f"{path}.tmp", "wb") as f:
+                f.write(source)
+        else:
+            shutil.copyfile(source, f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+        entry = (start_ms, duration, os.path.getsize(path), init_name, relative)
+        with self.lock:
+            position = bisect.bisect(self.starts, start_ms)
+            self.starts.insert(position, start_ms)
+            self.entries.insert(position, entry)
+            self.size += entry[2]
+            self.longest = max(self.longest, duration)
+            with open(os.path.join(self.root, "index.tsv"), "a") as f:
+                f.write("\t".join(str(field) for field in entry) + "\n")
+        if self.size > self.max_bytes:
+            self.prune()
+
+    def prune(self):
+        with self.lock:
+            dropped = 0
+            size = self.size
+            while dropped < len(self.entries) and size > self.max_bytes * 0.95:
+                size -= self.entries[dropped][2]
+                dropped += 1
+            removed = self.entries[:dropped]
+            del self.entries[:dropped]
+            del self.starts[:dropped]
+            self.size = size
+            index = os.path.join(self.root, "index.tsv")
+            with open(f"{index}.tmp", "w") as f:
+                f.writelines("\t".join(str(field) for field in entry) + "\n" for entry in self.entries)
+            os.replace(f"{index}.tmp", index)
+            used = {entry[3] for entry in self.entries}
+        for entry in removed:
+            path = os.path.join(self.root, entry[4])
+            try:
+                os.remove(path)
+                os.removedirs(os.path.dirname(path))
+            except OSError:
+                # The hour's directory still holds newer segments
+                pass
+        # Segments are only added by the archiver thread that prunes, so no new segment needs these
+        for name in os.listdir(os.path.join(self.root, "init")):
+            if name.endswith(".mp4") and name[:-4] not in used:
+                os.remove(os.path.join(self.root, "init", name))
+                self.inits.discard(name[:-4])
+        print(f"Archive pruned {len(removed)} segments, {self.size / 1e9:.2f} GB kept")
+
+    def latest(self):
+        """Start of the newest archived segment, or None."""
+        with self.lock:
+            if not self.entries:
+                return None
+            return datetime.datetime.fromtimestamp(self.entries[-1][0] / 1000, datetime.timezone.utc)
+
+    def window(self, start_ms, end_ms=None):
+        """Segments overlapping [start_ms, end_ms), found by bisecting the start times."""
+        with self.lock:
+            first = max(0, bisect.bisect_right(self.starts, start_ms) - 1)
+            if first < len(self.entries) and self.entries[first][0] + self.entries[first][1] * 1000 <= start_ms:
+                first += 1
+            last = bisect.bisect_left(self.starts, end_ms) if end_ms is not None else len(self.entries)
+            return self.entries[first:last]
+
+    def playlist(self, start_ms, end_ms, base):
+        """VOD playlist for a closed window, or an EVENT playlist that keeps growing when end_ms is None."""
+        entries = self.window(start_ms, end_ms)
+        if not entries:
+            return None
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:7",
+            f"#EXT-X-TARGETDURATION:{math.ceil(max(entry[1] for entry in entries))}",
+            f"#EXT-X-PLAYLIST-TYPE:{'VOD' if end_ms is not None else 'EVENT'}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+            "#EXT-X-INDEPENDENT-SEGMENTS",
+        ]
+        init = None
+        previous_end = None
+        for start, duration, size, init_name, path in entries:
+            # A gap (ffmpeg restart, camera outage) or a new init section starts a new timeline
+            gap = previous_end is None or abs(start - previous_end) > 1000
+            if previous_end is not None and (gap or init_name != init):
+                lines.append("#EXT-X-DISCONTINUITY")
+            if init_name != init:
+                init = init_name
+                lines.append(f'#EXT-X-MAP:URI="{base}init/{init_name}.mp4"')
+            if gap:
+                date = datetime.datetime.fromtimestamp(start / 1000, datetime.timezone.utc)
+                lines.append(f"#EXT-X-PROGRAM-DATE-TIME:{date.isoformat(timespec='milliseconds')}")
+            lines += [f"#EXTINF:{duration:.3f},", f"{base}{path}"]
+            previous_end = start + duration * 1000
+        if end_ms is not None:
+            lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+async def run_archiver(archive):
+    """Writes queued segments to the archive off the event loop, one at a time."""
+    while True:
+        item = await archive.queue.get()
+        try:
+            await asyncio.to_thread(archive.add, *item)
+        except OSError as e:
+            print(f"Warning: Failed to archive segment: {e}")
+
+def parse_time(value):
+    """Unix seconds or an ISO 8601 time, as milliseconds."""
+    try:
+        return int(float(value) * 1000)
+    except ValueError:
+        date = datetime.datetime.fromisoformat(value)
+        if date.tzinfo is None:
+            date = date.astimezone()
+        return int(date.timestamp() * 1000)
+
+def write_master(path, media_uri):
+    """Master playlist for the website, pointing at the low-latency media playlist.
+
+    CODECS is left out: the camera's HEVC is copied, so its profile and level are not known
+    here, and a bare "hvc1" is rejected by MediaSource.isTypeSupported.
+    """
+    bandwidth = int(VIDEO_KBPS or 0) * 1000 + 8000
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write("#EXTM3U\n#EXT-X-VERSION:9\n#EXT-X-INDEPENDENT-SEGMENTS\n"
+                f"#EXT-X-STREAM-INF:BANDWIDTH={bandwidth}\n{media_uri}\n")
+    os.replace(tmp, path)
+
+async def serve_http(playlist, cadence, archive, port):
+    """Serves the LL-HLS playlist, init sections, parts and segments, with blocking reloads and preload hints.
+
+    With an archive, /dvr/playlist.m3u8 also lists archived segments for ?start=&end= (Unix
+    seconds or ISO 8601); without an end it is an EVENT playlist that grows as segments are
+    archived. ?rewind=N redirects once to the absolute start N seconds ago, so reloads keep
+    appending to the same playlist. The segments themselves are served by nginx.
+    """
+    part_name = re.compile(r"/seg-(\d+)\.(\d+)\.m4s$")
+    segment_name = re.compile(r"/seg-(\d+)\.m4s$")
+    init_name = re.compile(r"/init-(\d+)\.mp4$")
+
+    async def respond(writer, status, body=b"", content_type="text/plain", cache=True, location=None):
+        headers = [f"HTTP/1.1 {status}", f"Content-Type: {content_type}", f"Content-Length: {len(body)}",
+                   "Access-Control-Allow-Origin: *", "Connection: keep-alive"]
+        if location:
+            headers.append(f"Location: {location}")
+        if not cache:
+            headers.append("Cache-Control: no-cache")
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode() + body)
+        await writer.drain()
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                request = await asyncio.wait_for(reader.readline(), 65)
+                if not request:
+                    break
+                while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                    pass
+                parts = request.decode("latin-1").split()
+                url = urllib.parse.urlparse(parts[1] if len(parts) > 1 else "/")
+                query = dict(urllib.parse.parse_qsl(url.query))
+                path = url.path
+                # Requests for future media are held for up to three target durations
+                hold = 3 * math.ceil(playlist.longest) if playlist else 0
+
+                if path.startswith("/dvr/") and archive:
+                    try:
+                        if "rewind" in query:
+                            start = time.time() - float(query["rewind"])
+                            await respond(writer, "302 Found", cache=False,
+                                          location=f"{path}?start={start:.3f}")
+                            continue
+                        start = parse_time(query.get("start", "0"))
+                        end = parse_time(query["end"]) if "end" in query else None
+                    except ValueError:
+                        await respond(writer, "400 Bad Request")
+                        continue
+                    body = archive.playlist(start, end, "/dvr/media/")
+                    if body:
+                        await respond(writer, "200 OK", body.encode(), "application/vnd.apple.mpegurl", cache=False)
+                    else:
+                        await respond(writer, "404 Not Found")
+                elif not playlist and not path.endswith("/stats"):
+                    await respond(writer, "404 Not Found")
+                elif path.endswith(".m3u8"):
+                    if "_HLS_msn" in query:
+                        msn = int(query["_HLS_msn"])
+                        part = int(query["_HLS_part"]) if "_HLS_part" in query else None
+                        last = playlist.segments[-1]["msn"] if playlist.segments else 0
+                        if msn > last + 2:
+                            await respond(writer, "400 Bad Request")
+                            continue
+                        if not await playlist.wait_for(lambda: playlist.has(msn, part), hold):
+                            await respond(writer, "503 Service Unavailable")
+                            continue
+                    await respond(writer, "200 OK", playlist.render().encode(),
+                                  "application/vnd.apple.mpegurl", cache=False)
+                elif match := part_name.search(path):
+                    msn, number = int(match[1]), int(match[2])
+
+                    def ready():
+                        segment = playlist.find(msn)
+                        return bool(segment and (len(segment["parts"]) > number or segment["complete"]))
+
+                    # A preload-hinted part is requested before it exists and answered once it does
+                    if playlist.segments and (msn, number) == playlist.next_part():
+                        await playlist.wait_for(ready, hold)
+                    segment = playlist.find(msn)
+                    if segment and number < len(segment["parts"]):
+                        await respond(writer, "200 OK", segment["parts"][number]["data"], "video/iso.segment")
+                    else:
+                        await respond(writer, "404 Not Found")
+                elif match := segment_name.search(path):
+                    segment = playlist.find(int(match[1]))
+                    if segment and segment["complete"]:
+                        body = b"".join(part["data"] for part in segment["parts"])
+                        await respond(writer, "200 OK", body, "video/iso.segment")
+                    else:
+                        await respond(writer, "404 Not Found")
+                elif (match := init_name.search(path)) and int(match[1]) in playlist.inits:
+                    await respond(writer, "200 OK", playlist.inits[int(match[1])], "video/mp4")
+                elif path.endswith("/stats"):
+                    body = json.dumps(cadence.summary(STATS_INTERVAL or 300), indent=2).encode()
+                    await respond(writer, "200 OK", body, "application/json", cache=False)
+                else:
+                    await respond(writer, "404 Not Found")
+        except (asyncio.TimeoutError, ConnectionError, ValueError, IndexError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, port=port)
+    print(f"Serving {'low-latency HLS' if playlist else 'the archive'} on port {port}")
+    return server
+
+def playlist_entries(text):
+    """(program date time, duration, uri) of each segment in an ffmpeg playlist."""
+    entries = []
+    date = duration = None
+    for line in text.splitlines():
+        if line.startswith("#EXT-X-PROGRAM-DATE-TIME:"):
+            date = datetime.datetime.fromisoformat(line.split(":", 1)[1])
+        elif line.startswith("#EXTINF:"):
+            duration = float(line[8:].split(",")[0])
+        elif line and not line.startswith("#") and duration is not None:
+            entries.append((date, duration, line))
+            date = date + datetime.timedelta(seconds=duration) if date else None
+            duration = None
+    return entries
+
+async def watch_standard_playlist(path, cadence, archive=None):
+    """Notes each new segment ffmpeg adds to its playlist, and queues it for the archive.
+
+    Segments are archived as soon as they are listed, long before ffmpeg deletes them from the
+    ramdisk. They are told apart by program date time, which carries on across restarts, so
+    segments archived before a restart of the container are not archived again.
+    """
+    newest = None
+    archived = archive.latest() if archive else None
+    directory = os.path.dirname(path)
+    while True:
+        await asyncio.sleep(1)
+        try:
+            with open(path) as f:
+                text = f.read()
+        except FileNotFoundError:
+            continue
+        entries = [entry for entry in playlist_entries(text) if entry[0]]
+        init_map = re.search(r'#EXT-X-MAP:URI="([^"]+)"', text)
+        for date, duration, uri in entries:
+            if newest is not None and date > newest:
+                cadence.segment(duration)
+            if archive and init_map and (archived is None or date > archived):
+                with open(os.path.join(directory, init_map[1]), "rb") as f:
+                    init = f.read()
+                archive.queue.put_nowait((date, duration, os.path.join(directory, uri), init))
+                archived = date
+        if entries:
+            newest = max(newest or entries[-1][0], entries[-1][0])
+
+async def run_packager(command, cadence, playlist=None):
+    """Runs ffmpeg, restarting it when it exits or when no new segment has appeared for STALL_TIMEOUT seconds.
+
+    In low-latency mode ffmpeg's fMP4 output is read from stdout and fed to the playlist;
+    in standard mode ffmpeg writes its own playlist and segments.
+    """
+    delay = RESTART_DELAY
+    while True:
+        started = time.time()
+        cadence.speed = None
+        process = await asyncio.create_subprocess_exec(
+            *command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        if playlist:
+            reader = asyncio.create_task(read_fragments(process.stdout, playlist, cadence))
+        else:
+            reader = asyncio.create_task(read_progress(process.stdout, cadence))
+        stalled = False
+        try:
+            while process.returncode is None:
+                try:
+                    await asyncio.wait_for(asyncio.shield(process.wait()), 2)
+                except asyncio.TimeoutError:
+                    pass
+                age = cadence.age()
+                if age is None or cadence.segments[-1][0] < started:
+                    age, limit = time.time() - started, STALL_TIMEOUT + STALL_STARTUP_GRACE
+                else:
+                    limit = STALL_TIMEOUT
+                if process.returncode is None and age > limit:
+                    print(f"FFmpeg has stalled (no new segment for {age:.0f}s). Killing it...")
+                    cadence.stalls += 1
+                    stalled = True
+                    process.kill()
+                    await process.wait()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+            raise
+        await reader
+        cadence.restarts += 1
+        if stalled:
+            print("Restarting stalled FFmpeg now...")
+            delay = RESTART_DELAY
+            continue
+        if time.time() - started >= 60:
+            delay = RESTART_DELAY
+        print(f"FFmpeg exited with code {process.returncode}. Restarting in {delay:.0f}s...")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, RESTART_DELAY_MAX)
+
+async def read_fragments(stdout, playlist, cadence):
+    splitter = Fmp4Splitter()
+    while chunk := await stdout.read(65536):
+        for piece in splitter.feed(chunk):
+            if piece[0] == "init":
+                await playlist.set_init(piece[1])
+            else:
+                await playlist.add(*piece[1:], cadence=cadence)
+
+async def read_progress(stdout, cadence):
+    """Keeps the encode speed from ffmpeg's -progress output, when it has been asked for."""
+    while line := await stdout.readline():
+        key, _, value = line.decode().strip().partition("=")
+        if key == "speed" and value.endswith("x"):
+            cadence.speed = float(value[:-1])
+
+def snapshot_outputs():
+    """(file name, height, format) of each snapshot; a height of None keeps the camera's resolution."""
+    outputs = [(f"{STREAM_NAME}.jpg", None, "jpg")]
+    for name, height in SNAPSHOT_SIZES.items():
+        outputs += [(f"{STREAM_NAME}-{name}.{fmt}", height, fmt) for fmt in SNAPSHOT_FORMATS]
+    return outputs
+
+def snapshot_command(outputs, directory):
+    """Decodes one frame from stdin once and writes every snapshot from it, each to a temporary file."""
+    split = f"[0:v:0]split={len(outputs)}" + "".join(f"[s{index}]" for index in range(len(outputs)))
+    scales = [f"[s{index}]scale=-2:'min({height},ih)'[o{index}]" if height else f"[s{index}]null[o{index}]"
+              for index, (_, height, _) in enumerate(outputs)]
+    command = ["ffmpeg", "-v", "error", "-y", "-i", "pipe:0", "-filter_complex", ";".join([split, *scales])]
+    for index, (name, _, fmt) in enumerate(outputs):
+        command += ["-map", f"[o{index}]", "-frames:v", "1", *SNAPSHOT_ENCODERS[fmt], os.path.join(directory, f".{name}.tmp")]
+    return command
+
+def newest_keyframe(playlist=None, standard_path=None):
+    """(key, capture time, init + media starting on a keyframe) from the newest segment, or None."""
+    if playlist:
+        for segment in reversed(playlist.segments):
+            if segment["parts"] and segment["parts"][0]["independent"]:
+                init = playlist.inits.get(segment["init"])
+                return (segment["msn"], segment["date"], init + segment["parts"][0]["data"]) if init else None
+        return None
+    try:
+        with open(standard_path) as f:
+            text = f.read()
+        entries = playlist_entries(text)
+        init_map = re.search(r'#EXT-X-MAP:URI="([^"]+)"', text)
+        if not entries or not init_map:
+            return None
+        date, _, uri = entries[-1]
+        directory = os.path.dirname(standard_path)
+        with open(os.path.join(directory, init_map[1]), "rb") as init, open(os.path.join(directory, uri), "rb") as media:
+            return (uri, date or datetime.datetime.now(datetime.timezone.utc), init.read() + media.read())
+    except FileNotFoundError:
+        # ffmpeg deleted the segment as it was read; the next one will do
+        return None
+
+def publish_snapshots(outputs, directory, date, digests):
+    """Moves rendered snapshots into place, leaving any that are byte-for-byte unchanged alone.
+
+    nginx's ETag is the file's modification time and size, so each file's time is set to when
+    the frame was captured: an image keeps its ETag for as long as it is served, and players
+    revalidating an unchanged one get a 304.
+    """
+    replaced = 0
+    for name, _, _ in outputs:
+        tmp = os.path.join(directory, f".{name}.tmp")
+        with open(tmp, "rb") as f:
+            digest = hashlib.sha1(f.read()).digest()
+        if digests.get(name) == digest:
+            os.remove(tmp)
+            continue
+        if date:
+            os.utime(tmp, (date.timestamp(), date.timestamp()))
+        os.replace(tmp, os.path.join(directory, name))
+        digests[name] = digest
+        replaced += 1
+    return replaced
+
+async def render_snapshots(outputs, directory, frame, digests):
+    """Renders and publishes every snapshot of one frame. Returns how many files changed, or None on failure."""
+    process = await asyncio.create_subprocess_exec(
+        *snapshot_command(outputs, directory), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    _, errors = await process.communicate(frame[2])
+    if process.returncode != 0:
+        print(f"Warning: Snapshot failed: {errors.decode(errors='replace').strip()[-300:]}")
+        return None
+    return await asyncio.to_thread(publish_snapshots, outputs, directory, frame[1], digests)
+
+async def run_snapshots(playlist=None, standard_path=None):
+    """Every SNAPSHOT_INTERVAL seconds, renders the newest keyframe into every snapshot size and format.
+
+    Frames come from the stream already being packaged, so the camera is never asked for an
+    image. A keyframe is only rendered once, however often the interval comes round.
+    """
+    outputs = snapshot_outputs()
+    print(f"Writing snapshots every {SNAPSHOT_INTERVAL}s: {', '.join(name for name, _, _ in outputs)}")
+    digests = {}
+    previous = None
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        frame = newest_keyframe(playlist, standard_path)
+        if frame and frame[0] != previous:
+            await render_snapshots(outputs, HLS_DIR, frame, digests)
+            previous = frame[0]
+
+async def log_cadence(cadence):
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        print(format_cadence(cadence.summary(STATS_INTERVAL), STATS_INTERVAL))
+
+async def measure_latency(command, duration, playlist=None, port=None, standard_path=None):
+    """Runs a packager against a real-time source and times when each piece of media can first be fetched.
+
+    Returns, for each part (or segment), how long after start the piece became available less
+    the media time at its end. A player's latency is roughly that plus its hold-back from the
+    live edge, once corrected for how far ahead of real time ffmpeg reads the source.
+    """
+    cadence = Cadence()
+    tasks = [asyncio.create_task(run_packager(command, cadence, playlist))]
+    if standard_path:
+        tasks.append(asyncio.create_task(watch_standard_playlist(standard_path, cadence)))
+    start = time.time()
+    delays = []
+    if playlist:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        msn, part, media_end = 0, 0, 0.0
+        while time.time() - start < duration:
+            writer.write(f"GET /ll/output.m3u8?_HLS_msn={msn}&_HLS_part={part} HTTP/1.1\r\n\r\n".encode())
+            await writer.drain()
+            status = await reader.readline()
+            length = 0
+            while (line := await reader.readline()).strip():
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":")[1])
+            text = (await reader.readexactly(length)).decode()
+            if not status.startswith(b"HTTP/1.1 200"):
+                continue
+            segment = playlist.find(msn)
+            if segment and part < len(segment["parts"]):
+                media_end += segment["parts"][part]["duration"]
+                delays.append(time.time() - start - media_end)
+                part += 1
+            else:
+                msn, part = msn + 1, 0
+        writer.close()
+    else:
+        seen = 0
+        media_end = 0.0
+        while time.time() - start < duration:
+            await asyncio.sleep(0.1)
+            try:
+                with open(standard_path) as f:
+                    found = [float(d) for d in re.findall(r"#EXTINF:([\d.]+)", f.read())]
+            except FileNotFoundError:
+                continue
+            for segment in found[seen:]:
+                media_end += segment
+                delays.append(time.time() - start - media_end)
+            seen = len(found)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return delays
+
+async def run_latency_test(duration, port):
+    """Compares how soon media is fetchable in standard and low-latency mode, against a local real-time source."""
+    global HLS_DIR, STREAM_NAME, VIDEO_KBPS
+    STREAM_NAME, VIDEO_KBPS = "test", "1000"
+    with tempfile.TemporaryDirectory() as tmp:
+        sample = os.path.join(tmp, "sample.mp4")
+        print("Generating HEVC sample video...")
+        subprocess.run(["ffmpeg", "-v", "error", "-f", "lavfi", "-i", "testsrc2=size=640x360:rate=25", "-t", "20",
+                        "-c:v", "libx265", "-preset", "ultrafast", "-g", "50", "-x265-params", "log-level=none",
+                        sample], check=True)
+        source = ["-re", "-readrate_initial_burst", "0", "-stream_loop", "-1", "-i", sample]
+        quiet = ["-v", "error"]
+
+        HLS_DIR = tmp
+        playlist = LowLatencyPlaylist(LL_SEGMENT_TIME, LL_PART_TIME, LL_LIST_SIZE)
+        server = await serve_http(playlist, Cadence(), None, port)
+        command = low_latency_command(source)
+        command[1:3] = quiet
+        low = await measure_latency(command, duration, playlist, port)
+        server.close()
+
+        command = standard_command(source)
+        command[1:3] = quiet
+        standard = await measure_latency(command, duration, standard_path=f"{tmp}/output.m3u8")
+
+    # ffmpeg reads the start of the source ahead of real time. A blocked playlist reload returns
+    # the moment a part is written, so the earliest part gives that lead, and it is taken off both
+    lead = -min(low)
+
+    def report(name, delays, hold_back, unit):
+        # The first pieces include ffmpeg's start-up, so are left out of the steady-state figure
+        steady = [delay + lead for delay in delays[len(delays) // 4:]]
+        average = sum(steady) / len(steady)
+        print(f"{name} {len(delays)} {unit}, available {average:.2f}s after capture on average; "
+              f"with a {hold_back:.1f}s hold-back, about {average + hold_back:.1f}s behind live")
+
+    print(f"Source read {lead:.2f}s ahead of real time")
+    # hls.js holds back three target durations from the live edge, or three part targets in low-latency mode
+    report("Standard:   ", standard, 3 * HLS_TIME, "segments")
+    report("Low-latency:", low, 3 * LL_PART_TIME, "parts")
+    print(f"Low-latency segments: {len(playlist.segments)}, longest {playlist.longest:.2f}s")
+
+async def run_dvr_test(duration, port):
+    """Archives a short-lived standard playlist, plays a window of it back, then times a lookup in a large index."""
+    global HLS_DIR, STREAM_NAME, VIDEO_KBPS, HLS_TIME, HLS_LIST_SIZE
+    STREAM_NAME, VIDEO_KBPS, HLS_TIME, HLS_LIST_SIZE = "test", "1000", 2, 3
+    with tempfile.TemporaryDirectory() as tmp:
+        HLS_DIR = os.path.join(tmp, "hls")
+        os.makedirs(HLS_DIR)
+        archive = Archive(os.path.join(tmp, "archive"), 1e9)
+        cadence = Cadence()
+        sample = os.path.join(tmp, "sample.mp4")
+        print("Generating HEVC sample video...")
+        subprocess.run(["ffmpeg", "-v", "error", "-f", "lavfi", "-i", "testsrc2=size=640x360:rate=25", "-t", "20",
+                        "-c:v", "libx265", "-preset", "ultrafast", "-g", "50", "-x265-params", "log-level=none",
+                        sample], check=True)
+        source = ["-re", "-readrate_initial_burst", "0", "-stream_loop", "-1", "-i", sample]
+        command = standard_command(source)
+        command[1:3] = ["-v", "error"]
+        tasks = [asyncio.create_task(run_packager(command, cadence)),
+                 asyncio.create_task(watch_standard_playlist(f"{HLS_DIR}/output.m3u8", cadence, archive)),
+                 asyncio.create_task(run_archiver(archive))]
+        server = await serve_http(None, cadence, archive, port)
+        start = time.time()
+        print(f"Packaging a {HLS_TIME}s-segment, {HLS_LIST_SIZE}-segment playlist for {duration}s...")
+        await asyncio.sleep(duration)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        on_ramdisk = len([name for name in os.listdir(HLS_DIR) if name.endswith(".m4s")])
+        print(f"Segments left on the ramdisk: {on_ramdisk}, in the archive: {len(archive.entries)}, "
+              f"{archive.size / 1e6:.1f} MB")
+
+        async def get(url):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(f"GET {url} HTTP/1.1\r\n\r\n".encode())
+            await writer.drain()
+            status = (await reader.readline()).decode().strip()
+            headers = {}
+            while (line := (await reader.readline()).decode()).strip():
+                name, _, value = line.partition(":")
+                headers[name.lower()] = value.strip()
+            text = (await reader.readexactly(int(headers.get("content-length", 0)))).decode()
+            writer.close()
+            return status, headers, text
+
+        # A rewind resolves to one absolute start, so every reload lists the same first segment
+        status, headers, _ = await get(f"/dvr/playlist.m3u8?rewind={duration / 2:.0f}")
+        location = headers.get("location")
+        reloads = [(await get(location))[2] for _ in range(2)] if location else []
+        stable = len(reloads) == 2 and reloads[0].split("#EXTINF")[1] == reloads[1].split("#EXTINF")[1]
+        print(f"Rewind: {status} to {location}, first segment stable across reloads: {'yes' if stable else 'no'}")
+
+        # A window from the middle of the run, through the server as a player would fetch it
+        first, last = start + duration / 4, start + duration * 3 / 4
+        status, _, text = await get(f"/dvr/playlist.m3u8?start={first:.3f}&end={last:.3f}")
+        await asyncio.sleep(0.1)
+        server.close()
+        listed = sum(float(d) for d in re.findall(r"#EXTINF:([\d.]+)", text))
+        print(f"Window of {last - first:.0f}s: {status}, {text.count('#EXTINF')} segments, {listed:.1f}s listed")
+        vod = os.path.join(archive.root, "window.m3u8")
+        with open(vod, "w") as f:
+            f.write(text.replace("/dvr/media/", ""))
+        decoded = subprocess.run(["ffmpeg", "-v", "error", "-i", vod, "-f", "null", "-"], capture_output=True, text=True)
+        print(f"Window decodes: {'yes' if decoded.returncode == 0 and not decoded.stderr else decoded.stderr.strip()}")
+
+        # Retention: shrink the limit and check the index on disk agrees after a reload, with an
+        # init section only the pruned segments used
+        archive.entries[0] = archive.entries[0][:3] + (archive.store_init(b"stale"),) + archive.entries[0][4:]
+        archive.max_bytes = archive.size / 2
+        archive.prune()
+        files = sum(len([name for name in names if name.endswith(".m4s")])
+                    for _, _, names in os.walk(archive.root))
+        inits = len(os.listdir(os.path.join(archive.root, "init")))
+        reloaded = Archive(archive.root, archive.max_bytes)
+        print(f"After pruning to half: {len(archive.entries)} indexed, {files} files, {len(reloaded.entries)} reloaded, "
+              f"{inits} init sections for {len({entry[3] for entry in archive.entries})} in use")
+
+        # A month of 2s segments, then an hour's rewind from the middle of it
+        big = Archive(os.path.join(tmp, "big"), 1e15)
+        now = int(time.time() * 1000)
+        big.entries = [(now - i * 2000, 2.0, 500000, "init", f"{i}.m4s") for i in range(1300000, 0, -1)]
+        big.starts = [entry[0] for entry in big.entries]
+        timer = time.perf_counter()
+        for _ in range(100):
+            text = big.playlist(now - 1300000 * 1000, now - 1296400 * 1000, "/dvr/media/")
+        elapsed = (time.perf_counter() - timer) / 100
+        print(f"One-hour playlist from {len(big.entries)} segments: {text.count('#EXTINF')} segments "
+              f"in {elapsed * 1000:.2f}ms")
+
+async def run_abr_benchmark(size, rungs, seconds=10):
+    """Times each rung on its own and the whole ladder on a generated HEVC sample, as fast as the CPU allows.
+
+    Each rung's own cost is its run less a decode-only run, since the ladder decodes the camera's
+    stream once for all of them. The ladder keeps up with the camera if it runs at 1x or faster.
+    """
+    global HLS_DIR, STREAM_NAME, VIDEO_KBPS
+    STREAM_NAME, VIDEO_KBPS = "test", "8192"
+    with tempfile.TemporaryDirectory() as tmp:
+        sample = os.path.join(tmp, "sample.mp4")
+        print(f"Generating {seconds}s {size} HEVC sample video...")
+        subprocess.run(["ffmpeg", "-v", "error", "-f", "lavfi", "-i", f"testsrc2=size={size}:rate=25", "-t", str(seconds),
+                        "-c:v", "libx265", "-preset", "ultrafast", "-g", "50", "-x265-params", "log-level=none",
+                        sample], check=True)
+
+        def timed(args):
+            started = time.time()
+            subprocess.run(["ffmpeg", "-v", "error", "-y", "-i", sample, *args], check=True)
+            return time.time() - started
+
+        decode = timed(["-f", "null", "-"])
+        print(f"Decode only: {seconds / decode:.2f}x real time")
+        encode_total = 0.0
+        for rung in rungs:
+            elapsed = timed(["-filter_complex", ladder_filter([rung]), "-map", "[rung0]", *rung_args(0, rung),
+                             "-f", "null", "-"])
+            encode_total += elapsed - decode
+            print(f"{rung:>6}: {seconds / elapsed:.2f}x real time with the decode, "
+                  f"{seconds / max(elapsed - decode, 0.001):.2f}x for the scale and encode alone")
+        print(f"Estimated ladder: {seconds / (decode + encode_total):.2f}x real time")
+
+        HLS_DIR = tmp
+        command = standard_command(["-i", sample], rungs)
+        command[1:3] = ["-v", "error"]
+        started = time.time()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        ladder = time.time() - started
+        with open(f"{tmp}/{STREAM_NAME}.m3u8") as f:
+            variants = f.read().count("#EXT-X-STREAM-INF")
+        aligned = {name: re.findall(r"#EXTINF:([\d.]+)", open(f"{tmp}/{name}/output.m3u8").read())[:-1]
+                   for name in ["source", *rungs]}
+        print(f"Ladder of {variants} variants: {seconds / ladder:.2f}x real time, "
+              f"{'keeps up' if ladder <= seconds else 'too slow'} for a live camera; segments "
+              f"{'aligned' if len({tuple(durations) for durations in aligned.values()}) == 1 else 'NOT aligned'}")
+
+async def run_snapshot_test(size):
+    """Renders every snapshot from a keyframe of a generated stream, twice, and times it."""
+    global HLS_DIR, STREAM_NAME, VIDEO_KBPS, HLS_TIME
+    STREAM_NAME, VIDEO_KBPS, HLS_TIME = "test", "8192", 2
+    with tempfile.TemporaryDirectory() as tmp:
+        sample = os.path.join(tmp, "sample.mp4")
+        print(f"Generating {size} HEVC sample video...")
+        subprocess.run(["ffmpeg", "-v", "error", "-f", "lavfi", "-i", f"testsrc2=size={size}:rate=25", "-t", "4",
+                        "-c:v", "libx265", "-preset", "ultrafast", "-g", "50", "-x265-params", "log-level=none",
+                        sample], check=True)
+        HLS_DIR = tmp
+        command = standard_command(["-i", sample], [])
+        command[1:3] = ["-v", "error"]
+        subprocess.run(command, check=True)
+
+        outputs = snapshot_outputs()
+        digests = {}
+        frame = newest_keyframe(standard_path=media_playlist([]))
+        for attempt in ("First", "Same keyframe again"):
+            started = time.time()
+            replaced = await render_snapshots(outputs, tmp, frame, digests)
+            print(f"{attempt}: rendered {len(outputs)} snapshots in {time.time() - started:.2f}s, {replaced} files replaced")
+        for name, _, _ in outputs:
+            stat = os.stat(os.path.join(tmp, name))
+            # As nginx builds it from the modification time and size
+            etag = f'"{int(stat.st_mtime):x}-{stat.st_size:x}"'
+            print(f"  {name:<18} {stat.st_size / 1000:8.1f} kB  ETag {etag}")
+
+async def main():
+    print(f"Starting HLS packager in {HLS_MODE} mode...")
+    cadence = Cadence()
+    if STATS_INTERVAL:
+        asyncio.create_task(log_cadence(cadence))
+    source = input_args(RTSP_URL)
+    unknown = [rung for rung in ABR_RUNGS if rung not in LADDER]
+    if unknown:
+        raise SystemExit(f"Error: Unknown ABR rungs {', '.join(unknown)} (choose from {', '.join(LADDER)})")
+    if ABR_RUNGS:
+        if HLS_MODE == "low-latency":
+            print("Warning: ABR_RUNGS is only used in standard mode; serving the camera's stream alone")
+        else:
+            print(f"Offering {', '.join(ABR_RUNGS)} below the camera's stream, encoded with x264 {ABR_PRESET}")
+    archive = None
+    if ARCHIVE_DIR:
+        archive = Archive(ARCHIVE_DIR, ARCHIVE_MAX_GB * 1e9)
+        asyncio.create_task(run_archiver(archive))
+    if HLS_MODE == "low-latency":
+        playlist = LowLatencyPlaylist(LL_SEGMENT_TIME, LL_PART_TIME, LL_LIST_SIZE)
+        if archive:
+            playlist.on_segment = lambda segment, init: archive.queue.put_nowait(
+                (segment["date"], segment["duration"], b"".join(part["data"] for part in segment["parts"]), init))
+        await serve_http(playlist, cadence, archive, PACKAGER_PORT)
+        write_master(f"{HLS_DIR}/{STREAM_NAME}.m3u8", "ll/output.m3u8")
+        if SNAPSHOT_INTERVAL:
+            asyncio.create_task(run_snapshots(playlist))
+        await run_packager(low_latency_command(source), cadence, playlist)
+    else:
+        if archive:
+            await serve_http(None, cadence, archive, PACKAGER_PORT)
+        asyncio.create_task(watch_standard_playlist(media_playlist(), cadence, archive))
+        if SNAPSHOT_INTERVAL:
+            asyncio.create_task(run_snapshots(standard_path=media_playlist()))
+        await run_packager(standard_command(source), cadence)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dunedin-Live HLS packager")
+    parser.add_argument("--latency-test", action="store_true",
+                        help="compare media availability in standard and low-latency mode on a local source, then exit")
+    parser.add_argument("--dvr-test", action="store_true",
+                        help="archive a short-lived local stream, play back a window of it and time index lookups, then exit")
+    parser.add_argument("--abr-benchmark", action="store_true",
+                        help="time each ABR rung and the whole ladder on a generated sample, then exit")
+    parser.add_argument("--snapshot-test", action="store_true",
+                        help="render every snapshot from a generated keyframe and time it, then exit")
+    parser.add_argument("--size", default="3840x2160", help="resolution of the sample in the ABR benchmark and snapshot test")
+    parser.add_argument("--rungs", default="1080p,720p,480p", help="rungs to time in the ABR benchmark")
+    parser.add_argument("--duration", type=int, default=40, help="seconds to run each mode in the latency test")
+    parser.add_argument("--port", type=int, default=18088, help="port for the low-latency server in the test")
+    args = parser.parse_args()
+
+    if args.latency_test:
+        asyncio.run(run_latency_test(args.duration, args.port))
+        raise SystemExit(0)
+    if args.abr_benchmark:
+        asyncio.run(run_abr_benchmark(args.size, args.rungs.split(",")))
+        raise SystemExit(0)
+    if args.snapshot_test:
+        asyncio.run(run_snapshot_test(args.size))
+        raise SystemExit(0)
+    if args.dvr_test:
+        asyncio.run(run_dvr_test(args.duration, args.port))
+        raise SystemExit(0)
+    asyncio.run(main())
@@ -0,0 +1,510 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import itertools
+import subprocess
+import socketserver
+
+# Camera stream to hold the one session to
+CAMERA_RTSP_URL = os.getenv("CAMERA_RTSP_URL")
+
+# RTSP transport to the camera (udp or tcp)
+RTSP_TRANSPORT = os.getenv("RTSP_TRANSPORT", "udp")
+
+# Port consumers connect to: /stream.mkv, /snapshot.jpg and /stats
+RESTREAM_PORT = int(os.getenv("RESTREAM_PORT", "8554"))
+
+# Clusters queued for a subscriber before it is considered too slow and disconnected
+SUBSCRIBER_BUFFER = int(os.getenv("SUBSCRIBER_BUFFER", "256"))
+
+# JPEG quality of snapshots (ffmpeg -q:v, 2 is best)
+SNAPSHOT_QUALITY = os.getenv("SNAPSHOT_QUALITY", "2")
+
+# Seconds without data from the camera before the session is treated as stalled and restarted
+STALL_TIMEOUT = int(os.getenv("STALL_TIMEOUT", "20"))
+
+# Delay before reconnecting to the camera, doubled after each quick failure up to RESTART_DELAY_MAX
+RESTART_DELAY = float(os.getenv("RESTART_DELAY", "1"))
+RESTART_DELAY_MAX = float(os.getenv("RESTART_DELAY_MAX", "30"))
+
+# Matroska element IDs used to split the stream into headers and clusters
+EBML_HEADER = 0x1A45DFA3
+SEGMENT = 0x18538067
+CLUSTER = 0x1F43B675
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_NUMBER = 0xD7
+TRACK_TYPE = 0x83
+SIMPLE_BLOCK = 0xA3
+BLOCK_GROUP = 0xA0
+BLOCK = 0xA1
+REFERENCE_BLOCK = 0xFB
+
+def read_vint(data, pos, keep_marker=False):
+    """Reads an EBML variable length integer; returns (value, length), value None if it is all ones (unknown)."""
+    first = data[pos]
+    length = 1
+    mask = 0x80
+    while mask and not first & mask:
+        mask >>= 1
+        length += 1
+    if not mask:
+        raise ValueError(f"Invalid EBML integer at {pos}")
+    if pos + length > len(data):
+        raise IndexError
+    value = first if keep_marker else first & (mask - 1)
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        value = None
+    return value, length
+
+def read_element(data, pos):
+    """Returns (id, data_start, size) of the element at pos, raising IndexError if its header is incomplete."""
+    element_id, id_length = read_vint(data, pos, keep_marker=True)
+    size, size_length = read_vint(data, pos + id_length)
+    return element_id, pos + id_length + size_length, size
+
+def children(data, start, end):
+    while start < end:
+        element_id, data_start, size = read_element(data, start)
+        yield element_id, data_start, data_start + size
+        start = data_start + size
+
+def video_track(tracks):
+    """Track number of the first video track in a Tracks element's body."""
+    for element_id, start, end in children(tracks, 0, len(tracks)):
+        if element_id != TRACK_ENTRY:
+            continue
+        fields = {field: int.from_bytes(tracks[s:e], "big") for field, s, e in children(tracks, start, end)}
+        if fields.get(TRACK_TYPE) == 1:
+            return fields.get(TRACK_NUMBER)
+    return None
+
+def starts_with_keyframe(cluster, track):
+    """Whether the first block of the video track in a cluster's body is a keyframe."""
+    for element_id, start, end in children(cluster, 0, len(cluster)):
+        if element_id == SIMPLE_BLOCK:
+            number, length = read_vint(cluster, start)
+            if number == track:
+                return bool(cluster[start + length + 2] & 0x80)
+        elif element_id == BLOCK_GROUP:
+            block = [(i, s) for i, s, e in children(cluster, start, end) if i == BLOCK]
+            if block and read_vint(cluster, block[0][1])[0] == track:
+                return not any(i == REFERENCE_BLOCK for i, s, e in children(cluster, start, end))
+    return False
+
+class MatroskaSplitter:
+    """Splits a live Matroska byte stream into its header and whole clusters.
+
+    The header is everything before the first cluster (EBML header, segment start, tracks),
+    which every new subscriber needs once. Clusters from ffmpeg's live Matroska output always
+    have a known size, so they can be cut out whole and passed along untouched.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.header = None
+        self.track = None
+        self.pos = 0
+
+    def feed(self, chunk):
+        """Returns the new (kind, bytes, keyframe) pieces: one ("header", ...) then ("cluster", ...) items."""
+        self.buffer += chunk
+        pieces = []
+        try:
+            if self.header is None:
+                element_id, start, size = read_element(self.buffer, 0)
+                if element_id != EBML_HEADER:
+                    raise ValueError("Not a Matroska stream")
+                element_id, start, size = read_element(self.buffer, start + size)
+                if element_id != SEGMENT:
+                    raise ValueError("Matroska segment missing")
+                self.pos = start
+                self.header = False
+            while True:
+                element_id, start, size = read_element(self.buffer, self.pos)
+                if size is None:
+                    raise ValueError("Matroska element of unknown size in a live stream")
+                end = start + size
+                if end > len(self.buffer):
+                    break
+                if element_id == TRACKS:
+                    self.track = video_track(bytes(self.buffer[start:end]))
+                if element_id == CLUSTER and self.header is False:
+                    self.header = bytes(self.buffer[:self.pos])
+                    pieces.append(("header", self.header, False))
+                if self.header:
+                    body = bytes(self.buffer[start:end])
+                    keyframe = element_id == CLUSTER and starts_with_keyframe(body, self.track)
+                    pieces.append(("cluster", bytes(self.buffer[self.pos:end]), keyframe))
+                    del self.buffer[:end]
+                    self.pos = 0
+                else:
+                    self.pos = end
+        except IndexError:
+            pass
+        return pieces
+
+class Subscriber:
+    def __init__(self, name, backlog=0):
+        self.name = name
+        # Room for the header and GOP it starts with, on top of the buffer it may fall behind by
+        self.queue = asyncio.Queue(backlog + SUBSCRIBER_BUFFER)
+        self.connected = time.time()
+        self.sent = 0
+
+class Restreamer:
+    """Holds the latest header and GOP of the camera stream and hands each new cluster to every subscriber.
+
+    A new subscriber is sent the header and the clusters since the last keyframe, so it can
+    start decoding at once. A subscriber that falls SUBSCRIBER_BUFFER clusters behind is
+    disconnected rather than holding up the others. When the camera session restarts,
+    subscribers are disconnected too, since the new stream starts with a new header.
+    """
+
+    def __init__(self):
+        self.header = None
+        self.gop = []
+        self.keyframes = 0
+        self.ready = asyncio.Event()
+        self.subscribers = set()
+        self.snapshot = (None, None)
+        self.snapshot_task = None
+        self.stats = {"sessions": 0, "bytes_in": 0, "clusters": 0, "dropped_subscribers": 0,
+                      "snapshots_served": 0, "snapshots_decoded": 0, "snapshot_ms": 0.0}
+
+    def publish(self, kind, data, keyframe):
+        if kind == "header":
+            self.close_subscribers()
+            self.header = data
+            self.gop = []
+            self.ready.set()
+            return
+        self.stats["clusters"] += 1
+        if keyframe:
+            self.gop = [data]
+            self.keyframes += 1
+        elif self.gop:
+            self.gop.append(data)
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.queue.put_nowait(data)
+            except asyncio.QueueFull:
+                print(f"Subscriber {subscriber.name} is {SUBSCRIBER_BUFFER} clusters behind. Disconnecting it...")
+                self.stats["dropped_subscribers"] += 1
+                self.drop(subscriber)
+
+    def drop(self, subscriber):
+        self.subscribers.discard(subscriber)
+        while not subscriber.queue.empty():
+            subscriber.queue.get_nowait()
+        subscriber.queue.put_nowait(None)
+
+    def close_subscribers(self):
+        for subscriber in list(self.subscribers):
+            self.drop(subscriber)
+        self.header = None
+        self.ready.clear()
+
+    async def subscribe(self, name):
+        await self.ready.wait()
+        backlog = [self.header, *self.gop]
+        subscriber = Subscriber(name, len(backlog))
+        for data in backlog:
+            subscriber.queue.put_nowait(data)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    async def get_snapshot(self):
+        """JPEG of the latest keyframe, decoded once per keyframe however many consumers ask for it."""
+        await self.ready.wait()
+        if not self.gop:
+            raise RuntimeError("No keyframe received yet for a snapshot")
+        keyframe, jpeg = self.snapshot
+        if keyframe == self.keyframes and jpeg:
+            return jpeg
+        if not self.snapshot_task or self.snapshot_task.done():
+            self.snapshot_task = asyncio.create_task(self.decode_snapshot(self.keyframes, self.header + self.gop[0]))
+        return await self.snapshot_task
+
+    async def decode_snapshot(self, keyframe, data):
+        start = time.monotonic()
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-v", "error", "-f", "matroska", "-i", "pipe:0", "-frames:v", "1",
+            "-c:v", "mjpeg", "-q:v", SNAPSHOT_QUALITY, "-f", "image2pipe", "pipe:1",
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        jpeg, _ = await process.communicate(data)
+        if process.returncode != 0 or not jpeg:
+            raise RuntimeError(f"Snapshot decode failed with code {process.returncode}")
+        self.snapshot = (keyframe, jpeg)
+        self.stats["snapshots_decoded"] += 1
+        self.stats["snapshot_ms"] = (time.monotonic() - start) * 1000
+        return jpeg
+
+    def summary(self):
+        now = time.time()
+        return {
+            **self.stats,
+            "streaming": self.header is not None,
+            "gop_clusters": len(self.gop),
+            "subscribers": [{"name": s.name, "seconds": now - s.connected, "sent": s.sent,
+                             "queued": s.queue.qsize()} for s in self.subscribers],
+        }
+
+def source_command(source_url):
+    command = ["ffmpeg", "-v", "error", "-err_detect", "ignore_err",
+               "-probesize", "5000000", "-analyzeduration", "5000000", "-timeout", "5000000"]
+    if source_url.startswith("rtsp://"):
+        command += ["-rtsp_transport", RTSP_TRANSPORT]
+    # Only video is passed on; the consumers add their own silent audio track
+    return command + ["-i", source_url, "-map", "0:v:0", "-c", "copy", "-f", "matroska", "-live", "1", "pipe:1"]
+
+async def run_source(restreamer, source_url):
+    """Holds the one session to the camera, reconnecting with backoff when it ends or stalls."""
+    delay = RESTART_DELAY
+    while True:
+        print(f"Connecting to {source_url.split('@')[-1]}...")
+        process = await asyncio.create_subprocess_exec(*source_command(source_url), stdin=subprocess.DEVNULL,
+                                                       stdout=subprocess.PIPE)
+        restreamer.stats["sessions"] += 1
+        started = time.monotonic()
+        splitter = MatroskaSplitter()
+        try:
+            while True:
+                chunk = await asyncio.wait_for(process.stdout.read(65536), STALL_TIMEOUT)
+                if not chunk:
+                    break
+                restreamer.stats["bytes_in"] += len(chunk)
+                for piece in splitter.feed(chunk):
+                    restreamer.publish(*piece)
+        except asyncio.TimeoutError:
+            print(f"Camera stream has stalled (no data for {STALL_TIMEOUT}s). Reconnecting...")
+        except ValueError as e:
+            print(f"Camera stream could not be split: {e}")
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            restreamer.close_subscribers()
+            raise
+        if process.returncode is None:
+            process.kill()
+        await process.wait()
+        restreamer.close_subscribers()
+        runtime = time.monotonic() - started
+        if runtime >= 60:
+            delay = RESTART_DELAY
+        print(f"Camera session ended with code {process.returncode} after {runtime:.1f}s. "
+              f"Reconnecting in {delay:.1f} seconds...")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, RESTART_DELAY_MAX)
+
+async def serve(restreamer, port):
+    """Serves /stream.mkv to any number of subscribers, /snapshot.jpg and /stats over HTTP."""
+    names = itertools.count(1)
+
+    async def handle(reader, writer):
+        peer = writer.get_extra_info("peername")
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass
+            parts = request.decode("latin-1").split()
+            path = parts[1].split("?")[0] if len(parts) > 1 else "/"
+            if path == "/stream.mkv":
+                subscriber = await restreamer.subscribe(f"{peer[0]}:{peer[1]}#{next(names)}")
+                print(f"Subscriber {subscriber.name} connected ({len(restreamer.subscribers)} now)")
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: video/x-matroska\r\nConnection: close\r\n\r\n")
+                try:
+                    while (data := await subscriber.queue.get()) is not None:
+                        writer.write(data)
+                        subscriber.sent += len(data)
+                        await writer.drain()
+                finally:
+                    restreamer.subscribers.discard(subscriber)
+                    print(f"Subscriber {subscriber.name} disconnected after {subscriber.sent} bytes")
+                return
+            if path == "/snapshot.jpg":
+                body, content_type = await restreamer.get_snapshot(), "image/jpeg"
+                restreamer.stats["snapshots_served"] += 1
+            elif path == "/stats":
+                body, content_type = json.dumps(restreamer.summary(), indent=2).encode(), "application/json"
+            else:
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                return
+            writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (RuntimeError, asyncio.QueueFull) as e:
+            print(f"Warning: {e or 'Subscriber backlog does not fit its queue'}")
+            writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, port=port)
+    print(f"Restreaming on port {port}")
+    return server
+
+def serve_test_camera(port, rtp_port, sample):
+    """Serves a looping sample file over RTSP (interleaved TCP only), counting the sessions it is asked for.
+
+    ffmpeg packetises the sample to RTP on a local UDP port; the packets are forwarded to every
+    playing client. Stands in for the camera, which is what the restreamer is meant to spare.
+    """
+    sdp_file = f"{sample}.sdp"
+    sender = subprocess.Popen(["ffmpeg", "-v", "error", "-re", "-stream_loop", "-1", "-i", sample,
+                               "-map", "0:v", "-c", "copy", "-f", "rtp", "-sdp_file", sdp_file,
+                               f"rtp://127.0.0.1:{rtp_port}"])
+    rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rtp.bind(("127.0.0.1", rtp_port))
+    # RTCP reports from the sender are not used, but need somewhere to go
+    rtcp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rtcp.bind(("127.0.0.1", rtp_port + 1))
+    while not os.path.exists(sdp_file) or not os.path.getsize(sdp_file):
+        time.sleep(0.1)
+    time.sleep(0.2)
+    with open(sdp_file) as f:
+        sdp = f.read().replace("c=IN IP4 127.0.0.1", "c=IN IP4 0.0.0.0") + "a=control:trackID=0\r\n"
+    players = []
+    lock = threading.Lock()
+    sessions = []
+
+    def forward():
+        while True:
+            packet = rtp.recv(65536)
+            frame = b"$\x00" + len(packet).to_bytes(2, "big") + packet
+            with lock:
+                for player in list(players):
+                    try:
+                        player.sendall(frame)
+                    except OSError:
+                        players.remove(player)
+
+    class RtspHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            while True:
+                request = self.rfile.readline().decode("latin-1")
+                if not request:
+                    break
+                headers = {}
+                while (line := self.rfile.readline().decode("latin-1").strip()):
+                    key, _, value = line.partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                method, url = request.split()[:2]
+                reply = [f"CSeq: {headers.get('cseq', '0')}"]
+                body = ""
+                status = "200 OK"
+                if method == "OPTIONS":
+                    reply.append("Public: OPTIONS, DESCRIBE, SETUP, PLAY, TEARDOWN, GET_PARAMETER")
+                elif method == "DESCRIBE":
+                    body = sdp
+                    reply += ["Content-Type: application/sdp", f"Content-Base: {url}/"]
+                elif method == "SETUP":
+                    if "TCP" not in headers.get("transport", ""):
+                        status = "461 Unsupported Transport"
+                    reply += ["Transport: RTP/AVP/TCP;unicast;interleaved=0-1", "Session: 1"]
+                elif method == "PLAY":
+                    reply.append("Session: 1")
+                    sessions.append(time.time())
+                else:
+                    reply.append("Session: 1")
+                with lock:
+                    self.wfile.write((f"RTSP/1.0 {status}\r\n" + "".join(f"{h}\r\n" for h in reply)
+                                      + f"Content-Length: {len(body)}\r\n\r\n" + body).encode())
+                    if method == "PLAY":
+                        players.append(self.connection)
+                if method == "TEARDOWN":
+                    break
+
+    threading.Thread(target=forward, daemon=True).start()
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", port), RtspHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, sender, sessions
+
+async def run_test(duration, consumers, port):
+    """Restreams a local RTSP source to several stream consumers and snapshot pollers, then reports camera load."""
+    with tempfile.TemporaryDirectory() as tmp:
+        sample = os.path.join(tmp, "sample.mp4")
+        print("Generating sample video...")
+        subprocess.run(["ffmpeg", "-v", "error", "-f", "lavfi", "-i", "testsrc2=size=1280x720:rate=25", "-t", "20",
+                        "-c:v", "libx264", "-preset", "ultrafast", "-g", "50", sample], check=True)
+        camera, sender, sessions = serve_test_camera(port + 1, port + 2, sample)
+        global RTSP_TRANSPORT
+        RTSP_TRANSPORT = "tcp"
+        restreamer = Restreamer()
+        server = await serve(restreamer, port)
+        source = asyncio.create_task(run_source(restreamer, f"rtsp://127.0.0.1:{port + 1}/sample"))
+
+        readers = [await asyncio.create_subprocess_exec(
+            "ffmpeg", "-v", "error", "-nostats", "-progress", "pipe:1", "-i", f"http://127.0.0.1:{port}/stream.mkv",
+            "-c", "copy", "-f", "null", "-", stdout=subprocess.PIPE) for _ in range(consumers)]
+
+        async def fetch_snapshot():
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET /snapshot.jpg HTTP/1.1\r\n\r\n")
+            response = await reader.read()
+            writer.close()
+            return response.partition(b"\r\n\r\n")[2]
+
+        snapshots = []
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            await asyncio.sleep(2)
+            start = time.monotonic()
+            # Two pollers asking at once, like the capturer and the HLS server's fetcher
+            for jpeg in await asyncio.gather(fetch_snapshot(), fetch_snapshot()):
+                snapshots.append((time.monotonic() - start, len(jpeg), jpeg[:2] == b"\xff\xd8"))
+
+        received = []
+        for reader in readers:
+            reader.terminate()
+            output = (await reader.communicate())[0].decode()
+            received.append(max([int(line.split("=")[1]) / 1e6 for line in output.splitlines()
+                                 if line.startswith("out_time_us=") and line[12:].isdigit()] or [0]))
+        source.cancel()
+        await asyncio.gather(source, return_exceptions=True)
+        # Let the subscriber handlers see the disconnect
+        await asyncio.sleep(0.1)
+        server.close()
+        camera.shutdown()
+        sender.terminate()
+        sender.wait()
+
+    summary = restreamer.summary()
+    print(f"{consumers} stream consumers received " + ", ".join(f"{seconds:.1f}s" for seconds in received)
+          + f" of video in {duration}s")
+    print(f"{len(snapshots)} snapshots, {sum(ok for _, _, ok in snapshots)} valid JPEGs, "
+          f"{max(t for t, _, _ in snapshots) * 1000:.0f}ms slowest, {summary['snapshots_decoded']} decodes")
+    print(f"Camera RTSP sessions opened: {len(sessions)} "
+          f"(without the restreamer: {consumers} streams plus a snapshot request per poll)")
+
+async def main():
+    print("Starting Dunedin-Live restreamer...")
+    if not CAMERA_RTSP_URL:
+        print("Error: CAMERA_RTSP_URL environment variable is not set.")
+        raise SystemExit(1)
+    restreamer = Restreamer()
+    await serve(restreamer, RESTREAM_PORT)
+    await run_source(restreamer, CAMERA_RTSP_URL)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dunedin-Live RTSP restreamer")
+    parser.add_argument("--test", action="store_true",
+                        help="restream a local RTSP source built from a sample file to several consumers, then exit")
+    parser.add_argument("--duration", type=int, default=20, help="test duration (seconds)")
+    parser.add_argument("--consumers", type=int, default=2, help="stream consumers in the test")
+    parser.add_argument("--port", type=int, default=18554, help="first of three ports used by the test")
+    args = parser.parse_args()
+
+    if args.test:
+        asyncio.run(run_test(args.duration, args.consumers, args.port))
+        raise SystemExit(0)
+    asyncio.run(main())
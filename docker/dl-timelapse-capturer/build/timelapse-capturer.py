@@ -1,9 +1,22 @@
+import io
 import os
+import sys
+import json
+import zlib
+import struct
+import heapq
+import queue
+import asyncio
+import argparse
+import threading
 import requests
+import numpy as np
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from datetime import datetime
 import pytz
-import threading
 import time
 
 # URL to Camera Snapshot API
@@ -22,41 +35,630 @@ CAMERA_API_PASSWORD = os.environ.get("CAMERA_PASSWORD")
 # Save Path
 IMG_SAVE_PATH = os.environ.get("IMG_SAVE_PATH", "/data")
 
-def download_image(url, username, password, savepath, tz):
+# Optional JSON file describing several cameras (overrides the single camera settings above)
+CAMERAS_CONFIG = os.environ.get("CAMERAS_CONFIG")
+
+# Maximum number of snapshot requests allowed in flight at once (per camera)
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", "2"))
+
+# Timeout for a single snapshot request (in seconds)
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", "10"))
+
+# Time between capture statistics reports (in seconds)
+STATS_INTERVAL = int(os.environ.get("STATS_INTERVAL", "3600"))
+
+# Maximum number of captured frames buffered for the disk writer
+WRITE_QUEUE_SIZE = int(os.environ.get("WRITE_QUEUE_SIZE", "64"))
+
+# Maximum number of frames written before a batch is fsynced and published
+FSYNC_BATCH = int(os.environ.get("FSYNC_BATCH", "16"))
+
+# How frames are stored: "files" (one JPEG per frame) or "pack" (appended to a container file)
+STORAGE_MODE = os.environ.get("STORAGE_MODE", "files").lower()
+
+# Container rotation in pack mode: "day" or "hour"
+PACK_ROTATE = os.environ.get("PACK_ROTATE", "day").lower()
+
+# Drop frames that are nearly identical to the last kept frame (string to bool)
+DEDUP_FRAMES = os.environ.get("DEDUP_FRAMES", "false").lower() in ("true", "1", "yes")
+
+# Mean absolute luma difference (0-255) below which a frame counts as a repeat
+DEDUP_THRESHOLD = float(os.environ.get("DEDUP_THRESHOLD", "1.5"))
+
+# Longest run (in seconds) of repeats before a frame is kept regardless
+DEDUP_MAX_REPEAT = int(os.environ.get("DEDUP_MAX_REPEAT", "300"))
+
+# Size of the luma grid used to compare frames
+SIGNATURE_SIZE = (64, 36)
+
+# Pack container format: the .pack file holds concatenated JPEGs, the .idx file a magic header
+# followed by fixed-size records of (capture timestamp, offset, length, crc32)
+PACK_MAGIC = b"DLPACK01"
+INDEX_RECORD = struct.Struct("<dQII")
+
+# Wall clock drift (in seconds) tolerated before the schedule is re-anchored
+MAX_CLOCK_DRIFT = 1.0
+
+class CaptureStats:
+    """Per-report counters for the capture loop."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.ticks = 0
+        self.captured = 0
+        self.failed = 0
+        self.missed = 0
+        self.latencies = []
+
+    def record(self, ok, latency):
+        if ok:
+            self.captured += 1
+        else:
+            self.failed += 1
+        self.latencies.append(latency)
+
+    def report(self):
+        return (f"ticks: {self.ticks}, captured: {self.captured}, failed: {self.failed}, "
+                f"missed: {self.missed}, {format_latencies(self.latencies, 'fetches')}")
+
+class WriterStats:
+    """Per-report counters for the disk writer."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.written = 0
+        self.repeats = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.latencies = []
+
+    def report(self, depth):
+        return (f"written: {self.written}, repeats: {self.repeats}, failed: {self.failed}, queue depth: {depth} (max {self.max_depth}), "
+                f"{format_latencies(self.latencies, 'writes')}")
+
+def format_latencies(latencies, what):
+    if not latencies:
+        return f"no completed {what}"
+    latencies = sorted(latencies)
+    p50 = latencies[len(latencies) // 2]
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    return f"latency p50 {p50:.3f}s p95 {p95:.3f}s max {latencies[-1]:.3f}s"
+
+def frame_signature(content):
+    """Cheap luma fingerprint: decode at 1/8 scale via JPEG DCT scaling, then block-average to SIGNATURE_SIZE."""
+    with Image.open(io.BytesIO(content)) as img:
+        img.draft("L", (img.width // 8, img.height // 8))
+        small = img.convert("L").resize(SIGNATURE_SIZE, Image.Resampling.BOX)
+    return np.asarray(small, dtype=np.float32)
+
+class FrameFilter:
+    """Tracks the last kept frame of a camera and recognises near-duplicates of it.
+
+    Only the frame writer calls check, in the capture order each camera submits its frames in.
+    """
+
+    def __init__(self, threshold=DEDUP_THRESHOLD, max_repeat=DEDUP_MAX_REPEAT):
+        self.threshold = threshold
+        self.max_repeat = max_repeat
+        self.signature = None
+        self.kept_at = None
+
+    def check(self, signature, captured_at):
+        """Returns the capture time of the kept frame this one repeats, or None if it should be kept."""
+        # A frame that could not be fingerprinted is kept
+        if signature is None:
+            return None
+        # Each day starts with a kept frame, and long static runs are still sampled
+        if (self.signature is not None
+                and self.kept_at.date() == captured_at.date()
+                and 0 < (captured_at - self.kept_at).total_seconds() < self.max_repeat
+                and float(np.mean(np.abs(signature - self.signature))) < self.threshold):
+            return self.kept_at
+        self.signature = signature
+        self.kept_at = captured_at
+        return None
+
+class Camera:
+    """A snapshot source with its own schedule, credentials and output root."""
+
+    def __init__(self, name, url, username, password, interval, save_path, max_in_flight, dedup=False):
+        self.name = name
+        self.url = url
+        self.auth = HTTPBasicAuth(username, password) if username else None
+        self.interval = interval
+        self.save_path = save_path
+        self.max_in_flight = max_in_flight
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.stats = CaptureStats()
+        self.filter = FrameFilter() if dedup else None
+        # Resolved once the latest tick has handed its frame to the writer (dedup cameras only)
+        self.last_submit = None
+        self.wall_anchor = 0.0
+        self.mono_anchor = 0.0
+        self.tick = 0
+
+def load_cameras(config_path):
+    """Builds the camera list from CAMERAS_CONFIG, or from the single camera environment variables."""
+    if not config_path:
+        return [Camera("camera", CAMERA_API_URL, CAMERA_API_USER, CAMERA_API_PASSWORD,
+                       TIME_INTERVAL, IMG_SAVE_PATH, MAX_IN_FLIGHT, DEDUP_FRAMES)]
+
+    with open(config_path) as f:
+        config = json.load(f)
+
+    cameras = []
+    for index, entry in enumerate(config.get("cameras", [])):
+        name = entry.get("name", f"camera{index + 1}")
+        cameras.append(Camera(
+            name,
+            entry["url"],
+            entry.get("username", CAMERA_API_USER),
+            entry.get("password", CAMERA_API_PASSWORD),
+            int(entry.get("interval", TIME_INTERVAL)),
+            entry.get("save_path", os.path.join(IMG_SAVE_PATH, name)),
+            int(entry.get("max_in_flight", MAX_IN_FLIGHT)),
+            bool(entry.get("dedup", DEDUP_FRAMES))
+        ))
+
+    if not cameras:
+        raise ValueError(f"No cameras defined in {config_path}")
+    names = [camera.name for camera in cameras]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Cameras in {config_path} must have unique names")
+    save_paths = [camera.save_path for camera in cameras]
+    if len(set(save_paths)) != len(save_paths):
+        raise ValueError(f"Cameras in {config_path} must not share a save_path")
+    return cameras
+
+def create_session(pool_size):
+    # Keep-alive connections shared by every camera and reused across ticks
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+class PackFile:
+    """Append-only frame container with its offset index.
+
+    Frame bytes are appended to <base>.pack and their index records are held back until
+    commit(), which fsyncs the container before appending and fsyncing the index. Readers only
+    trust indexed frames, so a crash can leave unindexed bytes in the container but never an
+    index entry pointing at data that is not on disk.
+    """
+
+    def __init__(self, basepath):
+        self.basepath = basepath
+        self.pack_fd = os.open(basepath + ".pack", os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.index_fd = os.open(basepath + ".idx", os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self.index_fd).st_size
+        if size < len(PACK_MAGIC):
+            os.ftruncate(self.index_fd, 0)
+            os.write(self.index_fd, PACK_MAGIC)
+        else:
+            # Drop a partially written trailing record left behind by a crash
+            records = (size - len(PACK_MAGIC)) // INDEX_RECORD.size
+            os.ftruncate(self.index_fd, len(PACK_MAGIC) + records * INDEX_RECORD.size)
+        os.lseek(self.index_fd, 0, os.SEEK_END)
+        self.offset = os.fstat(self.pack_fd).st_size
+        self.pending = []
+
+    def append(self, timestamp, content):
+        view = memoryview(content)
+        ref = (self.offset, len(view), zlib.crc32(view))
+        while view:
+            view = view[os.write(self.pack_fd, view):]
+        self.offset += ref[1]
+        self.pending.append(INDEX_RECORD.pack(timestamp, *ref))
+        return ref
+
+    def append_repeat(self, timestamp, ref):
+        # A repeat is just another index record pointing at the kept frame's bytes
+        self.pending.append(INDEX_RECORD.pack(timestamp, *ref))
+
+    def commit(self):
+        if not self.pending:
+            return
+        os.fsync(self.pack_fd)
+        os.write(self.index_fd, b"".join(self.pending))
+        os.fsync(self.index_fd)
+        self.pending = []
+
+    def close(self):
+        self.commit()
+        os.close(self.pack_fd)
+        os.close(self.index_fd)
+
+class FrameWriter:
+    """Write-behind storage stage: frames are queued by the fetchers and published by one writer thread.
+
+    Each frame is written to a hidden temporary name and renamed into place once it has been
+    fsynced, so readers never see a partial HH:MM:SS.jpg. Under backlog, fsyncs and directory
+    syncs are batched across up to FSYNC_BATCH frames. Duplicates are recognised here as frames
+    are dequeued, and suppressed duplicates are appended to repeats.txt in the day directory as "<repeat>.jpg <kept>.jpg" so timing can be rebuilt.
+
+    In pack mode frames are appended to a per-day (or per-hour) PackFile instead, and a batch
+    is published by committing the index of every container it touched.
+    """
+
+    def __init__(self, queue_size=WRITE_QUEUE_SIZE, batch_size=FSYNC_BATCH, storage_mode=STORAGE_MODE):
+        if storage_mode not in ("files", "pack"):
+            raise ValueError(f"Unknown STORAGE_MODE '{storage_mode}', expected 'files' or 'pack'")
+        if PACK_ROTATE not in ("day", "hour"):
+            raise ValueError(f"Unknown PACK_ROTATE '{PACK_ROTATE}', expected 'day' or 'hour'")
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.storage_mode = storage_mode
+        self.stats = WriterStats()
+        self.known_dirs = set()
+        self.packs = {}
+        self.last_kept = {}
+        self.thread = threading.Thread(target=self.run, name="frame-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, camera, captured_at, content, signature=None):
+        """Queues a frame and its dedup signature for writing, blocking the fetch worker if the writer has fallen behind."""
+        if self.queue.full():
+            print(f"[{camera.name}] Disk writer is {self.queue.maxsize} frames behind, waiting for it to catch up")
+        self.queue.put((camera, captured_at, content, signature, time.monotonic()))
+        self.stats.max_depth = max(self.stats.max_depth, self.queue.qsize())
+
+    def close(self):
+        """Flushes every queued frame and stops the writer thread."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def frame_dir(self, savepath, captured_at):
+        # The per-day directory only needs creating once
+        outputpath = os.path.join(savepath, captured_at.strftime("%d-%m-%Y"))
+        if outputpath not in self.known_dirs:
+            os.makedirs(outputpath, exist_ok=True)
+            if len(self.known_dirs) > 64:
+                self.known_dirs.clear()
+            self.known_dirs.add(outputpath)
+        return outputpath
+
+    def write(self, camera, captured_at, content):
+        outputpath = self.frame_dir(camera.save_path, captured_at)
+        filename = f"{captured_at.strftime('%H:%M:%S')}.jpg"
+        tmppath = os.path.join(outputpath, f".{filename}.tmp")
+        try:
+            fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        except FileNotFoundError:
+            # The cached directory was removed underneath us, so create it again
+            self.known_dirs.discard(outputpath)
+            self.frame_dir(camera.save_path, captured_at)
+            fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            view = memoryview(content)
+            while view:
+                view = view[os.write(fd, view):]
+        except Exception:
+            os.close(fd)
+            os.unlink(tmppath)
+            raise
+        return fd, tmppath, os.path.join(outputpath, filename)
+
+    def pack_for(self, camera, captured_at):
+        name = "frames" if PACK_ROTATE == "day" else captured_at.strftime("%H")
+        basepath = os.path.join(self.frame_dir(camera.save_path, captured_at), name)
+        pack = self.packs.get(camera.name)
+        if pack is None or pack.basepath != basepath:
+            if pack is not None:
+                pack.close()
+                del self.packs[camera.name]
+            pack = PackFile(basepath)
+            self.packs[camera.name] = pack
+        return pack
+
+    def write_packed(self, camera, captured_at, content, repeat_of):
+        pack = self.pack_for(camera, captured_at)
+        timestamp = captured_at.timestamp()
+        kept = self.last_kept.get(camera.name)
+        # Repeats can only point at a kept frame in the same container
+        if repeat_of is not None and kept is not None and kept[0] == repeat_of and kept[1] is pack:
+            pack.append_repeat(timestamp, kept[2])
+            self.stats.repeats += 1
+            return pack, True
+        self.last_kept[camera.name] = (captured_at, pack, pack.append(timestamp, content))
+        return pack, False
+
+    def publish_packs(self, batch):
+        committed = set()
+        for pack, repeat, enqueued in batch:
+            try:
+                if pack not in committed:
+                    pack.commit()
+                    committed.add(pack)
+                if not repeat:
+                    self.stats.written += 1
+                    self.stats.latencies.append(time.monotonic() - enqueued)
+            except OSError as e:
+                print(f"Failed to commit {pack.basepath}.pack: {e}")
+                self.stats.failed += 1
+
+    def write_repeat(self, camera, captured_at, repeat_of):
+        outputpath = self.frame_dir(camera.save_path, captured_at)
+        with open(os.path.join(outputpath, "repeats.txt"), "a") as f:
+            f.write(f"{captured_at.strftime('%H:%M:%S')}.jpg {repeat_of.strftime('%H:%M:%S')}.jpg\n")
+        self.stats.repeats += 1
+
+    def publish(self, batch):
+        """Fsyncs a batch of written frames, renames them into place and syncs their directories once."""
+        dirs = set()
+        for fd, tmppath, filepath, enqueued in batch:
+            try:
+                os.fsync(fd)
+                os.close(fd)
+                os.replace(tmppath, filepath)
+                dirs.add(os.path.dirname(filepath))
+                self.stats.written += 1
+                self.stats.latencies.append(time.monotonic() - enqueued)
+            except OSError as e:
+                print(f"Failed to publish {filepath}: {e}")
+                self.stats.failed += 1
+        for dirpath in dirs:
+            try:
+                dirfd = os.open(dirpath, os.O_RDONLY)
+                try:
+                    os.fsync(dirfd)
+                finally:
+                    os.close(dirfd)
+            except OSError as e:
+                print(f"Failed to sync directory {dirpath}: {e}")
+
+    def run(self):
+        batch = []
+        while True:
+            item = self.queue.get()
+            if item is not None:
+                camera, captured_at, content, signature, enqueued = item
+                repeat_of = camera.filter.check(signature, captured_at) if camera.filter else None
+                try:
+                    if self.storage_mode == "pack":
+                        batch.append(self.write_packed(camera, captured_at, content, repeat_of) + (enqueued,))
+                    elif repeat_of is not None:
+                        self.write_repeat(camera, captured_at, repeat_of)
+                    else:
+                        batch.append(self.write(camera, captured_at, content) + (enqueued,))
+                except OSError as e:
+                    print(f"[{camera.name}] Failed to write image for {captured_at.strftime('%H:%M:%S')}: {e}")
+                    self.stats.failed += 1
+            # Publish as soon as the queue drains, or once the batch is full
+            if batch and (item is None or self.queue.empty() or len(batch) >= self.batch_size):
+                if self.storage_mode == "pack":
+                    self.publish_packs(batch)
+                else:
+                    self.publish(batch)
+                batch = []
+            if item is None:
+                for pack in self.packs.values():
+                    pack.close()
+                self.packs.clear()
+                return
+
+def download_image(session, camera, captured_at):
+    """Fetches a snapshot and, for a dedup camera, its signature. Returns (content, signature) or None."""
     try:
-        response = requests.get(url, auth=HTTPBasicAuth(username, password), timeout=10)
+        response = session.get(camera.url, auth=camera.auth, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()  # Raise an exception for bad status codes
-        current_time = datetime.now(pytz.timezone(tz))
-        ts = current_time.strftime("%H:%M:%S")
-        ds = current_time.strftime("%d-%m-%Y")
-        outputpath = os.path.join(savepath, ds)
-        os.makedirs(outputpath, exist_ok=True)  # Create the directory if it doesn't exist
-        filepath = os.path.join(outputpath, f"{ts}.jpg")
-        with open(filepath, 'wb') as f:
-            f.write(response.content)
-        #print("Image downloaded successfully.")
+        content = response.content
+        signature = None
+        if camera.filter:
+            try:
+                signature = frame_signature(content)
+            except Exception as e:
+                print(f"[{camera.name}] Could not fingerprint frame {captured_at.strftime('%H:%M:%S')}, keeping it: {e}")
+        return content, signature
     except requests.exceptions.RequestException as e:
-        print(f"Failed to download image: {e}")
+        print(f"[{camera.name}] Failed to download image for {captured_at.strftime('%H:%M:%S')}: {e}")
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+        print(f"[{camera.name}] An unexpected error occurred: {e}")
+    return None
+
+async def capture_tick(session, writer, camera, captured_at, deadline):
+    loop = asyncio.get_running_loop()
+    # Fetches finish out of order, but duplicates must be judged in capture order, so a dedup
+    # camera hands each frame to the writer only after the previous tick has
+    previous, submitted = camera.last_submit, None
+    if camera.filter:
+        submitted = camera.last_submit = loop.create_future()
+    try:
+        frame = await loop.run_in_executor(None, download_image, session, camera, captured_at)
+        if previous:
+            await previous
+        if frame:
+            await loop.run_in_executor(None, writer.submit, camera, captured_at, *frame)
+        camera.stats.record(frame is not None, loop.time() - deadline)
+    finally:
+        if submitted:
+            submitted.set_result(None)
+        camera.slots.release()
+
+def anchor_schedule(loop, cameras):
+    """Anchors every camera's tick 0 to its next wall clock multiple so frame names stay aligned."""
+    now_wall = time.time()
+    now_mono = loop.time()
+    schedule = []
+    for index, camera in enumerate(cameras):
+        camera.wall_anchor = (now_wall // camera.interval + 1) * camera.interval
+        camera.mono_anchor = now_mono + (camera.wall_anchor - now_wall)
+        camera.tick = 0
+        schedule.append((camera.mono_anchor, index))
+    heapq.heapify(schedule)
+    return schedule
+
+async def run_capture_loop(cameras, writer):
+    """Fires every camera's captures on the monotonic clock from a single schedule, independent of fetch duration."""
+    loop = asyncio.get_running_loop()
+    pool_size = sum(camera.max_in_flight for camera in cameras)
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=pool_size))
+    tz = pytz.timezone(TIMEZONE)
+    session = create_session(pool_size)
+    pending = set()
+
+    schedule = anchor_schedule(loop, cameras)
+    next_report = loop.time() + STATS_INTERVAL
 
-def run_download_loop(ti):
     while True:
-        current_time = datetime.now(pytz.timezone(TIMEZONE))
-        seconds_until_next_run = ti - (current_time.second % ti)
-        if seconds_until_next_run == 0:
-            seconds_until_next_run = ti
-        time.sleep(seconds_until_next_run)
-        download_image(CAMERA_API_URL, CAMERA_API_USER, CAMERA_API_PASSWORD, IMG_SAVE_PATH, TIMEZONE)
+        deadline, index = schedule[0]
+        await asyncio.sleep(max(0.0, deadline - loop.time()))
+        heapq.heappop(schedule)
+        camera = cameras[index]
+
+        # Re-anchor if the wall clock was stepped (e.g. NTP) so filenames match real time
+        drift = time.time() - (camera.wall_anchor + camera.tick * camera.interval + (loop.time() - deadline))
+        if abs(drift) > MAX_CLOCK_DRIFT:
+            print(f"Wall clock moved by {drift:.1f}s, re-anchoring capture schedule")
+            schedule = anchor_schedule(loop, cameras)
+            continue
+
+        # Ticks that were slept through entirely (e.g. host suspend) cannot be honoured
+        lateness = loop.time() - deadline
+        if lateness >= camera.interval:
+            skipped = int(lateness // camera.interval)
+            camera.stats.ticks += skipped
+            camera.stats.missed += skipped
+            camera.tick += skipped
+        else:
+            camera.stats.ticks += 1
+            captured_at = datetime.fromtimestamp(camera.wall_anchor + camera.tick * camera.interval, tz)
+            if camera.slots.locked():
+                print(f"[{camera.name}] Missed tick {captured_at.strftime('%H:%M:%S')}: "
+                      f"{camera.max_in_flight} fetches still in flight")
+                camera.stats.missed += 1
+            else:
+                await camera.slots.acquire()
+                task = asyncio.create_task(capture_tick(session, writer, camera, captured_at, deadline))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            camera.tick += 1
+
+        heapq.heappush(schedule, (camera.mono_anchor + camera.tick * camera.interval, index))
+
+        if loop.time() >= next_report:
+            for camera in cameras:
+                print(f"[{camera.name}] Capture stats: {camera.stats.report()}")
+                camera.stats.reset()
+            print(f"Writer stats: {writer.stats.report(writer.queue.qsize())}")
+            writer.stats.reset()
+            next_report += STATS_INTERVAL
+
+def serve_fake_snapshots(port, frame_bytes):
+    """Serves a fixed JPEG-sized payload on every path, standing in for a set of cameras."""
+    import http.server
+
+    payload = b"\xff\xd8" + os.urandom(frame_bytes - 4) + b"\xff\xd9"
+
+    class SnapshotHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    http.server.ThreadingHTTPServer(("127.0.0.1", port), SnapshotHandler).serve_forever()
+
+def run_dedup_benchmark(args):
+    """Times frame_signature on a synthetic 4K JPEG and compares it with the capture interval."""
+    rng = np.random.default_rng(0)
+    gradient = np.linspace(0, 255, 3840, dtype=np.float32)[None, :, None]
+    pixels = np.clip(gradient + rng.normal(0, 20, (2160, 3840, 3)), 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", quality=90)
+    content = buffer.getvalue()
+
+    frame_filter = FrameFilter()
+    base = datetime.now(pytz.timezone(TIMEZONE)).replace(hour=12, minute=0, second=0, microsecond=0)
+    timings = []
+    for n in range(args.frames):
+        start = time.perf_counter()
+        frame_filter.check(frame_signature(content), base.replace(second=n % 60))
+        timings.append(time.perf_counter() - start)
+
+    mean = sum(timings) / len(timings)
+    print(f"Dedup benchmark: {args.frames} frames of 3840x2160 ({len(content) / 1024:.0f} KiB JPEG)")
+    print(f"Per frame: {format_latencies(timings, 'frames')}, mean {mean * 1000:.1f} ms "
+          f"({mean / TIME_INTERVAL * 100:.2f}% of the {TIME_INTERVAL}s capture interval)")
+
+def run_benchmark(args):
+    """Drives N cameras against a local fake snapshot server and reports throughput and overhead."""
+    import resource
+    import tempfile
+    import multiprocessing
+
+    server = multiprocessing.Process(target=serve_fake_snapshots, args=(args.port, args.frame_kb * 1024), daemon=True)
+    server.start()
+    time.sleep(0.5)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cameras = [
+            Camera(f"bench{n}", f"http://127.0.0.1:{args.port}/cam{n}/GetSnapshot", None, None,
+                   args.interval, os.path.join(tmpdir, f"bench{n}"), MAX_IN_FLIGHT)
+            for n in range(args.cameras)
+        ]
+        writer = FrameWriter()
+        cpu_start = time.process_time()
+        wall_start = time.monotonic()
+        try:
+            asyncio.run(asyncio.wait_for(run_capture_loop(cameras, writer), args.duration))
+        except (asyncio.TimeoutError, TimeoutError):
+            pass
+        writer.close()
+        wall = time.monotonic() - wall_start
+        cpu = time.process_time() - cpu_start
+
+    server.terminate()
+
+    totals = CaptureStats()
+    for camera in cameras:
+        totals.ticks += camera.stats.ticks
+        totals.captured += camera.stats.captured
+        totals.failed += camera.stats.failed
+        totals.missed += camera.stats.missed
+        totals.latencies.extend(camera.stats.latencies)
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    print(f"Benchmark: {args.cameras} cameras every {args.interval}s, {args.frame_kb} KiB frames, {wall:.1f}s wall")
+    print(f"Totals: {totals.report()}")
+    print(f"Writer: {writer.stats.report(writer.queue.qsize())}")
+    print(f"Throughput: {totals.captured / wall:.1f} frames/s, "
+          f"CPU: {cpu:.2f}s ({cpu / max(totals.captured, 1) * 1000:.2f} ms/frame), max RSS: {max_rss_mb:.1f} MiB")
 
 if __name__ == "__main__":
-    # Start the download loop in a daemon thread
-    download_thread = threading.Thread(target=run_download_loop, args=(TIME_INTERVAL,), daemon=True)
-    download_thread.start()
+    parser = argparse.ArgumentParser(description="Dunedin-Live timelapse capturer")
+    parser.add_argument("--benchmark", action="store_true", help="benchmark against a local fake snapshot server")
+    parser.add_argument("--benchmark-dedup", action="store_true", help="benchmark duplicate detection on 4K frames")
+    parser.add_argument("--frames", type=int, default=50, help="number of frames for --benchmark-dedup")
+    parser.add_argument("--cameras", type=int, default=16, help="number of fake cameras to drive")
+    parser.add_argument("--interval", type=int, default=1, help="capture interval per fake camera (seconds)")
+    parser.add_argument("--duration", type=float, default=30, help="benchmark duration (seconds)")
+    parser.add_argument("--frame-kb", type=int, default=1024, help="fake snapshot size (KiB)")
+    parser.add_argument("--port", type=int, default=18080, help="port for the fake snapshot server")
+    args = parser.parse_args()
 
-    # Keep the main thread running indefinitely
+    if args.benchmark:
+        run_benchmark(args)
+        sys.exit(0)
+    if args.benchmark_dedup:
+        run_dedup_benchmark(args)
+        sys.exit(0)
+
+    cameras = load_cameras(CAMERAS_CONFIG)
+    writer = FrameWriter()
     try:
-        while True:
-            time.sleep(1)
+        asyncio.run(run_capture_loop(cameras, writer))
     except KeyboardInterrupt:
         print("Exiting...")
+    finally:
+        writer.close()
@@ -1,13 +1,32 @@
+import io
 import os
+import re
+import glob
+import json
+import fcntl
+import mmap
+import zlib
 import pytz
 import shutil
+import bisect
+import struct
+import itertools
+import threading
+import collections
+import argparse
+import resource
+import tempfile
+import numpy as np
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
 import subprocess
+import time
+import random
+import requests
 import google_auth_oauthlib.flow
-import googleapiclient.discovery
 from datetime import datetime, timedelta
-from google.auth.transport.requests import Request
+from google.auth.transport.requests import AuthorizedSession, Request
 from google.oauth2.credentials import Credentials
-from googleapiclient.http import MediaFileUpload
 
 
 # Local Timezone
@@ -16,8 +35,13 @@ TIMEZONE = os.environ.get("TZ", "UTC")
 # Path where auth tokens and client secrets json files are stored
 AUTH_TOKEN_PATH = os.environ.get("AUTH_TOKEN_PATH", "/data/oauth")
 
-# Image path to image-capturer directory
+# Capturer camera to stitch when it drives several (CAMERAS_CONFIG); blank for its main image directory
+CAMERA_NAME = os.environ.get("CAMERA_NAME", "")
+
+# Image path to image-capturer directory; a named camera's frames are in the folder of that name under it
 TIMELAPSE_IMAGE_PATH = os.environ.get("TIMELAPSE_IMAGE_PATH", "/data/images")
+if CAMERA_NAME:
+    TIMELAPSE_IMAGE_PATH = os.path.join(TIMELAPSE_IMAGE_PATH, CAMERA_NAME)
 
 # Video output / upload path
 VIDEO_OUTPUT_PATH = os.environ.get("VIDEO_OUTPUT_PATH", "/data/video")
@@ -40,62 +64,965 @@ YOUTUBE_PRIVACY = os.environ.get("YOUTUBE_PRIVACY", "public")
 # Cleanup Images (string to bool)
 CLEANUP_IMAGES = os.environ.get("CLEANUP_IMAGES", "true").lower() in ("true", "1", "yes")
 
+# Number of past days a run looks back over for days that still need processing
+BACKFILL_DAYS = int(os.environ.get("BACKFILL_DAYS", "7"))
+
+# Number of days a finished day's videos and journal are kept under the video output path (0 to keep forever)
+KEEP_DAYS = int(os.environ.get("KEEP_DAYS", "7"))
+
+# Name of a day's main video inside its directory under the video output path
+VIDEO_FILE = "timelapse.mp4"
+
+# Youtube resumable upload endpoint
+YOUTUBE_UPLOAD_URL = os.environ.get("YOUTUBE_UPLOAD_URL", "https://www.googleapis.com/upload/youtube/v3/videos")
+
+# Upload chunk size in MiB
+UPLOAD_CHUNK_MB = int(os.environ.get("UPLOAD_CHUNK_MB", "16"))
+
+# Attempts per upload request before giving up
+UPLOAD_MAX_RETRIES = int(os.environ.get("UPLOAD_MAX_RETRIES", "8"))
+
+# Encode completed blocks of frames ahead of the midnight run (string to bool)
+INCREMENTAL_ENCODING = os.environ.get("INCREMENTAL_ENCODING", "false").lower() in ("true", "1", "yes")
+
+# Length of an incremental encoding block in minutes (should divide a day evenly)
+BLOCK_MINUTES = int(os.environ.get("BLOCK_MINUTES", "60"))
+
+# Time after a block closes before it is considered complete (in seconds)
+BLOCK_GRACE = 60
+
+# Time between captured frames (in seconds), used to pace the video in real time
+CAPTURE_INTERVAL = int(os.environ.get("CAPTURE_INTERVAL", "10"))
+
+# Longest gap between frames (in seconds) filled by holding the previous frame; longer gaps are cut
+GAP_FILL_LIMIT = int(os.environ.get("GAP_FILL_LIMIT", "600"))
+
+# Output frame rate
+FRAMERATE = '30'
+
+# Video encoder backend: "auto" or one of the ENCODERS below
+ENCODER = os.environ.get("ENCODER", "auto").lower()
+
+# Largest acceptable output bitrate (kbps) when choosing an encoder automatically (0 for no limit)
+ENCODER_MAX_KBPS = int(os.environ.get("ENCODER_MAX_KBPS", "0"))
+
+# Lowest acceptable SSIM against the source frames when choosing an encoder automatically
+ENCODER_MIN_SSIM = float(os.environ.get("ENCODER_MIN_SSIM", "0"))
+
+# Results of --benchmark-encoders, used by automatic encoder selection
+ENCODER_BENCHMARK_FILE = os.environ.get("ENCODER_BENCHMARK_FILE", VIDEO_OUTPUT_PATH + "/encoder-benchmark.json")
+
+# Render node used by the hardware encoders
+RENDER_DEVICE = os.environ.get("RENDER_DEVICE", "/dev/dri/renderD128")
+
+# Encoder backends: the ffmpeg encoder they need, whether they need RENDER_DEVICE, and the
+# options placed before the input, in the filter chain and on the output
+ENCODERS = {
+    "qsv": {
+        "codec": "hevc_qsv",
+        "device": True,
+        "input_args": [],
+        "filters": [],
+        "args": ['-c:v', 'hevc_qsv', '-pix_fmt', 'yuv420p']
+    },
+    "vaapi": {
+        "codec": "hevc_vaapi",
+        "device": True,
+        "input_args": ['-vaapi_device', RENDER_DEVICE],
+        "filters": ['format=nv12', 'hwupload'],
+        "args": ['-c:v', 'hevc_vaapi']
+    },
+    "x264": {
+        "codec": "libx264",
+        "device": False,
+        "input_args": [],
+        "filters": [],
+        "args": ['-c:v', 'libx264', '-preset', 'medium', '-crf', '23', '-pix_fmt', 'yuv420p']
+    },
+    "svtav1": {
+        "codec": "libsvtav1",
+        "device": False,
+        "input_args": [],
+        "filters": [],
+        "args": ['-c:v', 'libsvtav1', '-preset', '8', '-crf', '35', '-pix_fmt', 'yuv420p']
+    },
+    "x265": {
+        "codec": "libx265",
+        "device": False,
+        "input_args": [],
+        "filters": [],
+        "args": ['-c:v', 'libx265', '-preset', 'medium', '-crf', '26', '-pix_fmt', 'yuv420p', '-tag:v', 'hvc1']
+    }
+}
+
+# Order in which encoders are tried when there are no benchmark results (fastest first)
+ENCODER_PREFERENCE = ["qsv", "vaapi", "x264", "svtav1", "x265"]
+
+# Split software encodes of a whole day into segments encoded in parallel (string to bool)
+PARALLEL_ENCODING = os.environ.get("PARALLEL_ENCODING", "false").lower() in ("true", "1", "yes")
+
+# Number of segments encoded at once (0 for one per CPU core)
+PARALLEL_WORKERS = int(os.environ.get("PARALLEL_WORKERS", "0"))
+
+# Frames per GOP in parallel encodes; segments are cut on GOP boundaries
+GOP_SIZE = int(os.environ.get("GOP_SIZE", "60"))
+
+# JSON file describing extra renditions encoded alongside the main video from the same decode
+RENDITIONS_CONFIG = os.environ.get("RENDITIONS_CONFIG")
+
+# Analyse frames before encoding, dropping bad ones and deflickering exposure jumps (string to bool)
+QUALITY_CHECK = os.environ.get("QUALITY_CHECK", "false").lower() in ("true", "1", "yes")
+
+# Number of processes decoding frames for the quality check (0 for one per CPU core)
+QUALITY_WORKERS = int(os.environ.get("QUALITY_WORKERS", "0"))
+
+# Frames whose luma standard deviation is below this are blank (black or grey) and dropped
+QUALITY_MIN_STDDEV = float(os.environ.get("QUALITY_MIN_STDDEV", "3"))
+
+# Frames with more than this share of pixels in a single histogram bin are flat fills and dropped
+QUALITY_MAX_PEAK = float(os.environ.get("QUALITY_MAX_PEAK", "0.8"))
+
+# Mean luma difference from both neighbours above which a lone frame is a glitch and dropped
+QUALITY_MAX_DIFF = float(os.environ.get("QUALITY_MAX_DIFF", "20"))
+
+# Frame-to-frame change in mean luma (as a ratio) treated as an exposure jump
+QUALITY_EXPOSURE_STEP = float(os.environ.get("QUALITY_EXPOSURE_STEP", "1.3"))
+
+# Number of frames averaged by the deflicker filter applied when exposure jumps are found
+DEFLICKER_FRAMES = int(os.environ.get("DEFLICKER_FRAMES", "5"))
+
+# Size the quality check compares frames at (decoded at 1/8 scale first)
+QUALITY_THUMB_SIZE = (64, 36)
+
+# Pack container format written by dl-timelapse-capturer in STORAGE_MODE=pack: the .pack file
+# holds concatenated JPEGs, the .idx file a magic header followed by fixed-size records of
+# (capture timestamp, offset, length, crc32)
+PACK_MAGIC = b"DLPACK01"
+INDEX_RECORD = struct.Struct("<dQII")
+
+# JPEG start/end of image markers
+JPEG_SOI = b"\xff\xd8"
+JPEG_EOI = b"\xff\xd9"
+
+# Stages of a day's job: the stages each one needs finished first, and the lane it runs in.
+# Stages in different lanes run at the same time; each lane runs one stage at a time
+STAGES = {
+    "validate": ([], "cpu"),
+    "encode": (["validate"], "cpu"),
+    "upload": (["encode"], "network"),
+    "cleanup": (["upload"], "disk")
+}
+
+# A validated frame in a day's manifest: loose frames have no position, packed frames are
+# length bytes at position in the .pack file at path
+Frame = collections.namedtuple('Frame', ['offset', 'path', 'position', 'length'])
+
 # Define the scopes
 SCOPES = [
     "https://www.googleapis.com/auth/youtube.upload",
     "https://www.googleapis.com/auth/youtube.force-ssl"
 ]
 
-def get_yesterdays_date(tz):
-    now = datetime.now(pytz.timezone(tz))
-    yesterday = now - timedelta(days=1)
-    yesterday_str = yesterday.strftime('%d-%m-%Y')
-    return yesterday_str
+def read_pack_index(indexfile):
+    """Returns the (timestamp, offset, length, crc32) records of a pack index, ignoring a torn tail."""
+    with open(indexfile, 'rb') as f:
+        data = f.read()
+    if not data.startswith(PACK_MAGIC):
+        raise ValueError(f"{indexfile} is not a frame pack index")
+    usable = (len(data) - len(PACK_MAGIC)) // INDEX_RECORD.size * INDEX_RECORD.size
+    return list(INDEX_RECORD.iter_unpack(data[len(PACK_MAGIC):len(PACK_MAGIC) + usable]))
 
-def create_timelapse_video(inputdir,outputdir):
-    # Create the output directory if it doesn't exist
-    os.makedirs(outputdir, exist_ok=True)
-    # Create video file full path
-    outputfile = outputdir + "/tmp.mp4"
-    # Clean up old timelapse video if it exists
-    if os.path.isfile(outputfile):
+def has_packed_frames(inputdir):
+    return bool(glob.glob(os.path.join(inputdir, '*.idx')))
+
+def is_valid_jpeg(head, tail):
+    # A complete JPEG starts with SOI and ends with EOI (some cameras pad a few bytes after it)
+    return head[:2] == JPEG_SOI and JPEG_EOI in tail
+
+def build_image_manifest(inputdir):
+    """Returns {seconds since midnight: Frame} for loose HH:MM:SS.jpg frames, plus the corrupt count."""
+    entries = {}
+    corrupt = 0
+    for name in os.listdir(inputdir):
+        if name.startswith('.') or not name.endswith('.jpg'):
+            continue
         try:
-            os.remove(outputfile)
-            print(f"Cleaning up old video {outputfile}...")
-        except Exception as e:
-            print(f"An error occurred while deleting the file: {e}")
+            hours, minutes, seconds = (int(part) for part in name[:-len('.jpg')].split(':'))
+        except ValueError:
+            continue
+        path = os.path.join(inputdir, name)
+        with open(path, 'rb') as f:
+            head = f.read(2)
+            size = f.seek(0, os.SEEK_END)
+            f.seek(max(0, size - 32))
+            tail = f.read()
+        if not is_valid_jpeg(head, tail):
+            print(f"Skipping corrupt frame {path}")
+            corrupt += 1
+            continue
+        entries[hours * 3600 + minutes * 60 + seconds] = Frame(hours * 3600 + minutes * 60 + seconds, path, None, size)
+
+    # Frames the capturer suppressed as duplicates point back at the frame they repeat
+    repeatsfile = os.path.join(inputdir, "repeats.txt")
+    if os.path.isfile(repeatsfile):
+        names = {os.path.basename(frame.path): frame for frame in entries.values()}
+        with open(repeatsfile) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) != 2 or parts[1] not in names:
+                    continue
+                try:
+                    hours, minutes, seconds = (int(part) for part in parts[0][:-len('.jpg')].split(':'))
+                except ValueError:
+                    continue
+                offset = hours * 3600 + minutes * 60 + seconds
+                entries.setdefault(offset, names[parts[1]]._replace(offset=offset))
+    return entries, corrupt
+
+def build_pack_manifest(inputdir):
+    """Returns {seconds since midnight: Frame} for packed frames, plus the corrupt count."""
+    tz = pytz.timezone(TIMEZONE)
+    entries = {}
+    corrupt = 0
+    for indexfile in sorted(glob.glob(os.path.join(inputdir, '*.idx'))):
+        packfile = indexfile[:-len('.idx')] + '.pack'
+        records = read_pack_index(indexfile)
+        if not records:
+            continue
+        with open(packfile, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            verified = {}
+            for timestamp, position, length, crc in records:
+                # Repeats share their kept frame's bytes, so each frame is only checked once
+                if (position, length) not in verified:
+                    frame = mapped[position:position + length]
+                    verified[(position, length)] = (len(frame) == length and zlib.crc32(frame) == crc
+                                                    and is_valid_jpeg(frame[:2], frame[-32:]))
+                if not verified[(position, length)]:
+                    print(f"Skipping corrupt frame at offset {position} in {packfile}")
+                    corrupt += 1
+                    continue
+                captured_at = datetime.fromtimestamp(timestamp, tz)
+                offset = captured_at.hour * 3600 + captured_at.minute * 60 + captured_at.second
+                entries[offset] = Frame(offset, packfile, position, length)
+        finally:
+            mapped.close()
+    return entries, corrupt
+
+def build_frame_manifest(inputdir):
+    """Builds the ordered list of validated frames of a day, keyed by their real capture times."""
+    if has_packed_frames(inputdir):
+        entries, corrupt = build_pack_manifest(inputdir)
     else:
-        print(f"Old video file {outputfile} does not exist, moving on...")
-    # Define ffmpeg params (software encoding)
-    #ffmpeg = [
-    #    'ffmpeg',
-    #    '-framerate', '30',
-    #    '-pattern_type', 'glob',
-    #    '-i', inputdir + '/' + '*.jpg',
-    #    '-c:v', 'libx264',
-    #    '-pix_fmt', 'yuv420p',
-    #    '-r', '30',
-    #    outputfile
-    #]
-    # ffmpeg params for qsv hwaccel hevc
+        entries, corrupt = build_image_manifest(inputdir)
+    manifest = [entries[offset] for offset in sorted(entries)]
+    print(f"Frame manifest for {inputdir}: {len(manifest)} frames, {corrupt} corrupt frames skipped")
+    return manifest
+
+def analyse_frame(job):
+    """Returns (mean luma, luma stddev, 64-bin histogram, thumbnail) of one frame, or None if it will not decode.
+
+    Runs in a worker process: JPEG DCT scaling decodes the luma plane at 1/8 size.
+    """
+    path, position, length = job
+    try:
+        with open(path, 'rb') as f:
+            f.seek(position or 0)
+            data = f.read(length)
+        with Image.open(io.BytesIO(data)) as img:
+            img.draft("L", (img.width // 8, img.height // 8))
+            luma = img.convert("L")
+            thumb = np.asarray(luma.resize(QUALITY_THUMB_SIZE, Image.Resampling.BOX), dtype=np.uint8)
+            pixels = np.asarray(luma, dtype=np.uint8)
+    except (OSError, ValueError):
+        return None
+    histogram = np.bincount(pixels.ravel() >> 2, minlength=64) / pixels.size
+    return float(pixels.mean()), float(pixels.std()), histogram, thumb
+
+def check_frame_quality(manifest, planfile=None):
+    """Analyses the frames of a manifest and returns (manifest without bad frames, deflicker plan).
+
+    Blank, flat and lone glitched frames are dropped, so frame_slots holds the previous frame
+    in their place. Exposure jumps are kept but make the plan ask for a deflicker filter.
+    """
+    if not manifest:
+        return manifest, {"frames": 0, "dropped": [], "exposure_jumps": [], "filters": []}
+    start = time.monotonic()
+    # Held repeats share their kept frame's bytes, so each distinct frame is decoded once
+    keys = list(dict.fromkeys((frame.path, frame.position) for frame in manifest))
+    first = {}
+    for frame in manifest:
+        first.setdefault((frame.path, frame.position), frame)
+    jobs = [(path, position, first[(path, position)].length) for path, position in keys]
+    workers = QUALITY_WORKERS or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(analyse_frame, jobs, chunksize=max(1, min(64, len(jobs) // (workers * 4)))))
+
+    decoded = np.array([result is not None for result in results])
+    blank_result = (0.0, 0.0, np.zeros(64), np.zeros(QUALITY_THUMB_SIZE[::-1], dtype=np.uint8))
+    results = [result if result is not None else blank_result for result in results]
+    means = np.array([result[0] for result in results])
+    stds = np.array([result[1] for result in results])
+    peaks = np.array([result[2].max() for result in results])
+    thumbs = np.stack([result[3] for result in results]).astype(np.float32)
+
+    # Mean absolute difference from the previous frame, the next frame, and between the two
+    diff_prev = np.zeros(len(keys))
+    diff_prev[1:] = np.abs(thumbs[1:] - thumbs[:-1]).mean(axis=(1, 2))
+    diff_next = np.zeros(len(keys))
+    diff_next[:-1] = diff_prev[1:]
+    diff_skip = np.full(len(keys), np.inf)
+    diff_skip[1:-1] = np.abs(thumbs[2:] - thumbs[:-2]).mean(axis=(1, 2))
+
+    reasons = np.full(len(keys), "", dtype=object)
+    reasons[(diff_prev > QUALITY_MAX_DIFF) & (diff_next > QUALITY_MAX_DIFF)
+            & (diff_skip < np.minimum(diff_prev, diff_next) / 2)] = "glitch"
+    reasons[peaks > QUALITY_MAX_PEAK] = "flat"
+    reasons[stds < QUALITY_MIN_STDDEV] = "blank"
+    reasons[~decoded] = "undecodable"
+    bad = reasons != ""
+
+    # Exposure jumps between consecutive good frames, ignoring near-black night frames
+    good_means = means[~bad]
+    good_offsets = np.array([first[keys[n]].offset for n in np.flatnonzero(~bad)])
+    ratios = np.maximum(good_means[1:], 1) / np.maximum(good_means[:-1], 1)
+    jumps = np.flatnonzero((np.abs(np.log(ratios)) > np.log(QUALITY_EXPOSURE_STEP))
+                           & (np.minimum(good_means[1:], good_means[:-1]) > 16)) + 1
+
+    dropped_keys = {keys[n]: reasons[n] for n in np.flatnonzero(bad)}
+    plan = {
+        "frames": len(keys),
+        "dropped": [{"offset": first[key].offset, "reason": reason} for key, reason in dropped_keys.items()],
+        "exposure_jumps": [int(offset) for offset in good_offsets[jumps]],
+        "filters": [f"deflicker=size={DEFLICKER_FRAMES}:mode=pm"] if len(jumps) else [],
+        "seconds": time.monotonic() - start
+    }
+    print(f"Quality check: {len(keys)} frames in {plan['seconds']:.1f}s, dropped {len(dropped_keys)}, "
+          f"{len(jumps)} exposure jumps{', deflickering' if len(jumps) else ''}")
+    if planfile:
+        with open(planfile + ".tmp", 'w') as f:
+            json.dump(plan, f, indent=2)
+        os.replace(planfile + ".tmp", planfile)
+    return [frame for frame in manifest if (frame.path, frame.position) not in dropped_keys], plan
+
+def frame_slots(manifest, start=0, end=86400):
+    """Yields the manifest entry to show in each CAPTURE_INTERVAL slot of [start, end).
+
+    Missing or skipped frames are covered by holding the previous frame, so the video keeps
+    real-time pacing. Gaps longer than GAP_FILL_LIMIT are cut instead of filled.
+    """
+    offsets = [frame.offset for frame in manifest]
+    index = bisect.bisect_right(offsets, start) - 1
+    slot = start + (-start % CAPTURE_INTERVAL)
+    filled = 0
+    cut = 0
+    while slot < end:
+        while index + 1 < len(manifest) and manifest[index + 1].offset <= slot:
+            index += 1
+        if index >= 0 and slot - manifest[index].offset < GAP_FILL_LIMIT:
+            if slot - manifest[index].offset >= CAPTURE_INTERVAL:
+                filled += 1
+            yield manifest[index]
+            slot += CAPTURE_INTERVAL
+        elif index + 1 < len(manifest):
+            # Skip straight to the first slot showing the next frame
+            if index >= 0:
+                cut += 1
+            next_offset = manifest[index + 1].offset
+            slot = next_offset + (-(next_offset - start) % CAPTURE_INTERVAL)
+        else:
+            break
+    if filled or cut:
+        print(f"Filled {filled} empty slots with the previous frame, cut {cut} gaps longer than {GAP_FILL_LIMIT}s")
+
+def iter_slot_frames(manifest, start=0, end=86400):
+    """Yields (seconds since midnight, frame data) for each slot of [start, end)."""
+    return read_frames(frame_slots(manifest, start, end))
+
+def read_frames(entries):
+    """Yields (seconds since midnight, frame data) for manifest entries, reading held frames only once.
+
+    Packed frames are zero-copy memoryviews into the mapped containers.
+    """
+    maps = {}
+    last_entry = None
+    data = None
+    try:
+        for entry in entries:
+            if last_entry is None or (entry.path, entry.position) != (last_entry.path, last_entry.position):
+                if isinstance(data, memoryview):
+                    data.release()
+                if entry.position is None:
+                    with open(entry.path, 'rb') as f:
+                        data = f.read()
+                else:
+                    if entry.path not in maps:
+                        with open(entry.path, 'rb') as f:
+                            maps[entry.path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    data = memoryview(maps[entry.path])[entry.position:entry.position + entry.length]
+                last_entry = entry
+            yield entry.offset, data
+    finally:
+        if isinstance(data, memoryview):
+            data.release()
+        for mapped in maps.values():
+            mapped.close()
+
+def run_ffmpeg_with_frames(ffmpeg, frames):
+    """Runs an ffmpeg command reading an image2pipe input from stdin, streaming frames into it.
+
+    Returns the number of frames written; ffmpeg is not started at all when there are none.
+    """
+    frames = iter(frames)
+    first = next(frames, None)
+    if first is None:
+        return 0
+    frames = itertools.chain([first], frames)
+    count = 0
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(ffmpeg, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr)
+        try:
+            for _, frame in frames:
+                process.stdin.write(frame)
+                count += 1
+        except BrokenPipeError:
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+        returncode = process.wait()
+        if returncode != 0:
+            stderr.seek(0)
+            raise subprocess.CalledProcessError(returncode, ffmpeg, stderr=stderr.read())
+    return count
+
+def load_renditions(config_path):
+    """Reads the extra renditions from RENDITIONS_CONFIG; without one only the main video is encoded."""
+    if not config_path:
+        return []
+
+    with open(config_path) as f:
+        config = json.load(f)
+
+    renditions = []
+    for entry in config.get("renditions", []):
+        name = entry.get("name", "")
+        if not re.fullmatch(r"[A-Za-z0-9_-]+", name):
+            raise ValueError(f"Rendition names in {config_path} must be letters, digits, '-' or '_', got '{name}'")
+        if entry.get("encoder") is not None and entry["encoder"] not in ENCODERS:
+            raise ValueError(f"Unknown encoder '{entry['encoder']}' for rendition {name}, "
+                             f"expected one of {', '.join(ENCODERS)}")
+        renditions.append({
+            "name": name,
+            "encoder": entry.get("encoder"),
+            "crop": entry.get("crop"),
+            "width": entry.get("width"),
+            "height": entry.get("height"),
+            "kbps": int(entry.get("kbps", 0))
+        })
+
+    names = [rendition["name"] for rendition in renditions]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Renditions in {config_path} must have unique names")
+    return renditions
+
+def rendition_file(outputfile, rendition):
+    root, ext = os.path.splitext(outputfile)
+    return f"{root}-{rendition['name']}{ext}"
+
+def output_filters(output):
+    filters = []
+    if output.get("crop"):
+        filters.append(f"crop={output['crop']}")
+    if output.get("width") or output.get("height"):
+        filters.append(f"scale={output.get('width') or -2}:{output.get('height') or -2},setsar=1")
+    return filters + ENCODERS[output["encoder"]]['filters']
+
+def output_args(output):
+    spec = ENCODERS[output["encoder"]]
+    args = list(spec['args'])
+    if output.get("kbps"):
+        kbps = output["kbps"]
+        # Hardware encoders take a target bitrate, software encoders keep their CRF with a ceiling
+        if spec['device']:
+            args += ['-b:v', f'{kbps}k']
+        args += ['-maxrate', f'{kbps}k', '-bufsize', f'{kbps * 2}k']
+    return args
+
+def outputs_command(outputs, extra_args=(), pre_filters=()):
+    """Builds one ffmpeg command that decodes the piped frames once and encodes every (file, output) pair.
+
+    A single output keeps a plain filter chain; several outputs split the decoded frames in a
+    filter graph so each branch gets its own crop, scale and encoder. pre_filters apply to all.
+    """
+    input_args = []
+    for _, output in outputs:
+        for arg in ENCODERS[output["encoder"]]['input_args']:
+            if arg not in input_args:
+                input_args.append(arg)
     ffmpeg = [
         'ffmpeg',
-        '-pattern_type', 'glob',
-        '-i', inputdir + '/*.jpg',
-        '-framerate', '30',
-        '-c:v', 'hevc_qsv',
-        '-pix_fmt', 'yuv420p',
-        outputfile
+        '-y',
+        *input_args,
+        '-framerate', FRAMERATE,
+        '-f', 'image2pipe',
+        '-c:v', 'mjpeg',
+        '-i', 'pipe:0'
     ]
+
+    if len(outputs) == 1:
+        outputfile, output = outputs[0]
+        filters = [*pre_filters, *output_filters(output)]
+        if filters:
+            ffmpeg += ['-vf', ','.join(filters)]
+        return ffmpeg + [*output_args(output), *extra_args, outputfile]
+
+    graph = [f"[0:v]{''.join(f'{name},' for name in pre_filters)}split={len(outputs)}"
+             + "".join(f"[s{n}]" for n in range(len(outputs)))]
+    for n, (_, output) in enumerate(outputs):
+        graph.append(f"[s{n}]{','.join(output_filters(output)) or 'null'}[v{n}]")
+    ffmpeg += ['-filter_complex', ';'.join(graph)]
+    for n, (outputfile, output) in enumerate(outputs):
+        ffmpeg += ['-map', f'[v{n}]', *output_args(output), *extra_args, outputfile]
+    return ffmpeg
+
+def encode_outputs(outputfile, encoder, renditions=()):
+    """Pairs the main video and each rendition with the file it is written to."""
+    outputs = [(outputfile, {"encoder": encoder})]
+    for rendition in renditions:
+        outputs.append((rendition_file(outputfile, rendition), dict(rendition, encoder=rendition["encoder"] or encoder)))
+    return outputs
+
+def encode_command(outputfile, encoder, extra_args=(), renditions=(), pre_filters=()):
+    # Every encode (whole day or block) shares these settings so blocks can be stream-copied together
+    return outputs_command(encode_outputs(outputfile, encoder, renditions), extra_args, pre_filters)
+
+def probe_encoders():
+    """Returns the encoder backends that can actually encode on this host, in ENCODER_PREFERENCE order."""
+    try:
+        listing = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], check=True,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode('utf-8')
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Unable to list ffmpeg encoders: {e}")
+        return []
+
+    available = []
+    for name in ENCODER_PREFERENCE:
+        spec = ENCODERS[name]
+        if f" {spec['codec']} " not in listing:
+            continue
+        if spec['device'] and not os.path.exists(RENDER_DEVICE):
+            continue
+        # Being compiled in is not enough for hardware encoders, so try a few frames
+        ffmpeg = ['ffmpeg', '-v', 'error', *spec['input_args'],
+                  '-f', 'lavfi', '-i', 'testsrc2=size=640x360:rate=30', '-frames:v', '5']
+        if spec['filters']:
+            ffmpeg += ['-vf', ','.join(spec['filters'])]
+        ffmpeg += [*spec['args'], '-f', 'null', '-']
+        if subprocess.run(ffmpeg, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+            available.append(name)
+    return available
+
+def load_encoder_benchmark():
+    if os.path.isfile(ENCODER_BENCHMARK_FILE):
+        with open(ENCODER_BENCHMARK_FILE) as f:
+            return json.load(f).get("results", [])
+    return []
+
+def select_encoder(requested=ENCODER):
+    """Picks the encoder to use: the requested one if it works, otherwise the fastest that meets the targets."""
+    available = probe_encoders()
+    print(f"Available encoders: {', '.join(available) or 'none'}")
+    if requested != "auto":
+        if requested not in ENCODERS:
+            raise ValueError(f"Unknown ENCODER '{requested}', expected 'auto' or one of {', '.join(ENCODERS)}")
+        if requested in available:
+            return requested
+        print(f"Requested encoder {requested} is not available on this host, selecting automatically")
+
+    candidates = [
+        result for result in load_encoder_benchmark()
+        if result["encoder"] in available
+        and (not ENCODER_MAX_KBPS or result["kbps"] <= ENCODER_MAX_KBPS)
+        and result.get("ssim", 1.0) >= ENCODER_MIN_SSIM
+    ]
+    if candidates:
+        best = max(candidates, key=lambda result: result["fps"])
+        print(f"Selected encoder {best['encoder']} from benchmark results "
+              f"({best['fps']:.1f} fps, {best['kbps']:.0f} kbps, SSIM {best.get('ssim', 0):.4f})")
+        return best["encoder"]
+    if available:
+        print(f"Selected encoder {available[0]} by preference")
+        return available[0]
+    raise RuntimeError("No working video encoder found")
+
+def measure_ssim(videofile, framepattern):
+    """Returns the SSIM of an encoded video against the JPEG frames it was made from."""
+    result = subprocess.run(
+        ['ffmpeg', '-i', videofile, '-framerate', FRAMERATE, '-i', framepattern,
+         '-lavfi', '[0:v]format=yuv420p[encoded];[1:v]format=yuv420p[source];[encoded][source]ssim',
+         '-f', 'null', '-'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    match = re.search(r"All:([0-9.]+)", result.stderr.decode('utf-8'))
+    return float(match.group(1)) if match else None
+
+def load_synthetic_frames(framepattern, frames, size):
+    """Generates a reproducible set of noisy test pattern JPEGs and returns them as (n, data) pairs."""
+    print(f"Generating {frames} synthetic {size} frames...")
+    subprocess.run(['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', f'testsrc2=size={size}:rate={FRAMERATE}',
+                    '-vf', 'noise=alls=12:allf=t', '-frames:v', str(frames), '-q:v', '3', framepattern],
+                   check=True)
+    source = []
+    for n in range(1, frames + 1):
+        with open(framepattern % n, 'rb') as f:
+            source.append((n, f.read()))
+    return source
+
+def run_encoder_benchmark(frames, size):
+    """Encodes a fixed synthetic frame set with every available encoder and records the results."""
+    available = probe_encoders()
+    if not available:
+        print("No working encoders found, nothing to benchmark.")
+        return
+    with tempfile.TemporaryDirectory() as tmpdir:
+        framepattern = os.path.join(tmpdir, "frame-%05d.jpg")
+        source = load_synthetic_frames(framepattern, frames, size)
+
+        results = []
+        for name in available:
+            outputfile = os.path.join(tmpdir, f"{name}.mp4")
+            print(f"Benchmarking {name}...")
+            cpu_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            start = time.monotonic()
+            try:
+                run_ffmpeg_with_frames(encode_command(outputfile, name), source)
+            except subprocess.CalledProcessError as e:
+                print(f"Encoder {name} failed")
+                print(e.stderr.decode('utf-8'))
+                continue
+            wall = time.monotonic() - start
+            cpu_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            size_bytes = os.path.getsize(outputfile)
+            results.append({
+                "encoder": name,
+                "fps": frames / wall,
+                "wall_seconds": wall,
+                "cpu_seconds": (cpu_after.ru_utime - cpu_before.ru_utime) + (cpu_after.ru_stime - cpu_before.ru_stime),
+                "bytes": size_bytes,
+                "kbps": size_bytes * 8 / (frames / int(FRAMERATE)) / 1000,
+                "ssim": measure_ssim(outputfile, framepattern)
+            })
+
+    print(f"{'encoder':<8} {'fps':>8} {'wall s':>8} {'cpu s':>8} {'size KiB':>10} {'kbps':>8} {'ssim':>7}")
+    for result in results:
+        ssim = f"{result['ssim']:.4f}" if result['ssim'] is not None else "n/a"
+        print(f"{result['encoder']:<8} {result['fps']:>8.1f} {result['wall_seconds']:>8.2f} "
+              f"{result['cpu_seconds']:>8.2f} {result['bytes'] / 1024:>10.0f} {result['kbps']:>8.0f} {ssim:>7}")
+
+    os.makedirs(os.path.dirname(ENCODER_BENCHMARK_FILE) or ".", exist_ok=True)
+    with open(ENCODER_BENCHMARK_FILE, 'w') as f:
+        json.dump({"frames": frames, "size": size, "results": results}, f, indent=2)
+    print(f"Benchmark results written to {ENCODER_BENCHMARK_FILE}")
+
+def prepare_output_files(outputfiles):
+    # Create the output directory if it doesn't exist
+    for outputdir in {os.path.dirname(outputfile) for outputfile in outputfiles}:
+        os.makedirs(outputdir, exist_ok=True)
+    # Clean up old timelapse videos if they exist
+    for oldfile in outputfiles:
+        if os.path.isfile(oldfile):
+            try:
+                os.remove(oldfile)
+                print(f"Cleaning up old video {oldfile}...")
+            except Exception as e:
+                print(f"An error occurred while deleting the file: {e}")
+        else:
+            print(f"Old video file {oldfile} does not exist, moving on...")
+
+def get_parallel_workers():
+    return PARALLEL_WORKERS or os.cpu_count() or 1
+
+def encode_parallel(entries, outputs, workers, pre_filters=()):
+    """Encodes slot entries as contiguous GOP-aligned segments in parallel, then joins them losslessly.
+
+    Each segment is its own ffmpeg process with an equal share of the cores; the pool threads
+    only feed frames into those processes. Raises CalledProcessError when there are no frames,
+    as a single ffmpeg process would fail on an empty input.
+    """
+    if not entries:
+        raise subprocess.CalledProcessError(1, "ffmpeg", stderr=b"No frames to encode")
+    gops = -(-len(entries) // GOP_SIZE)
+    workers = max(1, min(workers, gops))
+    segment_length = -(-gops // workers) * GOP_SIZE
+    segments = [entries[n:n + segment_length] for n in range(0, len(entries), segment_length)]
+    extra_args = ['-g', str(GOP_SIZE), '-threads', str(max(1, (os.cpu_count() or 1) // len(segments)))]
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(outputs[0][0]) or ".") as tmpdir:
+        parts = [[(os.path.join(tmpdir, f"segment-{n:03d}-{k}.mp4"), output) for k, (_, output) in enumerate(outputs)]
+                 for n in range(len(segments))]
+        with ThreadPoolExecutor(max_workers=len(segments)) as pool:
+            counts = list(pool.map(
+                lambda job: run_ffmpeg_with_frames(outputs_command(job[0], extra_args, pre_filters),
+                                                   read_frames(job[1])),
+                zip(parts, segments)
+            ))
+        for k, (outputfile, _) in enumerate(outputs):
+            concat_videos([segment[k][0] for segment in parts], outputfile)
+    return sum(counts)
+
+def load_checked_manifest(inputdir, outputdir):
+    """Returns a day's manifest and encoder pre-filters, applying the quality check when it is enabled.
+
+    The plan is kept in quality.json, so the check runs once per day however many encodes follow.
+    """
+    manifest = build_frame_manifest(inputdir)
+    if not QUALITY_CHECK:
+        return manifest, []
+    planfile = os.path.join(outputdir, "quality.json")
+    if not os.path.isfile(planfile):
+        os.makedirs(outputdir, exist_ok=True)
+        manifest, plan = check_frame_quality(manifest, planfile)
+        return manifest, plan["filters"]
+    with open(planfile) as f:
+        plan = json.load(f)
+    dropped = {entry["offset"] for entry in plan["dropped"]}
+    # Held repeats of a dropped frame go with it
+    dropped_keys = {(frame.path, frame.position) for frame in manifest if frame.offset in dropped}
+    return [frame for frame in manifest if (frame.path, frame.position) not in dropped_keys], plan["filters"]
+
+def create_timelapse_video(inputdir, outputdir, encoder, renditions=()):
+    """Encodes a day into timelapse.mp4 and its renditions from a single decode of its frames.
+
+    Raises CalledProcessError if ffmpeg fails.
+    """
+    outputs = encode_outputs(os.path.join(outputdir, VIDEO_FILE), encoder, renditions)
+    prepare_output_files([outputfile for outputfile, _ in outputs])
     # Run ffmpeg
     print("Running ffmpeg, this may take a while...")
     try:
-        result = subprocess.run(ffmpeg, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        print("FFmpeg process completed successfully")
-        print(result.stdout.decode('utf-8'))
+        manifest, pre_filters = load_checked_manifest(inputdir, outputdir)
+        if PARALLEL_ENCODING and not any(ENCODERS[output["encoder"]]['device'] for _, output in outputs):
+            workers = get_parallel_workers()
+            print(f"Encoding in up to {workers} parallel segments...")
+            frames = encode_parallel(list(frame_slots(manifest)), outputs, workers, pre_filters)
+        else:
+            frames = run_ffmpeg_with_frames(outputs_command(outputs, pre_filters=pre_filters),
+                                            iter_slot_frames(manifest))
+        print(f"FFmpeg process completed successfully ({frames} frames)")
     except subprocess.CalledProcessError as e:
         print("An error occurred while running FFmpeg")
         print(e.stderr.decode('utf-8'))
+        raise
+    return frames
+
+def run_parallel_benchmark(frames, size):
+    """Compares single-process and parallel segment encoding of the same synthetic frames."""
+    encoder = ENCODER if ENCODER in ENCODERS and not ENCODERS[ENCODER]['device'] else "x264"
+    workers = get_parallel_workers()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = load_synthetic_frames(os.path.join(tmpdir, "frame-%05d.jpg"), frames, size)
+        entries = [Frame(n, os.path.join(tmpdir, "frame-%05d.jpg" % n), None, len(data)) for n, data in source]
+
+        start = time.monotonic()
+        run_ffmpeg_with_frames(encode_command(os.path.join(tmpdir, "single.mp4"), encoder,
+                                              ['-g', str(GOP_SIZE)]), read_frames(entries))
+        single = time.monotonic() - start
+
+        start = time.monotonic()
+        encode_parallel(entries, encode_outputs(os.path.join(tmpdir, "parallel.mp4"), encoder), workers)
+        parallel = time.monotonic() - start
+
+    print(f"Parallel benchmark: {frames} frames of {size} with {encoder}, {workers} workers, GOP {GOP_SIZE}")
+    print(f"Single process: {single:.2f}s ({frames / single:.1f} fps)")
+    print(f"Parallel:       {parallel:.2f}s ({frames / parallel:.1f} fps), {single / parallel:.2f}x speedup")
+
+def run_rendition_benchmark(frames, size):
+    """Compares one single-decode multi-output encode of every rendition with separate runs per rendition."""
+    renditions = load_renditions(RENDITIONS_CONFIG) or [
+        {"name": "1080p", "encoder": None, "crop": None, "width": 1920, "height": 1080, "kbps": 0},
+        {"name": "short", "encoder": None, "crop": "ih*9/16:ih", "width": 1080, "height": 1920, "kbps": 0}
+    ]
+    encoder = ENCODER if ENCODER in ENCODERS else select_encoder()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = load_synthetic_frames(os.path.join(tmpdir, "frame-%05d.jpg"), frames, size)
+        outputs = encode_outputs(os.path.join(tmpdir, "video.mp4"), encoder, renditions)
+
+        start = time.monotonic()
+        run_ffmpeg_with_frames(outputs_command(outputs), source)
+        combined = time.monotonic() - start
+
+        separate = []
+        for output in outputs:
+            start = time.monotonic()
+            run_ffmpeg_with_frames(outputs_command([output]), source)
+            separate.append(time.monotonic() - start)
+
+    print(f"Rendition benchmark: {frames} frames of {size}, {len(outputs)} outputs, main encoder {encoder}")
+    for (outputfile, _), wall in zip(outputs, separate):
+        print(f"  {os.path.basename(outputfile):<20} alone: {wall:.2f}s")
+    print(f"Separate runs:  {sum(separate):.2f}s")
+    print(f"Single decode:  {combined:.2f}s, {sum(separate) / combined:.2f}x faster, "
+          f"{combined / separate[0]:.2f}x the main video alone")
+
+def run_quality_benchmark(frames, size):
+    """Times the quality check on synthetic frames with a few bad ones mixed in, against encoding them."""
+    encoder = ENCODER if ENCODER in ENCODERS else select_encoder()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        framepattern = os.path.join(tmpdir, "frame-%05d.jpg")
+        source = load_synthetic_frames(framepattern, frames, size)
+        width, height = (int(part) for part in size.split('x'))
+        # A black frame, a grey decoder glitch and a half-grey frame at known positions
+        bad = {frames // 4: (0, 0, 0), frames // 2: (128, 128, 128), 3 * frames // 4: None}
+        for n, colour in bad.items():
+            if colour is None:
+                with Image.open(framepattern % n) as img:
+                    img.load()
+                    img.paste((128, 128, 128), (0, height // 2, width, height))
+                    img.save(framepattern % n, quality=85)
+            else:
+                Image.new("RGB", (width, height), colour).save(framepattern % n, quality=85)
+        manifest = [Frame(n * CAPTURE_INTERVAL, framepattern % n, None, os.path.getsize(framepattern % n))
+                    for n in range(1, frames + 1)]
+
+        _, plan = check_frame_quality(manifest)
+        start = time.monotonic()
+        run_ffmpeg_with_frames(encode_command(os.path.join(tmpdir, "video.mp4"), encoder), read_frames(manifest))
+        encode = time.monotonic() - start
+
+    analysis = plan["seconds"]
+    print(f"Quality benchmark: {frames} frames of {size}, {QUALITY_WORKERS or os.cpu_count()} workers")
+    print(f"Analysis: {analysis:.2f}s ({frames / analysis:.1f} fps, {analysis / frames * 1000:.1f} ms/frame), "
+          f"projected {analysis / frames * 8640:.0f}s for a full day of 8640 frames")
+    print(f"Encode with {encoder}: {encode:.2f}s, analysis is {analysis / encode * 100:.1f}% of the encode time")
+    print(f"Injected bad frames at {sorted(n * CAPTURE_INTERVAL for n in bad)}, "
+          f"dropped {[(entry['offset'], entry['reason']) for entry in plan['dropped']]}")
+
+def get_day_dir(outputdir, daystr):
+    return os.path.join(outputdir, daystr)
+
+def get_block_dir(outputdir, daystr):
+    return os.path.join(get_day_dir(outputdir, daystr), "blocks")
+
+def load_block_state(blockdir):
+    statefile = os.path.join(blockdir, "blocks.json")
+    if os.path.isfile(statefile):
+        with open(statefile) as f:
+            return json.load(f)
+    return {}
+
+def save_block_state(blockdir, state):
+    # Write then rename so an interrupted run never leaves a truncated state file
+    statefile = os.path.join(blockdir, "blocks.json")
+    with open(statefile + ".tmp", 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(statefile + ".tmp", statefile)
+
+def encode_pending_blocks(inputdir, outputdir, daystr, encoder, renditions=()):
+    """Encodes every closed BLOCK_MINUTES block of a day that has not been encoded yet.
+
+    Finished blocks are recorded in blocks.json next to the block videos, so a restarted or
+    repeated run only encodes what is missing. Changing the encoder settings invalidates them.
+    """
+    blockdir = get_block_dir(outputdir, daystr)
+    os.makedirs(blockdir, exist_ok=True)
+    block_length = BLOCK_MINUTES * 60
+    tz = pytz.timezone(TIMEZONE)
+    day_start = datetime.strptime(daystr, '%d-%m-%Y')
+    now = datetime.now(tz)
+
+    # Hourly and midnight runs may overlap, so only one of them works on a day at a time
+    with open(os.path.join(blockdir, ".lock"), 'w') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        state = load_block_state(blockdir)
+        spec = ENCODERS[encoder]
+        settings = [FRAMERATE, encoder, *spec['input_args'], *spec['filters'], *spec['args'],
+                    *[json.dumps(rendition, sort_keys=True) for rendition in renditions]]
+        if state.get("settings") != settings or state.get("block_minutes") != BLOCK_MINUTES:
+            if state:
+                print(f"Encoder settings changed, discarding existing blocks for {daystr}")
+            state = {"settings": settings, "block_minutes": BLOCK_MINUTES, "blocks": {}}
+
+        manifest = None
+        for start in range(0, 86400, block_length):
+            name = f"{start // 3600:02d}{start % 3600 // 60:02d}"
+            if name in state["blocks"]:
+                continue
+            block_end = tz.localize(day_start + timedelta(seconds=start + block_length))
+            if now < block_end + timedelta(seconds=BLOCK_GRACE):
+                break
+            blockfile = os.path.join(blockdir, f"block-{name}.mp4")
+            if manifest is None:
+                manifest = build_frame_manifest(inputdir)
+            print(f"Encoding block {name} of {daystr}...")
+            block_manifest = manifest
+            pre_filters = []
+            if QUALITY_CHECK:
+                # Only this block's own frames are checked; the one held into it was checked with its block
+                offsets = [frame.offset for frame in manifest]
+                first = bisect.bisect_left(offsets, start)
+                last = bisect.bisect_left(offsets, start + block_length)
+                if first < last:
+                    checked, plan = check_frame_quality(manifest[first:last],
+                                                        os.path.join(blockdir, f"quality-{name}.json"))
+                    block_manifest = manifest[max(0, first - 1):first] + checked
+                    pre_filters = plan["filters"]
+            try:
+                frames = run_ffmpeg_with_frames(encode_command(blockfile, encoder, renditions=renditions,
+                                                               pre_filters=pre_filters),
+                                                iter_slot_frames(block_manifest, start, start + block_length))
+            except subprocess.CalledProcessError as e:
+                print(f"An error occurred while encoding block {name}")
+                print(e.stderr.decode('utf-8'))
+                break
+            state["blocks"][name] = {"frames": frames}
+            save_block_state(blockdir, state)
+    return state
+
+def concat_videos(parts, outputfile):
+    """Joins videos sharing the same encoder settings with the concat demuxer, without re-encoding."""
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as listfile:
+        for part in parts:
+            escaped = os.path.abspath(part).replace("'", "'\\''")
+            listfile.write(f"file '{escaped}'\n")
+    try:
+        subprocess.run(['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', listfile.name,
+                        '-c', 'copy', outputfile],
+                       check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    finally:
+        os.remove(listfile.name)
+
+def create_timelapse_from_blocks(inputdir, outputdir, daystr, encoder, renditions=()):
+    """Encodes any blocks the hourly runs have not covered, then concatenates the day's blocks.
+
+    The videos are written to the day's directory under outputdir. Raises if nothing can be joined.
+    """
+    state = encode_pending_blocks(inputdir, outputdir, daystr, encoder, renditions)
+    blockdir = get_block_dir(outputdir, daystr)
+    names = sorted(name for name, block in state["blocks"].items() if block["frames"] > 0)
+    if len(state["blocks"]) < 86400 // (BLOCK_MINUTES * 60):
+        print(f"Warning: only {len(state['blocks'])} blocks of {daystr} could be encoded")
+    if not names:
+        raise RuntimeError(f"No frames were encoded for {daystr}, nothing to concatenate")
+    outputs = encode_outputs(os.path.join(get_day_dir(outputdir, daystr), VIDEO_FILE), encoder, renditions)
+    outputfile = outputs[0][0]
+    prepare_output_files([outputfile for outputfile, _ in outputs])
+    print(f"Concatenating {len(names)} blocks into {outputfile}...")
+    try:
+        blockfiles = [os.path.join(blockdir, f"block-{name}.mp4") for name in names]
+        concat_videos(blockfiles, outputfile)
+        for rendition in renditions:
+            concat_videos([rendition_file(blockfile, rendition) for blockfile in blockfiles],
+                          rendition_file(outputfile, rendition))
+        print("FFmpeg concat completed successfully")
+    except subprocess.CalledProcessError as e:
+        print("An error occurred while concatenating blocks")
+        print(e.stderr.decode('utf-8'))
+        raise
+    return sum(state["blocks"][name]["frames"] for name in names)
 
 def cleanup_images(choice,imgdir):
     if choice:
@@ -108,7 +1035,7 @@ def cleanup_images(choice,imgdir):
     else:
         print("Skipping cleanup...")
 
-def get_authenticated_service():
+def get_authenticated_session():
     token_file = f'{AUTH_TOKEN_PATH}/token.json'
     secrets_file = f'{AUTH_TOKEN_PATH}/client_secrets.json'
     creds = None
@@ -141,10 +1068,81 @@ def get_authenticated_service():
         with open(token_file, 'w') as token:
             token.write(creds.to_json())
 
-    youtube = googleapiclient.discovery.build('youtube', 'v3', credentials=creds)
-    return youtube
+    return AuthorizedSession(creds)
+
+class RetryableUploadError(Exception):
+    pass
+
+def upload_request(session, method, url, **kwargs):
+    """Sends one upload request, retrying connection failures and 5xx responses with exponential backoff."""
+    delay = 1
+    for attempt in range(UPLOAD_MAX_RETRIES):
+        try:
+            response = session.request(method, url, timeout=(10, 300), **kwargs)
+            if response.status_code in (500, 502, 503, 504):
+                raise RetryableUploadError(f"HTTP {response.status_code}")
+            return response
+        except (requests.ConnectionError, requests.Timeout, RetryableUploadError) as e:
+            if attempt == UPLOAD_MAX_RETRIES - 1:
+                raise
+            print(f"Upload request failed ({e}), retrying in {delay:.1f} seconds...")
+            time.sleep(delay)
+            delay = min(delay * 2, 64) + random.uniform(0, 1)
+
+def get_upload_offset(response):
+    # A 308 response carries the last byte the server has received, if any
+    received = response.headers.get("Range")
+    return int(received.rsplit("-", 1)[1]) + 1 if received else 0
+
+def load_upload_checkpoint(checkpoint_file, video_file, yesterdaystr):
+    """Returns the saved upload session for this exact video file, if there is one."""
+    if not os.path.isfile(checkpoint_file):
+        return None
+    with open(checkpoint_file) as f:
+        checkpoint = json.load(f)
+    stat = os.stat(video_file)
+    if (checkpoint.get("day"), checkpoint.get("size"), checkpoint.get("mtime")) != (yesterdaystr, stat.st_size, stat.st_mtime):
+        print("Discarding upload checkpoint for a different video file")
+        return None
+    return checkpoint
+
+def save_upload_checkpoint(checkpoint_file, checkpoint):
+    with open(checkpoint_file + ".tmp", 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(checkpoint_file + ".tmp", checkpoint_file)
 
-def upload_video(youtube, video_file, title, yesterdaystr, description, tags, category_id, privacy_status):
+def start_upload_session(session, body, size):
+    response = upload_request(
+        session, "POST", YOUTUBE_UPLOAD_URL,
+        params={"uploadType": "resumable", "part": "snippet,status"},
+        headers={
+            "Content-Type": "application/json; charset=UTF-8",
+            "X-Upload-Content-Length": str(size),
+            "X-Upload-Content-Type": "video/mp4"
+        },
+        data=json.dumps(body)
+    )
+    response.raise_for_status()
+    return response.headers["Location"]
+
+def query_upload_session(session, uri, size):
+    """Asks the server how much of an interrupted upload it has; returns (offset, response)."""
+    response = upload_request(session, "PUT", uri, headers={"Content-Range": f"bytes */{size}", "Content-Length": "0"})
+    if response.status_code in (200, 201):
+        return size, response
+    if response.status_code == 308:
+        return get_upload_offset(response), response
+    if response.status_code in (404, 410):
+        return None, response
+    response.raise_for_status()
+    return None, response
+
+def upload_video(session, video_file, title, yesterdaystr, description, tags, category_id, privacy_status):
+    """Uploads a video in UPLOAD_CHUNK_MB chunks through a resumable upload session.
+
+    The session URI and confirmed byte offset are checkpointed next to the video after every
+    chunk, so a restarted container resumes the upload where it stopped.
+    """
     print("Uploading video to Youtube...")
     body = {
         "snippet": {
@@ -158,32 +1156,289 @@ def upload_video(youtube, video_file, title, yesterdaystr, description, tags, ca
         }
     }
 
-    media_body = MediaFileUpload(video_file, chunksize=-1, resumable=True)
+    size = os.path.getsize(video_file)
+    if size == 0:
+        raise ValueError(f"{video_file} is empty, refusing to upload it")
+    chunk_size = max(1, UPLOAD_CHUNK_MB) * 1024 * 1024
+    checkpoint_file = video_file + ".upload.json"
+    checkpoint = load_upload_checkpoint(checkpoint_file, video_file, yesterdaystr)
+    offset = None
+    response = None
 
-    request = youtube.videos().insert(
-        part="snippet,status",
-        body=body,
-        media_body=media_body
-    )
+    if checkpoint:
+        offset, response = query_upload_session(session, checkpoint["uri"], size)
+        if offset is None:
+            print("Saved upload session has expired, starting a new one")
+        else:
+            print(f"Resuming upload at byte {offset} of {size}")
+
+    if offset is None:
+        stat = os.stat(video_file)
+        checkpoint = {"day": yesterdaystr, "size": size, "mtime": stat.st_mtime,
+                      "uri": start_upload_session(session, body, size), "offset": 0}
+        save_upload_checkpoint(checkpoint_file, checkpoint)
+        offset = 0
+
+    with open(video_file, 'rb') as f:
+        while offset < size:
+            f.seek(offset)
+            chunk = f.read(chunk_size)
+            end = offset + len(chunk) - 1
+            start = time.monotonic()
+            response = upload_request(session, "PUT", checkpoint["uri"], data=chunk,
+                                      headers={"Content-Range": f"bytes {offset}-{end}/{size}"})
+            elapsed = time.monotonic() - start
+            if response.status_code in (200, 201):
+                offset = size
+            elif response.status_code == 308:
+                offset = get_upload_offset(response)
+            else:
+                response.raise_for_status()
+                raise RuntimeError(f"Unexpected upload response: HTTP {response.status_code}")
+            checkpoint["offset"] = offset
+            save_upload_checkpoint(checkpoint_file, checkpoint)
+            print(f"Uploaded {offset}/{size} bytes ({offset / size * 100:.1f}%), "
+                  f"chunk at {len(chunk) * 8 / max(elapsed, 1e-6) / 1e6:.1f} Mbit/s")
+
+    os.remove(checkpoint_file)
+    video_id = response.json()['id']
+    print(f"Video uploaded. Video ID: {video_id}")
+    return video_id
+
+class DayJob:
+    """One day's run through STAGES, journaled to journal.json in the day's video directory."""
+
+    def __init__(self, daystr):
+        self.daystr = daystr
+        self.imgdir = os.path.join(TIMELAPSE_IMAGE_PATH, daystr)
+        self.outputdir = get_day_dir(VIDEO_OUTPUT_PATH, daystr)
+        self.videofile = os.path.join(self.outputdir, VIDEO_FILE)
+        self.journalfile = os.path.join(self.outputdir, "journal.json")
+        self.lock = threading.Lock()
+        self.journal = {"day": daystr, "stages": {}}
+        if os.path.isfile(self.journalfile):
+            with open(self.journalfile) as f:
+                self.journal = json.load(f)
 
-    response = request.execute()
-    print(f"Video uploaded. Video ID: {response['id']}")
+    def status(self, stage):
+        return self.journal["stages"].get(stage, {}).get("status")
+
+    def is_done(self, stage):
+        # An encode whose video has gone missing before the upload has to be redone
+        if stage == "encode" and self.status("upload") != "done" and not os.path.isfile(self.videofile):
+            return False
+        return self.status(stage) == "done"
+
+    def is_complete(self):
+        return all(self.is_done(stage) for stage in STAGES)
+
+    def record(self, stage, **fields):
+        # Stages of one day can finish at the same time, so the journal is written under a lock
+        with self.lock:
+            self.journal["stages"].setdefault(stage, {}).update(fields)
+            os.makedirs(self.outputdir, exist_ok=True)
+            with open(self.journalfile + ".tmp", 'w') as f:
+                json.dump(self.journal, f, indent=2)
+            os.replace(self.journalfile + ".tmp", self.journalfile)
+
+class Pipeline:
+    """Runs the stages of several days' jobs, skipping finished stages and overlapping lanes."""
+
+    def __init__(self, renditions):
+        self.renditions = renditions
+        self.lock = threading.Lock()
+        self.encoder = None
+        self.session = None
+
+    def get_encoder(self):
+        with self.lock:
+            if self.encoder is None:
+                self.encoder = select_encoder()
+            return self.encoder
+
+    def get_session(self):
+        with self.lock:
+            if self.session is None:
+                self.session = get_authenticated_session()
+            return self.session
+
+    def stage_validate(self, job):
+        if not os.path.isdir(job.imgdir):
+            raise FileNotFoundError(f"The directory {job.imgdir} does not exist")
+        if INCREMENTAL_ENCODING:
+            # Blocks run their own quality checks as they are encoded
+            manifest = build_frame_manifest(job.imgdir)
+        else:
+            manifest, _ = load_checked_manifest(job.imgdir, job.outputdir)
+        if not manifest:
+            raise ValueError(f"No usable frames in {job.imgdir}")
+        return {"frames": len(manifest)}
+
+    def stage_encode(self, job):
+        # The main video and every rendition come out of one decode of the day's frames
+        if INCREMENTAL_ENCODING:
+            frames = create_timelapse_from_blocks(job.imgdir, VIDEO_OUTPUT_PATH, job.daystr, self.get_encoder(),
+                                                  self.renditions)
+        else:
+            frames = create_timelapse_video(job.imgdir, job.outputdir, self.get_encoder(), self.renditions)
+        renditions = {rendition["name"]: os.path.getsize(rendition_file(job.videofile, rendition))
+                      for rendition in self.renditions}
+        return {"frames": frames, "bytes": os.path.getsize(job.videofile), "renditions": renditions}
+
+    def stage_upload(self, job):
+        video_id = upload_video(self.get_session(), job.videofile, YOUTUBE_TITLE, job.daystr, YOUTUBE_DESCRIPTION,
+                                YOUTUBE_VIDEO_TAGS, YOUTUBE_CATEGORY_ID, YOUTUBE_PRIVACY)
+        return {"video_id": video_id}
+
+    def stage_cleanup(self, job):
+        if os.path.isdir(job.imgdir):
+            cleanup_images(CLEANUP_IMAGES, job.imgdir)
+        blockdir = get_block_dir(VIDEO_OUTPUT_PATH, job.daystr)
+        if os.path.isdir(blockdir):
+            cleanup_images(CLEANUP_IMAGES, blockdir)
+        return {}
+
+    def run_stage(self, job, stage):
+        attempts = job.journal["stages"].get(stage, {}).get("attempts", 0) + 1
+        print(f"[{job.daystr}] Starting {stage} (attempt {attempts})...")
+        job.record(stage, status="running", attempts=attempts, started=datetime.now().isoformat(), error=None)
+        start = time.monotonic()
+        try:
+            result = getattr(self, "stage_" + stage)(job)
+        except Exception as e:
+            print(f"[{job.daystr}] {stage} failed: {e}")
+            job.record(stage, status="failed", seconds=time.monotonic() - start, error=str(e))
+            return False
+        job.record(stage, status="done", seconds=time.monotonic() - start,
+                   finished=datetime.now().isoformat(), result=result)
+        print(f"[{job.daystr}] Finished {stage} in {time.monotonic() - start:.1f}s")
+        return True
+
+    def run(self, jobs):
+        """Runs every unfinished stage of jobs, oldest day first. Returns True if all of them finished."""
+        pending = [(job, stage) for job in jobs for stage in STAGES if not job.is_done(stage)]
+        failed = set()
+        running = {}
+        with ThreadPoolExecutor(max_workers=len({lane for _, lane in STAGES.values()})) as pool:
+            while pending or running:
+                busy = {STAGES[stage][1] for _, stage in running.values()}
+                for job, stage in list(pending):
+                    needs, lane = STAGES[stage]
+                    if any((job.daystr, need) in failed for need in needs):
+                        # A stage whose dependency failed waits for the next run
+                        failed.add((job.daystr, stage))
+                        pending.remove((job, stage))
+                    elif lane not in busy and all(job.is_done(need) for need in needs):
+                        running[pool.submit(self.run_stage, job, stage)] = (job, stage)
+                        pending.remove((job, stage))
+                        busy.add(lane)
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, stage = running.pop(future)
+                    if not future.result():
+                        failed.add((job.daystr, stage))
+        return not failed and not pending
+
+def find_pending_days():
+    """Returns the days before today within BACKFILL_DAYS that have images or an unfinished journal, oldest first."""
+    tz = pytz.timezone(TIMEZONE)
+    today = datetime.now(tz).date()
+    names = set()
+    for root in (TIMELAPSE_IMAGE_PATH, VIDEO_OUTPUT_PATH):
+        if os.path.isdir(root):
+            names.update(os.listdir(root))
+    days = []
+    for name in names:
+        try:
+            day = datetime.strptime(name, '%d-%m-%Y').date()
+        except ValueError:
+            continue
+        if 0 < (today - day).days <= BACKFILL_DAYS:
+            days.append((day, name))
+    return [name for _, name in sorted(days) if not DayJob(name).is_complete()]
+
+def prune_finished_days():
+    """Deletes the video directories of finished days older than KEEP_DAYS.
+
+    A day still inside BACKFILL_DAYS is never pruned: with its journal gone, images left
+    behind (CLEANUP_IMAGES=false) would make it look unfinished, and it would be encoded and
+    uploaded again.
+    """
+    if not KEEP_DAYS or not os.path.isdir(VIDEO_OUTPUT_PATH):
+        return
+    keep = max(KEEP_DAYS, BACKFILL_DAYS)
+    today = datetime.now(pytz.timezone(TIMEZONE)).date()
+    for name in os.listdir(VIDEO_OUTPUT_PATH):
+        try:
+            day = datetime.strptime(name, '%d-%m-%Y').date()
+        except ValueError:
+            continue
+        if (today - day).days > keep and DayJob(name).is_complete():
+            print(f"Deleting videos of {name}, finished more than {keep} days ago...")
+            shutil.rmtree(get_day_dir(VIDEO_OUTPUT_PATH, name), ignore_errors=True)
 
 if __name__ == "__main__":
-    # Create a variable with yesterday's date string in it
-    YESTERDAY_STRING = get_yesterdays_date(TIMEZONE)
-    # Creare the full path to process using the image path and yesterdays date
-    IMGDIR = TIMELAPSE_IMAGE_PATH + "/" + YESTERDAY_STRING
-    # Check if the directory exists
-    if os.path.isdir(IMGDIR):
-        print(f"The directory {IMGDIR} exists, beginning processing...")
-        # Create timelapse video
-        create_timelapse_video(IMGDIR, VIDEO_OUTPUT_PATH)
-        # Clean up images
-        cleanup_images(CLEANUP_IMAGES, IMGDIR)
-        # Authenticate to Youtube
-        youtube = get_authenticated_service()
-        # Upload video to Youtube
-        upload_video(youtube, VIDEO_OUTPUT_PATH + "/tmp.mp4", YOUTUBE_TITLE, YESTERDAY_STRING, YOUTUBE_DESCRIPTION, YOUTUBE_VIDEO_TAGS, YOUTUBE_CATEGORY_ID, YOUTUBE_PRIVACY)
-    else:
-        print(f"The directory {IMGDIR} does not exist, nothing to do.")
+    parser = argparse.ArgumentParser(description="Dunedin-Live timelapse stitcher")
+    parser.add_argument("--blocks-only", action="store_true",
+                        help="encode completed blocks of today and yesterday, then exit")
+    parser.add_argument("--day", action="append", metavar="DD-MM-YYYY",
+                        help="process this day instead of every pending day (can be repeated)")
+    parser.add_argument("--benchmark-encoders", action="store_true",
+                        help="benchmark every available encoder on synthetic frames, then exit")
+    parser.add_argument("--frames", type=int, default=120, help="number of frames for the benchmarks")
+    parser.add_argument("--size", default="3840x2160", help="frame size for the benchmarks")
+    parser.add_argument("--benchmark-parallel", action="store_true",
+                        help="compare single-process and parallel segment encoding, then exit")
+    parser.add_argument("--benchmark-renditions", action="store_true",
+                        help="compare single-decode rendition encoding with separate runs, then exit")
+    parser.add_argument("--benchmark-quality", action="store_true",
+                        help="time the frame quality check against encoding the same frames, then exit")
+    args = parser.parse_args()
+
+    if args.benchmark_quality:
+        run_quality_benchmark(args.frames, args.size)
+        raise SystemExit(0)
+
+    if args.benchmark_renditions:
+        run_rendition_benchmark(args.frames, args.size)
+        raise SystemExit(0)
+
+    if args.benchmark_parallel:
+        run_parallel_benchmark(args.frames, args.size)
+        raise SystemExit(0)
+
+    if args.benchmark_encoders:
+        run_encoder_benchmark(args.frames, args.size)
+        raise SystemExit(0)
+
+    renditions = load_renditions(RENDITIONS_CONFIG)
+
+    if args.blocks_only:
+        encoder = select_encoder()
+        tz = pytz.timezone(TIMEZONE)
+        for day in (datetime.now(tz) - timedelta(days=1), datetime.now(tz)):
+            daystr = day.strftime('%d-%m-%Y')
+            imgdir = TIMELAPSE_IMAGE_PATH + "/" + daystr
+            if os.path.isdir(imgdir):
+                encode_pending_blocks(imgdir, VIDEO_OUTPUT_PATH, daystr, encoder, renditions)
+        raise SystemExit(0)
+
+    # Nightly runs and manual backfills must not work on the same days at once
+    os.makedirs(VIDEO_OUTPUT_PATH, exist_ok=True)
+    with open(os.path.join(VIDEO_OUTPUT_PATH, ".pipeline.lock"), 'w') as lockfile:
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("Another stitcher run is in progress, nothing to do.")
+            raise SystemExit(0)
+
+        days = args.day or find_pending_days()
+        if not days:
+            print("No days need processing, nothing to do.")
+        else:
+            print(f"Processing {', '.join(days)}...")
+        finished = Pipeline(renditions).run([DayJob(daystr) for daystr in days])
+        prune_finished_days()
+    raise SystemExit(0 if finished else 1)
@@ -4,6 +4,9 @@ import ast
 import json
 import os
 import time
+import argparse
+import tracemalloc
+import concurrent.futures
 from requests.auth import HTTPBasicAuth
 
 # Load environment variables with defaults where appropriate
@@ -20,46 +23,132 @@ cameraPassword = os.getenv('CAMERA_PASSWORD')
 
 updateFreq = int(os.getenv('UPDATE_INTERVAL', 600))  # Seconds between updates
 
-# Validate required environment variables
-required_vars = {
-    "MET_API_KEY": metserviceApiKey,
-    "MET_LAT": lat,
-    "MET_LON": lon,
-    "CAMERA_URL": cameraUrl,
-    "CAMERA_USERNAME": cameraUsername,
-    "CAMERA_PASSWORD": cameraPassword
-}
+# Seconds each source has to answer before its last good value is used instead
+metDeadline = float(os.getenv('MET_DEADLINE', 8))
+portotagoDeadline = float(os.getenv('PO_DEADLINE', 8))
 
-missing = [var for var, val in required_vars.items() if not val]
+# Seconds a source's value is reused before asking the source again, however short UPDATE_INTERVAL is
+metMinInterval = int(os.getenv('MET_MIN_INTERVAL', 300))
+portotagoMinInterval = int(os.getenv('PO_MIN_INTERVAL', 60))
 
-if missing:
-    raise RuntimeError(f"Missing required environment variables: {', '.join(missing)}")
+# Seconds a last good value can stand in for a slow or failed source
+cacheMaxAge = int(os.getenv('CACHE_MAX_AGE', 1800))
 
-# Timestamp helper
-def ts():
-    return time.strftime("[%Y-%m-%d %H:%M:%S]")
+# Minimum seconds between camera OSD pushes; quicker changes are held and only the latest is sent
+osdMinInterval = int(os.getenv('OSD_MIN_INTERVAL', 60))
 
-def get_met_obs(metserviceApi, metserviceApiKey, lat, lon, userAgent):
-    """Fetch weather data from Metservice API."""
+# Seconds after which unchanged text is pushed again, in case the camera's OSD was changed or reset
+osdMaxAge = int(os.getenv('OSD_MAX_AGE', 3600))
 
-    headers = {
-        'Accept': '*/*',
-        'User-Agent': userAgent,
-        'Accept-Language': 'en-CA;q=1.0',
-        'Accept-Encoding': 'br;q=1.0, gzip;q=0.9, deflate;q=0.8',
-        'Connection': 'keep-alive',
-        'apiKey': metserviceApiKey
+# Most of the Port Otago page read while looking for the wind data
+portotagoMaxBytes = int(os.getenv('PO_MAX_BYTES', 2 * 1024 * 1024))
+
+def check_required_vars():
+    """Validate required environment variables."""
+    required_vars = {
+        "MET_API_KEY": metserviceApiKey,
+        "MET_LAT": lat,
+        "MET_LON": lon,
+        "CAMERA_URL": cameraUrl,
+        "CAMERA_USERNAME": cameraUsername,
+        "CAMERA_PASSWORD": cameraPassword
     }
 
-    fullmetserviceApi = f"{metserviceApi}/{lat}/{lon}"
+    missing = [var for var, val in required_vars.items() if not val]
 
-    try:
-        response = requests.get(fullmetserviceApi, headers=headers, timeout=10)
+    if missing:
+        raise RuntimeError(f"Missing required environment variables: {', '.join(missing)}")
+
+# Timestamp helper
+def ts():
+    return time.strftime("[%Y-%m-%d %H:%M:%S]")
+
+class WxSource:
+    """One upstream weather source, fetched over a persistent session.
+
+    Requests are conditional (If-None-Match/If-Modified-Since), so an unchanged answer is a
+    304 and is parsed from the cached value. The last good value is kept for cacheMaxAge
+    seconds, and is reused without asking the source at all for minInterval seconds.
+    """
+
+    def __init__(self, name, url, headers, parse, deadline, minInterval, stream=False):
+        self.name = name
+        self.url = url
+        self.parse = parse
+        # Streamed responses are handed to parse unread, to read as little of them as it needs
+        self.stream = stream
+        self.deadline = deadline
+        self.minInterval = minInterval
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        self.etag = None
+        self.lastModified = None
+        self.value = None
+        self.fetchedAt = 0
+        self.pending = None
+
+    def fetch(self):
+        """Fetch and parse the source, returning the new value. Raises on any failure."""
+        headers = {}
+        if self.value is not None:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.lastModified:
+                headers['If-Modified-Since'] = self.lastModified
+        response = self.session.get(self.url, headers=headers, timeout=self.deadline, stream=self.stream)
+        if response.status_code == 304 and self.value is not None:
+            self.fetchedAt = time.time()
+            return self.value
         response.raise_for_status()
-    except requests.RequestException as e:
-        print(f"{ts()} Network/API error while fetching weather data: {e}")
+        value = self.parse(response)
+        if value is None:
+            raise ValueError("no usable data in response")
+        self.value = value
+        self.etag = response.headers.get('ETag')
+        self.lastModified = response.headers.get('Last-Modified')
+        self.fetchedAt = time.time()
+        return value
+
+    def cached(self):
+        """The last good value, if it is recent enough to stand in for the source."""
+        if self.value is not None and time.time() - self.fetchedAt < cacheMaxAge:
+            return self.value
         return None
 
+# Fetches run on their own threads so one slow source doesn't hold up the other
+fetchPool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+def fetch_all(sources):
+    """Fetch every source at once, each against its own deadline, falling back to its last good value."""
+    started = time.time()
+    fresh = [source.value is not None and started - source.fetchedAt < source.minInterval for source in sources]
+    for source, isFresh in zip(sources, fresh):
+        # A fetch still hung from an earlier update is waited on rather than doubled up
+        if not isFresh and (source.pending is None or source.pending.done()):
+            print(f"{ts()} Fetching weather data from {source.url}...")
+            source.pending = fetchPool.submit(source.fetch)
+
+    results = []
+    for source, isFresh in zip(sources, fresh):
+        if isFresh:
+            results.append(source.value)
+            continue
+        try:
+            results.append(source.pending.result(timeout=max(0, started + source.deadline - time.time())))
+            continue
+        except concurrent.futures.TimeoutError:
+            print(f"{ts()} {source.name} did not answer within {source.deadline:.0f}s")
+        except (requests.RequestException, ValueError) as e:
+            print(f"{ts()} Network/API error fetching {source.name} data: {e}")
+        value = source.cached()
+        if value is not None:
+            print(f"{ts()} Using {source.name} data from {time.time() - source.fetchedAt:.0f}s ago")
+        results.append(value)
+    return results
+
+def parse_met_obs(response):
+    """Parse a Metservice API response into the temperature and humidity line."""
+
     try:
         data = response.json()
     except ValueError:
@@ -82,47 +171,162 @@ def get_met_obs(metserviceApi, metserviceApiKey, lat, lon, userAgent):
     return wxString1
 
 
-def get_portotago_obs(portotagoApi, userAgent):
-
-    headers = {
-        "User-Agent": userAgent
-    }
-
-    # knots to km/hr conversion
-    kts_to_kmh = 1.852
-
+# Start of the Port Otago wind data object, up to its opening brace
+infoConfigStart = re.compile(rb"const\s+infoConfig\s*=\s*\{")
+
+# Characters that matter while finding the end of the object
+infoConfigSpecial = re.compile(rb"[{}\"'\\]")
+
+def extract_info_config(chunks, maxBytes):
+    """Return the text of the first `const infoConfig = {...}` object in a stream of byte chunks.
+
+    Stops reading as soon as the object's closing brace arrives, or after maxBytes. Braces
+    inside quoted strings are skipped. Only a short tail of the page is kept until the object
+    starts, so memory use doesn't grow with the page.
+    """
+    buffer = bytearray()
+    start = None
+    scan = 0
+    depth = 0
+    quote = None
+    read = 0
+    for chunk in chunks:
+        read += len(chunk)
+        buffer += chunk
+        if start is None:
+            match = infoConfigStart.search(buffer)
+            if not match:
+                # Enough to catch the marker split across two chunks
+                del buffer[:max(0, len(buffer) - 64)]
+            else:
+                start = scan = match.end() - 1
+        if start is not None:
+            for special in infoConfigSpecial.finditer(buffer, scan):
+                position = special.start()
+                if position < scan:
+                    # The character after a backslash
+                    continue
+                char = special.group()
+                if quote:
+                    if char == b"\\":
+                        scan = position + 2
+                    elif char == quote:
+                        quote = None
+                elif char in (b'"', b"'"):
+                    quote = char
+                elif char == b"{":
+                    depth += 1
+                elif char == b"}":
+                    depth -= 1
+                    if depth == 0:
+                        return buffer[start:position + 1].decode('utf-8', errors='replace')
+            scan = max(scan, len(buffer))
+        if read >= maxBytes:
+            print(f"{ts()} Warning: No complete infoConfig in the first {maxBytes} bytes")
+            return None
+    return None
+
+# Tokens of a JavaScript/Python object literal
+literalToken = re.compile(r"""\s*(?:([{}\[\],:])|("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')"""
+                          r"""|(-?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)|([A-Za-z_$][\w$]*))""", re.S)
+
+literalNames = {'true': True, 'True': True, 'false': False, 'False': False, 'null': None, 'None': None}
+
+def parse_literal(text):
+    """Parse an object literal of dicts, lists, quoted strings, numbers and true/false/null.
+
+    JSON goes straight to the json module. Anything else (single quotes, bare keys, trailing
+    commas) is tokenised with one regex and parsed here; unlike ast.literal_eval, nothing is
+    compiled. Raises ValueError on anything else.
+    """
     try:
-        response = requests.get(portotagoApi, headers=headers, timeout=10)
-        response.raise_for_status()
-    except requests.RequestException as e:
-        print(f"{ts()} Network error fetching Port Otago data: {e}")
-        return None
+        return json.loads(text)
+    except ValueError:
+        pass
+
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = literalToken.match(text, position)
+        if not match or match.end() == position:
+            raise ValueError(f"Unexpected character at {position}")
+        tokens.append(match.groups())
+        position = match.end()
+        while position < len(text) and text[position].isspace():
+            position += 1
+
+    def string(token):
+        if token[0] == "'":
+            # Re-quote a single-quoted string so json can decode its escapes
+            inner = re.sub(r"""\\(.)|\"""", lambda m: "'" if m.group(1) == "'" else '\\"' if m.group(1) is None
+                           else "\\" + m.group(1), token[1:-1], flags=re.S)
+            token = f'"{inner}"'
+        return json.loads(token)
+
+    def value(index):
+        punct, quoted, number, name = tokens[index]
+        if quoted:
+            return string(quoted), index + 1
+        if number:
+            return (float(number) if any(c in number for c in '.eE') else int(number)), index + 1
+        if name:
+            if name not in literalNames:
+                raise ValueError(f"Unexpected name {name}")
+            return literalNames[name], index + 1
+        if punct == '[':
+            items = []
+            index += 1
+            while tokens[index][0] != ']':
+                item, index = value(index)
+                items.append(item)
+                if tokens[index][0] == ',':
+                    index += 1
+                elif tokens[index][0] != ']':
+                    raise ValueError("Expected , or ]")
+            return items, index + 1
+        if punct == '{':
+            items = {}
+            index += 1
+            while tokens[index][0] != '}':
+                keyPunct, keyQuoted, keyNumber, keyName = tokens[index]
+                key = string(keyQuoted) if keyQuoted else keyName or keyNumber
+                if key is None or tokens[index + 1][0] != ':':
+                    raise ValueError("Expected a key and :")
+                items[key], index = value(index + 2)
+                if tokens[index][0] == ',':
+                    index += 1
+                elif tokens[index][0] != '}':
+                    raise ValueError("Expected , or }")
+            return items, index + 1
+        raise ValueError(f"Unexpected {punct}")
 
-    html = response.text
+    try:
+        result, index = value(0)
+    except IndexError:
+        raise ValueError("Unexpected end of literal")
+    if index != len(tokens):
+        raise ValueError("Unexpected data after literal")
+    return result
 
-    # This looks for 'const infoConfig = ' and captures the '{...}' before the ';'
-    matches = re.findall(r"const infoConfig\s*=\s*(\{.*?\});", html)
+def wind_from_info_config(info):
+    """Turn the Port Otago wind data object into the wind line."""
 
-    weather_data = []
-    for match in matches:
-        try:
-            parsed_dict = ast.literal_eval(match)
-            weather_data.append(parsed_dict)
-        except Exception:
-            continue
+    # knots to km/hr conversion
+    kts_to_kmh = 1.852
 
-    if not weather_data or 'values' not in weather_data[0]:
+    if not isinstance(info, dict) or 'values' not in info:
         return None
 
     try:
-        kts_speed = float(weather_data[0]['values'][0]['current_value'])
-        kts_gust = float(weather_data[0]['values'][1]['current_value'])
+        kts_speed = float(info['values'][0]['current_value'])
+        kts_gust = float(info['values'][1]['current_value'])
 
         # Convert KTS to KMH
         windSpeed = str(round(kts_speed * kts_to_kmh))
         windGustSpeed = str(round(kts_gust * kts_to_kmh))
-        windDirection = weather_data[0]['values'][2]['metadata']
-    except (IndexError, KeyError, ValueError):
+        windDirection = info['values'][2]['metadata']
+    except (IndexError, KeyError, ValueError, TypeError):
         return None
 
     # FIXED: Replaced brittle string manipulation with safe f-string substitution and defaults
@@ -133,11 +337,86 @@ def get_portotago_obs(portotagoApi, userAgent):
     wxString2 = f"W: {wd} {ws}-{wg} kph"
     return wxString2
 
-def updateOSD(cameraUrl, cameraUsername, cameraPassword, wxString1, wxString2):
-    """Send updated weather info to the camera OSD."""
+def parse_portotago_obs(response):
+    """Parse a streamed Port Otago graph page into the wind line, parsing only up to the wind data.
+
+    The rest of the page is read and discarded, up to another PO_MAX_BYTES, so the connection
+    goes back to the session's pool; a longer page has its connection closed instead.
+    """
+    try:
+        chunks = response.iter_content(16384)
+        text = extract_info_config(chunks, portotagoMaxBytes)
+        if text is not None:
+            drained = 0
+            for chunk in chunks:
+                drained += len(chunk)
+                if drained > portotagoMaxBytes:
+                    break
+    finally:
+        # Releases a fully read connection to the pool, and closes one with unread data
+        response.close()
+    if text is None:
+        return None
     try:
-        # FIXED: Reverted back to triple quotes for valid Python multiline f-string formatting
-        xml_data_raw = f"""<?xml version="1.0" encoding="UTF-8"?>
+        return wind_from_info_config(parse_literal(text))
+    except ValueError as e:
+        print(f"{ts()} Error: Could not parse Port Otago infoConfig: {e}")
+        return None
+
+def benchmark_portotago_parser(pages, repeats=20):
+    """Time and measure the Port Otago parser against the old whole-page regex and ast.literal_eval."""
+
+    def legacy(html):
+        weather_data = []
+        for match in re.findall(r"const infoConfig\s*=\s*(\{.*?\});", html):
+            try:
+                weather_data.append(ast.literal_eval(match))
+            except Exception:
+                continue
+        return wind_from_info_config(weather_data[0]) if weather_data else None
+
+    def streamed(data):
+        chunks = (data[i:i + 16384] for i in range(0, len(data), 16384))
+        text = extract_info_config(chunks, portotagoMaxBytes)
+        return wind_from_info_config(parse_literal(text)) if text else None
+
+    samples = []
+    for page in pages:
+        with open(page, 'rb') as f:
+            samples.append((os.path.basename(page), f.read()))
+    if not samples:
+        # A graph fragment with its wind data near the top, then more graphs and scripts
+        info = ("{'title': 'Wind', 'unit': 'kts', 'values': [{'label': 'Speed', 'current_value': '12.4'}, "
+                "{'label': 'Gust', 'current_value': '18.9'}, {'label': 'Direction', 'metadata': 'SW', "
+                "'note': 'braces {in} a \\'string\\''}], 'history': [" + ", ".join(str(i % 40) for i in range(500)) + "]}")
+        graph = f"<div class='graph'><script>const infoConfig = {info};</script></div>\n"
+        filler = "<div class='row'><span>" + "x" * 200 + "</span></div>\n"
+        for size in (100_000, 1_000_000, 10_000_000):
+            body = filler * 20 + graph
+            while len(body) < size:
+                body += graph + filler * 50
+            samples.append((f"synthetic {size // 1000} kB", body.encode()))
+
+    print(f"{'page':<22}{'size':>10}{'old':>12}{'old peak':>12}{'new':>12}{'new peak':>12}")
+    for name, data in samples:
+        results = []
+        for parse, argument in ((legacy, data.decode('utf-8', errors='replace')), (streamed, data)):
+            started = time.perf_counter()
+            for _ in range(repeats):
+                result = parse(argument)
+            elapsed = (time.perf_counter() - started) / repeats
+            tracemalloc.start()
+            parse(argument)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results.append((result, elapsed, peak))
+        (old, oldTime, oldPeak), (new, newTime, newPeak) = results
+        match = "" if old == new else f"  MISMATCH {old!r} != {new!r}"
+        print(f"{name:<22}{len(data) / 1000:>8.0f}kB{oldTime * 1000:>10.2f}ms{oldPeak / 1000:>10.0f}kB"
+              f"{newTime * 1000:>10.2f}ms{newPeak / 1000:>10.0f}kB  {new}{match}")
+
+# The camera's OSD config. It is rendered once; only the text overlay's CDATA changes between pushes
+osdXmlTemplate = """<?xml version="1.0" encoding="UTF-8"?>
         <config xmlns="http://www.ipc.com/ver10" version="1.7">
           <types>
             <dateFormat>
@@ -180,8 +459,7 @@ def updateOSD(cameraUrl, cameraUsername, cameraPassword, wxString1, wxString2):
                 <showLevel type="uint32">0</showLevel>
                 <flickerSwitch type="boolean">true</flickerSwitch>
                 <osdOverlayType type="osdOverlayType">TEXT</osdOverlayType>
-                <value type="string" maxLen="32"><![CDATA[{wxString1}
-{wxString2}]]></value>
+                <value type="string" maxLen="32"><![CDATA[{text}]]></value>
               </item>
               <item>
                 <switch type="boolean">false</switch>
@@ -205,41 +483,154 @@ def updateOSD(cameraUrl, cameraUsername, cameraPassword, wxString1, wxString2):
           </imageOsd>
         </config>"""
 
-        headers = {"Content-Type": "application/xml"}
-        response = requests.post(
+osdHead, _, osdTail = (part.encode('utf-8') for part in osdXmlTemplate.partition("{text}"))
+
+def render_osd(text):
+    """The OSD config document with `text` spliced into the weather overlay."""
+    # A "]]>" in the text would end the CDATA section early
+    return osdHead + text.replace("]]>", "]]]]><![CDATA[>").encode('utf-8') + osdTail
+
+def updateOSD(session, cameraUrl, body):
+    """Send a rendered OSD config to the camera. Returns whether the camera accepted it."""
+    try:
+        response = session.post(
             cameraUrl,
-            data=xml_data_raw.encode('utf-8'),
-            headers=headers,
-            auth=HTTPBasicAuth(cameraUsername, cameraPassword),
+            data=body,
+            headers={"Content-Type": "application/xml"},
             verify=False,
             timeout=10
         )
         response.raise_for_status()
         print(f"{ts()} Camera OSD updated successfully (HTTP {response.status_code})")
+        return True
 
     except requests.RequestException as e:
         print(f"{ts()} Camera update failed: {e}")
     except Exception as e:
         print(f"{ts()} Unexpected error updating camera: {type(e).__name__}: {e}")
+    return False
+
+class OsdPusher:
+    """Pushes weather text to the camera OSD only when it changes.
+
+    Every push makes the camera rewrite its OSD config, so text identical to what the camera
+    last accepted is skipped, unless it was pushed more than maxAge seconds ago. Pushes are
+    at least minInterval seconds apart: text arriving sooner is held, and only the latest
+    held text is sent once the interval has passed.
+    """
+
+    def __init__(self, cameraUrl, cameraUsername, cameraPassword, minInterval, maxAge):
+        self.cameraUrl = cameraUrl
+        self.minInterval = minInterval
+        self.maxAge = maxAge
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(cameraUsername, cameraPassword)
+        self.applied = None
+        self.appliedAt = 0
+        self.pushedAt = 0
+        self.pending = None
+        self.sent = 0
+        self.skipped = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    def counts(self):
+        return f"{self.sent} sent, {self.skipped} skipped, {self.coalesced} coalesced, {self.failed} failed"
+
+    def push(self, wxString1, wxString2):
+        text = f"{wxString1}\n{wxString2}"
+        if text == self.applied and time.time() - self.appliedAt < self.maxAge:
+            self.skipped += 1
+            if self.pending is not None:
+                # The text went back to what the camera already shows
+                self.pending = None
+                self.coalesced += 1
+            print(f"{ts()} Camera OSD already shows this. Skipping update ({self.counts()})")
+            return
+        if self.pending is not None:
+            self.coalesced += 1
+        self.pending = text
+        self.flush()
+
+    def due(self):
+        """When the held text can be sent, or None if nothing is held."""
+        return None if self.pending is None else self.pushedAt + self.minInterval
+
+    def flush(self):
+        """Send the held text if the minimum interval has passed."""
+        if self.pending is None:
+            return
+        if time.time() < self.due():
+            print(f"{ts()} Holding camera OSD update for {self.due() - time.time():.0f}s ({self.counts()})")
+            return
+        text, self.pending = self.pending, None
+        print(f"{ts()} Updating Camera OSD at {self.cameraUrl}...")
+        self.pushedAt = time.time()
+        if updateOSD(self.session, self.cameraUrl, render_osd(text)):
+            self.applied = text
+            self.appliedAt = self.pushedAt
+            self.sent += 1
+        else:
+            # Sent again with the next update, as the camera doesn't have it yet
+            self.failed += 1
+
+metSource = WxSource(
+    "MetService",
+    f"{metserviceApi}/{lat}/{lon}",
+    {
+        'Accept': '*/*',
+        'User-Agent': userAgent,
+        'Accept-Language': 'en-CA;q=1.0',
+        'Accept-Encoding': 'br;q=1.0, gzip;q=0.9, deflate;q=0.8',
+        'Connection': 'keep-alive',
+        'apiKey': metserviceApiKey
+    },
+    parse_met_obs,
+    metDeadline,
+    metMinInterval
+)
+
+portotagoSource = WxSource(
+    "Port Otago",
+    portotagoApi,
+    {"User-Agent": userAgent},
+    parse_portotago_obs,
+    portotagoDeadline,
+    portotagoMinInterval,
+    stream=True
+)
+
+osd = OsdPusher(cameraUrl, cameraUsername, cameraPassword, osdMinInterval, osdMaxAge)
 
 def main_loop():
     while True:
+        nextUpdate = time.time() + updateFreq
         try:
-            print(f"{ts()} Fetching weather data from {metserviceApi} for lat {lat}, lon {lon}...")
-            wxString1 = get_met_obs(metserviceApi, metserviceApiKey, lat, lon, userAgent)
-            print(f"{ts()} Fetching weather data from {portotagoApi}...")
-            wxString2 = get_portotago_obs(portotagoApi, userAgent)
+            wxString1, wxString2 = fetch_all([metSource, portotagoSource])
             print(f"{ts()} Results -> MetService: {wxString1} | Port Otago: {wxString2}")
             if wxString1 and wxString2:
-                print(f"{ts()} Updating Camera OSD at {cameraUrl}...")
-                updateOSD(cameraUrl, cameraUsername, cameraPassword, wxString1, wxString2)
+                osd.push(wxString1, wxString2)
             else:
                 print(f"{ts()} No weather data available. Skipping camera update.")
 
+            # A held OSD update is sent as soon as it's allowed, rather than waiting for the next update
+            while (due := osd.due()) is not None and due < nextUpdate:
+                time.sleep(max(0, due - time.time()))
+                osd.flush()
+
         except Exception as e:
             print(f"{ts()} Unexpected error in main loop: {type(e).__name__}: {e}")
 
-        time.sleep(updateFreq)
+        time.sleep(max(0, nextUpdate - time.time()))
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dunedin-Live weather OSD updater")
+    parser.add_argument("--benchmark-parser", nargs="*", metavar="PAGE",
+                        help="time the Port Otago parser on saved pages (or synthetic ones), then exit")
+    args = parser.parse_args()
+
+    if args.benchmark_parser is not None:
+        benchmark_portotago_parser(args.benchmark_parser)
+        raise SystemExit(0)
+    check_required_vars()
     main_loop()
@@ -1,10 +1,19 @@
 import os
+import json
 import time
+import asyncio
+import argparse
+import tempfile
+import threading
 import datetime
+import itertools
+import collections
 import pytz
 import subprocess
 import google_auth_oauthlib.flow
 import googleapiclient.discovery
+import googleapiclient.errors
+import googleapiclient.http
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 import random
@@ -33,10 +42,62 @@ BACKOFF_FACTOR = int(os.getenv("BACKOFF_FACTOR", "2"))
 STREAM_TITLE = os.getenv("STREAM_TITLE")
 STREAM_DESCRIPTION = os.getenv("STREAM_DESCRIPTION")
 
-def get_next_rollover_time(timezone_str):
-    """Calculates the exact datetime of the next 3:00 AM or 3:00 PM."""
+# YouTube Data API endpoint, overridable to point the daemon at a local stand-in for testing
+YOUTUBE_API_URL = os.getenv("YOUTUBE_API_URL")
+
+# YouTube Data API units available per day (quota resets at midnight Pacific Time)
+DAILY_QUOTA = int(os.getenv("DAILY_QUOTA", "10000"))
+
+# Seconds a looked-up stream ID is reused; the ID for a stream key never changes, so this can be long
+STREAM_CACHE_TTL = int(os.getenv("STREAM_CACHE_TTL", "86400"))
+
+# Seconds a list of active broadcasts is reused; any broadcast change clears it sooner
+BROADCAST_CACHE_TTL = int(os.getenv("BROADCAST_CACHE_TTL", "60"))
+
+# Quota units per call, from the YouTube Data API cost table
+QUOTA_COSTS = {"list": 1, "insert": 50, "update": 50, "bind": 50, "transition": 50, "delete": 50}
+
+# Seconds before each rollover that the next broadcast is created and bound
+ROLLOVER_PREPARE_AHEAD = int(os.getenv("ROLLOVER_PREPARE_AHEAD", "300"))
+
+# Seconds allowed for the next broadcast to go live at a rollover before giving up on it
+ROLLOVER_TIMEOUT = int(os.getenv("ROLLOVER_TIMEOUT", "60"))
+
+# Most transitions to live requested for one broadcast at a rollover (each costs about 50 quota units)
+ROLLOVER_TRANSITIONS = int(os.getenv("ROLLOVER_TRANSITIONS", "4"))
+
+# Delay before restarting ffmpeg after it exits, doubled after each quick exit up to RESTART_DELAY_MAX
+RESTART_DELAY = float(os.getenv("RESTART_DELAY", "1"))
+RESTART_DELAY_MAX = float(os.getenv("RESTART_DELAY_MAX", "30"))
+
+# Seconds ffmpeg has to run for before the restart delay goes back to RESTART_DELAY
+RESTART_RESET_AFTER = 60
+
+# Seconds without ffmpeg's output advancing before it is treated as stalled and restarted (0 to disable)
+STALL_TIMEOUT = int(os.getenv("STALL_TIMEOUT", "20"))
+
+# Extra seconds allowed before a freshly started ffmpeg first produces output (RTSP setup and probing)
+STALL_STARTUP_GRACE = 15
+
+# Lowest acceptable output bitrate (kbps) over STALL_TIMEOUT seconds, below which ffmpeg is restarted (0 to disable)
+STALL_MIN_KBPS = int(os.getenv("STALL_MIN_KBPS", "0"))
+
+# Number of ffmpeg progress samples kept for the stats (ffmpeg reports about twice a second)
+PROGRESS_HISTORY = int(os.getenv("PROGRESS_HISTORY", "1200"))
+
+# Seconds between stream stats summaries in the log (0 to disable)
+STATS_INTERVAL = int(os.getenv("STATS_INTERVAL", "300"))
+
+# Port serving the stream stats as JSON while the daemon runs (0 to disable)
+STATS_PORT = int(os.getenv("STATS_PORT", "0"))
+
+# Address the stats port binds to (0.0.0.0 exposes it to other containers on the network)
+STATS_HOST = os.getenv("STATS_HOST", "127.0.0.1")
+
+def get_next_rollover_time(timezone_str, after=None):
+    """Calculates the exact datetime of the next 3:00 AM or 3:00 PM (after now, or after the given time)."""
     tz = pytz.timezone(timezone_str)
-    now = datetime.datetime.now(tz)
+    now = after.astimezone(tz) if after else datetime.datetime.now(tz)
 
     # Candidate times for today
     candidate_3am = now.replace(hour=3, minute=0, second=0, microsecond=0)
@@ -83,31 +144,142 @@ def get_authenticated_service():
         with open(f'{AUTH_TOKEN_PATH}/token.json', 'w') as token:
             token.write(creds.to_json())
 
-    youtube = googleapiclient.discovery.build('youtube', 'v3', credentials=creds)
+    youtube = build_youtube(credentials=creds)
     return youtube
 
+def build_youtube(api_url=YOUTUBE_API_URL, **auth):
+    client_options = {"api_endpoint": api_url} if api_url else None
+    return googleapiclient.discovery.build('youtube', 'v3', client_options=client_options,
+                                           requestBuilder=MeteredRequest, **auth)
+
+class QuotaMeter:
+    """Counts API calls, their latency and the quota units they cost, per Pacific Time day."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.day = None
+        self.calls = {}
+        self.warned = False
+
+    def record(self, method, seconds, status):
+        verb = method.rsplit(".", 1)[-1]
+        today = datetime.datetime.now(pytz.timezone("America/Los_Angeles")).date()
+        with self.lock:
+            if today != self.day:
+                self.day, self.calls, self.warned = today, {}, False
+            call = self.calls.setdefault(method, {"calls": 0, "units": 0, "not_modified": 0, "seconds": 0.0})
+            call["calls"] += 1
+            call["units"] += QUOTA_COSTS.get(verb, 1)
+            call["not_modified"] += status == 304
+            call["seconds"] += seconds
+            used = self.used()
+            if used >= self.budget * 0.8 and not self.warned:
+                self.warned = True
+                print(f"Warning: {used} of {self.budget} API quota units used today")
+
+    def used(self):
+        return sum(call["units"] for call in self.calls.values())
+
+    def report(self):
+        with self.lock:
+            return {
+                "day": str(self.day),
+                "used": self.used(),
+                "budget": self.budget,
+                "methods": {method: {**call, "avg_ms": 1000 * call["seconds"] / call["calls"]}
+                            for method, call in self.calls.items()},
+            }
+
+class MeteredRequest(googleapiclient.http.HttpRequest):
+    """HttpRequest that charges every call to the quota meter, and clears cached lists a change makes stale."""
+
+    def execute(self, http=None, num_retries=0):
+        start = time.monotonic()
+        status = None
+        try:
+            response = super().execute(http=http, num_retries=num_retries)
+            status = 200
+            return response
+        except googleapiclient.errors.HttpError as e:
+            status = e.resp.status
+            raise
+        finally:
+            quota.record(self.methodId, time.monotonic() - start, status)
+            resource, verb = self.methodId.split(".")[-2:]
+            if verb != "list":
+                api_cache.invalidate(resource)
+
+class ApiCache:
+    """Holds list results with the time they were fetched and, for single-page results, their ETag."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def store(self, key, items, etag):
+        with self.lock:
+            self.entries[key] = {"time": time.monotonic(), "items": items, "etag": etag}
+
+    def invalidate(self, resource=None):
+        with self.lock:
+            for key in [key for key in self.entries if resource is None or key[0] == resource]:
+                del self.entries[key]
+
+quota = QuotaMeter(DAILY_QUOTA)
+api_cache = ApiCache()
+
+def list_all(youtube, resource, ttl, **params):
+    """Lists every item of a resource across all pages, reusing a cached result for up to ttl seconds.
+
+    Once the cached result is stale it is revalidated with If-None-Match where it came from a
+    single page, so an unchanged list comes back as a 304 without its items.
+    """
+    key = (resource, tuple(sorted(params.items())))
+    entry = api_cache.get(key)
+    if entry and time.monotonic() - entry["time"] < ttl:
+        return entry["items"]
+
+    collection = getattr(youtube, resource)()
+    request = collection.list(maxResults=50, **params)
+    if entry and entry["etag"]:
+        request.headers["If-None-Match"] = entry["etag"]
+    items = []
+    pages = 0
+    while request is not None:
+        try:
+            response = request.execute()
+        except googleapiclient.errors.HttpError as e:
+            if e.resp.status != 304:
+                raise
+            api_cache.store(key, entry["items"], entry["etag"])
+            return entry["items"]
+        request.headers.pop("If-None-Match", None)
+        items.extend(response.get("items", []))
+        pages += 1
+        request = collection.list_next(request, response)
+    api_cache.store(key, items, response.get("etag") if pages == 1 else None)
+    return items
+
 @retry_with_exponential_backoff()
 def find_stream_id_by_key(youtube, stream_key):
-    request = youtube.liveStreams().list(
-        part="id,snippet,cdn",
-        mine=True
-    )
-    response = request.execute()
-    for stream in response.get('items', []):
+    for stream in list_all(youtube, "liveStreams", STREAM_CACHE_TTL, part="id,snippet,cdn", mine=True):
         cdn_info = stream.get('cdn', {})
         if cdn_info.get('ingestionInfo', {}).get('streamName') == stream_key:
             return stream['id']
+    # The stream may be newer than the cached list, so look again on the retry
+    api_cache.invalidate("liveStreams")
     raise ValueError("Stream key not found or 'cdn' information is missing")
 
 @retry_with_exponential_backoff()
 def find_broadcast_id_by_stream_id(youtube, stream_id):
-    request = youtube.liveBroadcasts().list(
-        part="id,contentDetails",
-        broadcastStatus="active",
-        broadcastType="all"
-    )
-    response = request.execute()
-    for broadcast in response.get('items', []):
+    broadcasts = list_all(youtube, "liveBroadcasts", BROADCAST_CACHE_TTL,
+                          part="id,contentDetails", broadcastStatus="active", broadcastType="all")
+    for broadcast in broadcasts:
         if broadcast['contentDetails']['boundStreamId'] == stream_id:
             return broadcast['id']
     return None
@@ -131,8 +303,8 @@ def stop_broadcast_by_id(youtube, broadcast_id):
     request.execute()
 
 @retry_with_exponential_backoff()
-def start_new_broadcast(youtube, next_rollover_time):
-    current_time = datetime.datetime.now(pytz.timezone(TIMEZONE))
+def start_new_broadcast(youtube, next_rollover_time, start_time=None):
+    current_time = start_time or datetime.datetime.now(pytz.timezone(TIMEZONE))
     new_stream_title = f'{STREAM_TITLE}: {current_time.strftime("%d-%m-%Y %H:%M")} to {next_rollover_time.strftime("%H:%M")}'
 
     liveBroadcastStart = youtube.liveBroadcasts().insert(
@@ -149,7 +321,11 @@ def start_new_broadcast(youtube, next_rollover_time):
             "enableAutoStop": "false",
             "enableDvr": "true",
             "latencyPreference": "normal",
-            "recordFromStart": "true"
+            "recordFromStart": "true",
+            # Lets a prepared broadcast go straight from ready to live without a testing phase
+            "monitorStream": {
+              "enableMonitorStream": "false"
+            }
           },
           "status": {
             "privacyStatus": "public"
@@ -176,12 +352,348 @@ def unbind_stream_from_broadcast(youtube, broadcast_id):
     )
     liveBroadcastBind.execute()
 
-def run_ffmpeg_until(rtsp_url, stream_key, end_time, tz_str):
-    """Runs ffmpeg, monitors it for premature crashes, and terminates it exactly at end_time."""
-    youtube_rtmp_url = f"rtmp://a.rtmp.youtube.com/live2/{stream_key}"
-    tz = pytz.timezone(tz_str)
+def go_live(youtube, broadcast_id, timeout=ROLLOVER_TIMEOUT, attempts=ROLLOVER_TRANSITIONS):
+    """Transitions a prepared broadcast to live, polling quickly until it is live or timeout passes.
+
+    The broadcast's status is read first with a cheap list call. A transition (about 50 quota
+    units) is only requested while it is ready or testing, and at most `attempts` times; while
+    it is already starting (or auto-start got there first) it is just polled. Unlike the API
+    helpers above this does not back off for seconds at a time, since every retry here is time
+    the stream is offline.
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.25
+    transitions = 0
+    error = None
+    while True:
+        status = None
+        try:
+            response = youtube.liveBroadcasts().list(part="id,status", id=broadcast_id).execute()
+            status = response['items'][0]['status']['lifeCycleStatus']
+            if status == "live":
+                return
+            if status in ("ready", "testing") and transitions < attempts:
+                transitions += 1
+                youtube.liveBroadcasts().transition(broadcastStatus="live", id=broadcast_id, part="id,status").execute()
+                return
+        except Exception as e:
+            error = e
+        if status in ("ready", "testing") and transitions >= attempts:
+            raise RuntimeError(f"Broadcast {broadcast_id} still {status} after {attempts} transitions: {error}")
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Broadcast {broadcast_id} did not go live within {timeout}s: {error}")
+        time.sleep(delay)
+        delay = min(delay * 2, 2)
+
+def prepare_next_broadcast(youtube, stream_id, start_time, end_time):
+    """Creates the broadcast for the next cycle ahead of time and binds the stream to it."""
+    broadcast_id = start_new_broadcast(youtube, end_time, start_time)
+    bind_stream_to_broadcast(youtube, stream_id, broadcast_id)
+    return broadcast_id
+
+async def roll_over(youtube, stream_id, old_broadcast, next_broadcast, next_rollover, stats):
+    """Hands the running ingest from the old broadcast to the prepared one.
+
+    The new broadcast is transitioned to live as soon as the old one completes; the gap is the
+    time between the two. The API client is not thread safe, so the calls are not overlapped.
+    Returns the broadcast now live on the stream.
+    """
+    start = time.monotonic()
+    try:
+        await asyncio.to_thread(stop_broadcast_by_id, youtube, old_broadcast)
+    except Exception as e:
+        print(f"Warning: Failed to complete the old broadcast during rollover: {e}")
+    ended = time.monotonic()
+
+    try:
+        if not next_broadcast:
+            raise ValueError("no broadcast was prepared")
+        await asyncio.to_thread(go_live, youtube, next_broadcast)
+    except Exception as e:
+        # Fall back to creating one now, as the daemon used to at every rollover
+        print(f"Warning: Prepared broadcast did not go live ({e}). Creating new broadcast...")
+        next_broadcast = await asyncio.to_thread(start_new_broadcast, youtube, next_rollover)
+        await asyncio.to_thread(bind_stream_to_broadcast, youtube, stream_id, next_broadcast)
+        await asyncio.to_thread(go_live, youtube, next_broadcast)
+
+    live = time.monotonic()
+    stats.rolled_over(live - ended, live - start)
+    print(f"Rolled over from {old_broadcast} to {next_broadcast} in {live - start:.1f}s, "
+          f"gap between broadcasts {live - ended:.1f}s")
+    return next_broadcast
+
+async def run_rollovers(youtube, stream_id, active_broadcast, stats, next_rollover_time, prepare_ahead, count=None):
+    """Rolls the live broadcast over at each time next_rollover_time returns, with the ingest left running."""
+    rollovers = itertools.count() if count is None else range(count)
+    next_rollover = next_rollover_time()
+    for _ in rollovers:
+        following = next_rollover_time(next_rollover)
+        print(f"Daemon will roll over at: {next_rollover.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+        await sleep_until(next_rollover - datetime.timedelta(seconds=prepare_ahead))
+
+        print("Preparing the next broadcast...")
+        next_broadcast = None
+        try:
+            next_broadcast = await asyncio.to_thread(prepare_next_broadcast, youtube, stream_id,
+                                                     next_rollover, following)
+            print(f"Prepared broadcast {next_broadcast}, bound to the stream")
+        except Exception as e:
+            print(f"Warning: Failed to prepare the next broadcast, it will be created at rollover: {e}")
+
+        await sleep_until(next_rollover)
+        print("\n*** Scheduled rollover time reached! ***")
+        old_broadcast = active_broadcast
+        active_broadcast = await roll_over(youtube, stream_id, old_broadcast, next_broadcast, following, stats)
+        try:
+            await asyncio.to_thread(unbind_stream_from_broadcast, youtube, old_broadcast)
+        except Exception as e:
+            print(f"Warning: Failed to unbind the old broadcast: {e}")
+        next_rollover = following
+    return active_broadcast
+
+async def sleep_until(when):
+    await asyncio.sleep(max(0, (when - datetime.datetime.now(when.tzinfo)).total_seconds()))
+
+def parse_progress(fields):
+    """Turns one block of ffmpeg -progress key=value pairs into a stats sample."""
+    def number(key, suffix="", cast=float):
+        value = fields.get(key, "N/A").strip()
+        if value.endswith(suffix):
+            value = value[:len(value) - len(suffix)]
+        try:
+            return cast(value)
+        except ValueError:
+            return None
+
+    out_time_us = number("out_time_us", cast=int)
+    return {
+        "time": time.time(),
+        "frame": number("frame", cast=int),
+        "fps": number("fps"),
+        "bitrate_kbps": number("bitrate", "kbits/s"),
+        "total_size": number("total_size", cast=int),
+        "out_time": out_time_us / 1e6 if out_time_us is not None else None,
+        "dup_frames": number("dup_frames", cast=int),
+        "drop_frames": number("drop_frames", cast=int),
+        "speed": number("speed", "x")
+    }
+
+class StreamStats:
+    """Ring buffer of ffmpeg progress samples and process exits, readable while the stream runs."""
+
+    def __init__(self, history=PROGRESS_HISTORY):
+        self.samples = collections.deque(maxlen=history)
+        self.exits = collections.deque(maxlen=20)
+        self.recoveries = collections.deque(maxlen=20)
+        self.rollovers = collections.deque(maxlen=20)
+        self.restarts = 0
+        self.stalls = 0
+        self.process_started = None
+        self.last_advance = None
+        self.last_position = None
+        self.outage_started = None
+
+    def started(self):
+        self.process_started = time.time()
+        # Each ffmpeg process counts its frames and output time from zero
+        self.last_position = None
+
+    def add(self, sample):
+        self.samples.append(sample)
+        # Output has advanced when ffmpeg has written more video frames. Bytes keep growing from the
+        # synthetic audio track after the camera's video stops, so they are not counted. ffmpeg 7
+        # leaves frames out of the report for copied video, but also holds the audio back to the
+        # video, so there the output time stands in
+        position = sample["frame"] if sample["frame"] is not None else sample["out_time"]
+        if position is not None and (self.last_position is None or position > self.last_position):
+            self.last_position = position
+            self.last_advance = sample["time"]
+            if self.outage_started is not None:
+                recovery = sample["time"] - self.outage_started
+                self.recoveries.append({"time": sample["time"], "seconds": recovery})
+                self.outage_started = None
+                print(f"Stream output resumed {recovery:.1f}s after it stopped")
+
+    def rolled_over(self, gap, duration):
+        self.rollovers.append({"time": time.time(), "gap": gap, "duration": duration})
+
+    def stalled(self):
+        self.stalls += 1
 
-    ffmpeg_cmd = [
+    def throughput_kbps(self, window):
+        """Output bitrate over the last window seconds, from the growth of total_size."""
+        recent = [sample["total_size"] for sample in self.samples
+                  if sample["time"] >= time.time() - window and sample["total_size"] is not None]
+        return sum(max(0, b - a) for a, b in zip(recent, recent[1:])) * 8 / 1000 / window
+
+    def exited(self, returncode, runtime, planned=False):
+        self.exits.append({"time": time.time(), "returncode": returncode, "runtime": runtime, "planned": planned})
+        self.process_started = None
+        if not planned:
+            self.restarts += 1
+            if self.outage_started is None:
+                # The outage began when output last advanced, not when the failure was noticed
+                self.outage_started = self.last_advance or time.time()
+
+    def summary(self, window=60):
+        """Latest sample plus averages and frame counter deltas over the last window seconds."""
+        latest = self.samples[-1] if self.samples else None
+        recent = [sample for sample in self.samples if sample["time"] >= time.time() - window]
+
+        def average(key):
+            values = [sample[key] for sample in recent if sample[key] is not None]
+            return sum(values) / len(values) if values else None
+
+        def delta(key):
+            values = [sample[key] for sample in recent if sample[key] is not None]
+            # Counters restart with ffmpeg, so only count increases
+            return sum(max(0, b - a) for a, b in zip(values, values[1:])) if values else None
+
+        return {
+            "running": self.process_started is not None,
+            "uptime": time.time() - self.process_started if self.process_started else 0,
+            "restarts": self.restarts,
+            "stalls": self.stalls,
+            "last_exits": list(self.exits)[-5:],
+            "recoveries": list(self.recoveries)[-5:],
+            "rollovers": list(self.rollovers)[-5:],
+            "latest": latest,
+            "window": window,
+            "fps": average("fps"),
+            "bitrate_kbps": average("bitrate_kbps"),
+            "speed": average("speed"),
+            "dup_frames": delta("dup_frames"),
+            "drop_frames": delta("drop_frames")
+        }
+
+def format_summary(summary):
+    def value(key, fmt):
+        return format(summary[key], fmt) if summary[key] is not None else "n/a"
+    return (f"Stream {'up ' + format(summary['uptime'], '.0f') + 's' if summary['running'] else 'down'}, "
+            f"{value('fps', '.1f')} fps, {value('bitrate_kbps', '.0f')} kbps, speed {value('speed', '.2f')}x, "
+            f"{value('dup_frames', 'd')} dup / {value('drop_frames', 'd')} dropped frames in the last "
+            f"{summary['window']}s, {summary['restarts']} restarts ({summary['stalls']} stalls)")
+
+class FfmpegSupervisor:
+    """Runs an ffmpeg command until a deadline, restarting it as soon as it exits or stalls.
+
+    ffmpeg writes its machine-readable progress to stdout, which is parsed into stats; its
+    log still goes to stderr. Restarts back off from RESTART_DELAY to RESTART_DELAY_MAX,
+    except after a stall, which is restarted straight away.
+    """
+
+    def __init__(self, command, stats):
+        self.command = [*command[:1], "-nostats", "-progress", "pipe:1", *command[1:]]
+        self.stats = stats
+        self.killed = False
+
+    async def read_progress(self, stdout):
+        fields = {}
+        async for line in stdout:
+            key, _, value = line.decode("utf-8", "replace").strip().partition("=")
+            if key == "progress":
+                self.stats.add(parse_progress(fields))
+                fields = {}
+            elif key:
+                fields[key] = value
+
+    async def watch(self, process, started):
+        """Kills ffmpeg once its output has not advanced, or has been too slow, for STALL_TIMEOUT seconds.
+
+        An ffmpeg blocked on a dead RTSP source stops reporting progress entirely, so the time
+        since the last advance covers both a silent hang and a source that stopped sending.
+        Sets killed when it kills the process.
+        """
+        while process.returncode is None:
+            await asyncio.sleep(1)
+            now = time.time()
+            if self.stats.last_advance and self.stats.last_advance >= started:
+                silent = now - self.stats.last_advance
+                limit = STALL_TIMEOUT
+            else:
+                silent = now - started
+                limit = STALL_TIMEOUT + STALL_STARTUP_GRACE
+            if silent > limit:
+                reason = f"no output for {silent:.0f}s"
+            elif STALL_MIN_KBPS and now - started > STALL_TIMEOUT \
+                    and self.stats.throughput_kbps(STALL_TIMEOUT) < STALL_MIN_KBPS:
+                reason = f"output below {STALL_MIN_KBPS} kbps for {STALL_TIMEOUT}s"
+            else:
+                continue
+            if process.returncode is None:
+                print(f"FFmpeg has stalled ({reason}). Killing it...")
+                self.stats.stalled()
+                self.killed = True
+                process.kill()
+                return
+
+    async def stop(self, process):
+        if process.returncode is not None:
+            return
+        process.terminate()
+        try:
+            # Wait gracefully for it to wrap up
+            await asyncio.wait_for(process.wait(), 10)
+        except asyncio.TimeoutError:
+            print("FFmpeg didn't terminate gracefully. Forcing kill...")
+            process.kill()
+            await process.wait()
+
+    async def run_until(self, end_time=None):
+        """Supervises ffmpeg until end_time, or until cancelled when end_time is None."""
+        loop = asyncio.get_running_loop()
+        deadline = float("inf")
+        if end_time is not None:
+            deadline = loop.time() + (end_time - datetime.datetime.now(end_time.tzinfo)).total_seconds()
+        delay = RESTART_DELAY
+        while loop.time() < deadline:
+            process = await asyncio.create_subprocess_exec(*self.command, stdin=subprocess.DEVNULL,
+                                                           stdout=subprocess.PIPE)
+            self.stats.started()
+            started = loop.time()
+            self.killed = False
+            reader = asyncio.create_task(self.read_progress(process.stdout))
+            watchdog = asyncio.create_task(self.watch(process, time.time())) if STALL_TIMEOUT else None
+            try:
+                await asyncio.wait_for(asyncio.shield(process.wait()),
+                                       deadline - loop.time() if end_time is not None else None)
+            except asyncio.TimeoutError:
+                print("Run time reached. Terminating ffmpeg...")
+                if watchdog:
+                    watchdog.cancel()
+                await self.stop(process)
+                await reader
+                self.stats.exited(process.returncode, loop.time() - started, planned=True)
+                break
+            except asyncio.CancelledError:
+                print("Manual interrupt received. Terminating ffmpeg...")
+                if watchdog:
+                    watchdog.cancel()
+                await self.stop(process)
+                raise
+            await reader
+            runtime = loop.time() - started
+            self.stats.exited(process.returncode, runtime)
+            if watchdog:
+                # The watchdog only wakes once a second, so it is not waited for
+                watchdog.cancel()
+            if self.killed:
+                print("Restarting stalled ffmpeg now...")
+                delay = RESTART_DELAY
+                continue
+            if runtime >= RESTART_RESET_AFTER:
+                delay = RESTART_DELAY
+            # Check if ffmpeg exited unexpectedly (e.g. camera network drop)
+            print(f"FFmpeg exited prematurely with code {process.returncode} after {runtime:.1f}s! "
+                  f"Restarting in {delay:.1f} seconds...")
+            await asyncio.sleep(min(delay, max(0, deadline - loop.time())))
+            delay = min(delay * 2, RESTART_DELAY_MAX)
+
+def ffmpeg_command(rtsp_url, stream_key):
+    youtube_rtmp_url = f"rtmp://a.rtmp.youtube.com/live2/{stream_key}"
+    # The source is either the camera itself or the restreamer's shared stream over HTTP
+    transport = ["-rtsp_transport", "udp"] if rtsp_url.startswith("rtsp://") else []
+    return [
         "ffmpeg",
         "-err_detect", "ignore_err",
         "-probesize", "5000000",
@@ -189,7 +701,7 @@ def run_ffmpeg_until(rtsp_url, stream_key, end_time, tz_str):
         "-timeout", "5000000",
         "-use_wallclock_as_timestamps", "1",
         "-thread_queue_size", "5120",
-        "-rtsp_transport", "udp",
+        *transport,
         "-i", rtsp_url,
         "-thread_queue_size", "5120",
         "-f", "lavfi",
@@ -207,83 +719,361 @@ def run_ffmpeg_until(rtsp_url, stream_key, end_time, tz_str):
         youtube_rtmp_url
     ]
 
-    print(f"Starting ffmpeg stream to {youtube_rtmp_url}...")
-    process = subprocess.Popen(ffmpeg_cmd)
+async def run_ffmpeg(rtsp_url, stream_key, stats):
+    """Runs ffmpeg across rollovers, restarting it as soon as it crashes or stalls, until cancelled."""
+    print(f"Starting ffmpeg stream to rtmp://a.rtmp.youtube.com/live2/{stream_key}...")
+    await FfmpegSupervisor(ffmpeg_command(rtsp_url, stream_key), stats).run_until()
 
-    try:
-        while datetime.datetime.now(tz) < end_time:
-            # Check if ffmpeg exited unexpectedly (e.g. camera network drop)
-            if process.poll() is not None:
-                print("FFmpeg exited prematurely! Restarting in 5 seconds...")
-                time.sleep(5)
-                process = subprocess.Popen(ffmpeg_cmd)
-            time.sleep(1)
+def format_quota(report):
+    lines = [f"API quota: {report['used']} of {report['budget']} units used on {report['day']}"]
+    for method, call in sorted(report["methods"].items()):
+        lines.append(f"  {method}: {call['calls']} calls ({call['not_modified']} not modified), "
+                     f"{call['units']} units, {call['avg_ms']:.0f}ms average")
+    return "\n".join(lines)
 
-        print("Scheduled rollover time reached. Terminating ffmpeg...")
-        process.terminate()
+async def log_stats(stats):
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        print(format_summary(stats.summary(STATS_INTERVAL)))
+        print(format_quota(quota.report()))
+
+async def serve_stats(stats, host, port):
+    """Answers any HTTP request on host:port with the current stream stats as JSON (?window=N for the averages)."""
+    async def handle(reader, writer):
         try:
-            # Wait gracefully for it to wrap up
-            process.wait(timeout=10)
-        except subprocess.TimeoutExpired:
-            print("FFmpeg didn't terminate gracefully. Forcing kill...")
-            process.kill()
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass
+            parts = request.decode("latin-1").split()
+            window = 60
+            if len(parts) > 1 and "window=" in parts[1]:
+                window = int(parts[1].split("window=")[1].split("&")[0])
+            body = json.dumps({**stats.summary(window), "quota": quota.report()}, indent=2).encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                         + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
 
-    except KeyboardInterrupt:
-        print("Manual interrupt received. Terminating ffmpeg...")
-        process.terminate()
-        raise
+    server = await asyncio.start_server(handle, host=host, port=port)
+    print(f"Serving stream stats on {host}:{port}")
+    return server
+
+def serve_stalling_source(port, payload, seconds, stall_after, stalled_at):
+    """Streams an FLV payload in real time over HTTP; the first connection hangs after stall_after seconds.
+
+    Stands in for a camera that stops sending without closing the connection. The time the
+    stall begins is appended to stalled_at.
+    """
+    import http.server
 
-def main():
+    connections = itertools.count()
+    rate = len(payload) / seconds
+
+    class SourceHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            stall = next(connections) == 0
+            self.send_response(200)
+            self.send_header("Content-Type", "video/x-flv")
+            self.end_headers()
+            start = time.monotonic()
+            sent = 0
+            try:
+                while sent < len(payload):
+                    if stall and time.monotonic() - start >= stall_after:
+                        stalled_at.append(time.time())
+                        time.sleep(3600)
+                    target = min(len(payload), int((time.monotonic() - start + 0.1) * rate))
+                    self.wfile.write(payload[sent:target])
+                    sent = target
+                    time.sleep(0.1)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), SourceHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+async def run_stall_test(duration, stall_after, port):
+    """Supervises an ffmpeg ingest from a local source that hangs, and reports how fast the stall is recovered."""
+    with tempfile.NamedTemporaryFile(suffix=".flv") as source:
+        print(f"Generating {duration}s of test video...")
+        subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", "testsrc2=size=640x360:rate=25",
+                        "-t", str(duration), "-c:v", "libx264", "-preset", "ultrafast", "-g", "25",
+                        "-f", "flv", source.name], check=True)
+        payload = source.read()
+
+    stalled_at = []
+    server = serve_stalling_source(port, payload, duration, stall_after, stalled_at)
+    stats = StreamStats()
+    # The synthetic audio track keeps the muxer writing after the video stops, as in production
+    command = ["ffmpeg", "-v", "error", "-i", f"http://127.0.0.1:{port}/stream.flv",
+               "-f", "lavfi", "-i", "anullsrc=cl=mono:r=44100",
+               "-map", "0:v:0", "-map", "1:a:0", "-c:v", "copy", "-c:a", "aac", "-b:a", "8k",
+               "-f", "flv", "-y", os.devnull]
+    end_time = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=duration)
+    print(f"Source stalls after {stall_after}s, STALL_TIMEOUT is {STALL_TIMEOUT}s")
+    await FfmpegSupervisor(command, stats).run_until(end_time)
+    server.shutdown()
+
+    summary = stats.summary(duration)
+    print(format_summary(summary))
+    if not stalled_at or not summary["recoveries"]:
+        print("The stall was not recovered")
+        return
+    detected = next(exit["time"] for exit in summary["last_exits"] if not exit["planned"])
+    print(f"Stall detected {detected - stalled_at[0]:.1f}s after the source hung, "
+          f"output resumed {summary['recoveries'][0]['seconds']:.1f}s after it stopped")
+
+def serve_fake_youtube_api(port, stream_key, latency, other_streams=0):
+    """Serves the parts of the YouTube Live API the daemon uses, from memory, with a fixed response latency.
+
+    Models the lifecycle rules a rollover depends on: a broadcast can only go live from ready,
+    not while another broadcast on its stream is live, and a ready auto-start broadcast goes
+    live shortly after its stream becomes free. Lists are paged and answer If-None-Match with
+    a 304. The stream is listed after other_streams others. Returns the server and its broadcasts.
+    """
+    import http.server
+    import urllib.parse
+
+    lock = threading.Lock()
+    streams = [{"id": f"stream-{i + 2}", "cdn": {"ingestionInfo": {"streamName": f"other-{i}"}}}
+               for i in range(other_streams)]
+    streams.append({"id": "stream-1", "cdn": {"ingestionInfo": {"streamName": stream_key}}})
+    broadcasts = {}
+    ids = itertools.count(1)
+
+    def live_on(stream_id):
+        return [b for b in broadcasts.values()
+                if b["contentDetails"].get("boundStreamId") == stream_id and b["status"]["lifeCycleStatus"] == "live"]
+
+    def auto_start(stream_id):
+        time.sleep(latency)
+        with lock:
+            if live_on(stream_id):
+                return
+            for b in broadcasts.values():
+                if b["contentDetails"].get("boundStreamId") == stream_id and b["status"]["lifeCycleStatus"] == "ready" \
+                        and b["contentDetails"].get("enableAutoStart") == "true":
+                    b["status"]["lifeCycleStatus"] = "live"
+                    b["live_at"] = time.monotonic()
+                    return
+
+    class ApiHandler(http.server.BaseHTTPRequestHandler):
+        def reply(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def refuse(self, reason):
+            self.reply(403, {"error": {"code": 403, "message": reason, "errors": [{"reason": reason}]}})
+
+        def do_GET(self):
+            time.sleep(latency)
+            url = urllib.parse.urlparse(self.path)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            with lock:
+                if url.path.endswith("/liveStreams"):
+                    items = streams
+                elif "id" in query:
+                    items = [broadcasts[i] for i in query["id"].split(",") if i in broadcasts]
+                else:
+                    items = [b for b in broadcasts.values() if b["status"]["lifeCycleStatus"] in ("ready", "live")]
+                start = int(query.get("pageToken", 0))
+                end = start + int(query.get("maxResults", 5))
+                page = {"items": items[start:end]}
+                if end < len(items):
+                    page["nextPageToken"] = str(end)
+                page["etag"] = str(hash(json.dumps(page, sort_keys=True)))
+                if self.headers.get("If-None-Match") == page["etag"]:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.reply(200, page)
+
+        def do_POST(self):
+            time.sleep(latency)
+            url = urllib.parse.urlparse(self.path)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            with lock:
+                if url.path.endswith("/liveBroadcasts"):
+                    broadcast = json.loads(body)
+                    broadcast["id"] = f"broadcast-{next(ids)}"
+                    broadcast["status"]["lifeCycleStatus"] = "created"
+                    broadcasts[broadcast["id"]] = broadcast
+                    return self.reply(200, broadcast)
+                broadcast = broadcasts.get(query.get("id"))
+                if not broadcast:
+                    return self.reply(404, {"error": {"code": 404, "message": "liveBroadcastNotFound"}})
+                status = broadcast["status"]
+                if url.path.endswith("/bind"):
+                    broadcast["contentDetails"]["boundStreamId"] = query.get("streamId")
+                    if query.get("streamId") and status["lifeCycleStatus"] == "created":
+                        status["lifeCycleStatus"] = "ready"
+                        threading.Thread(target=auto_start, args=(query["streamId"],), daemon=True).start()
+                    return self.reply(200, broadcast)
+                stream_id = broadcast["contentDetails"].get("boundStreamId")
+                target = query.get("broadcastStatus")
+                if target == "live":
+                    if status["lifeCycleStatus"] != "ready" or live_on(stream_id):
+                        return self.refuse("invalidTransition")
+                    status["lifeCycleStatus"] = "live"
+                    broadcast["live_at"] = time.monotonic()
+                elif target == "complete":
+                    if status["lifeCycleStatus"] != "live":
+                        return self.refuse("invalidTransition")
+                    status["lifeCycleStatus"] = "complete"
+                    broadcast["completed_at"] = time.monotonic()
+                    threading.Thread(target=auto_start, args=(stream_id,), daemon=True).start()
+                self.reply(200, broadcast)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), ApiHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, broadcasts
+
+async def run_rollover_test(count, interval, latency, port):
+    """Rolls a test ingest over count times against a local stand-in for the YouTube API.
+
+    Compares the gap between broadcasts with the previous sequential teardown and setup, which
+    also stopped and restarted ffmpeg at every rollover (not included in its timings here).
+    """
+    server, broadcasts = serve_fake_youtube_api(port, "test-key", latency, other_streams=120)
+    youtube = build_youtube(api_url=f"http://127.0.0.1:{port}", developerKey="test")
+    for attempt in ("cold", "cached"):
+        start = time.monotonic()
+        stream_id = find_stream_id_by_key(youtube, "test-key")
+        print(f"Stream lookup among 121 streams, {attempt}: {time.monotonic() - start:.2f}s")
+    tz = pytz.timezone(TIMEZONE)
+
+    def gaps(start):
+        ordered = sorted(broadcasts.values(), key=lambda b: int(b["id"].split("-")[1]))[start:]
+        return [new["live_at"] - old["completed_at"] for old, new in zip(ordered, ordered[1:])]
+
+    print(f"Sequential rollovers, {latency * 1000:.0f}ms API latency:")
+    previous = prepare_next_broadcast(youtube, stream_id, datetime.datetime.now(tz), datetime.datetime.now(tz))
+    go_live(youtube, previous)
+    for _ in range(count):
+        start = time.monotonic()
+        stop_broadcast_by_id(youtube, previous)
+        unbind_stream_from_broadcast(youtube, previous)
+        previous = start_new_broadcast(youtube, datetime.datetime.now(tz))
+        bind_stream_to_broadcast(youtube, stream_id, previous)
+        go_live(youtube, previous)
+        print(f"  rolled over in {time.monotonic() - start:.2f}s")
+    sequential = gaps(0)
+    stop_broadcast_by_id(youtube, previous)
+
+    print(f"Prepared rollovers every {interval}s with a running ingest:")
+    first = len(broadcasts)
+    active = prepare_next_broadcast(youtube, stream_id, datetime.datetime.now(tz), datetime.datetime.now(tz))
+    go_live(youtube, active)
+    stats = StreamStats()
+    command = ["ffmpeg", "-v", "error", "-re", "-f", "lavfi", "-i", "testsrc2=size=320x180:rate=25",
+               "-c:v", "libx264", "-preset", "ultrafast", "-f", "flv", "-y", os.devnull]
+    ingest = asyncio.create_task(FfmpegSupervisor(command, stats).run_until())
+    await run_rollovers(youtube, stream_id, active, stats,
+                        lambda after=None: (after or datetime.datetime.now(tz)) + datetime.timedelta(seconds=interval),
+                        interval / 2, count)
+    ingest.cancel()
+    await asyncio.gather(ingest, return_exceptions=True)
+    server.shutdown()
+
+    prepared = gaps(first)
+    print(f"Sequential gap: {sum(sequential) / len(sequential):.2f}s average, {max(sequential):.2f}s worst")
+    print(f"Prepared gap:   {sum(prepared) / len(prepared):.2f}s average, {max(prepared):.2f}s worst, "
+          f"{stats.restarts} ingest restarts")
+    print(format_quota(quota.report()))
+
+async def main():
     print("Starting Dunedin-Live YouTube Daemon...")
+    stats = StreamStats()
+    stats_logger = asyncio.create_task(log_stats(stats)) if STATS_INTERVAL else None
+    stats_server = await serve_stats(stats, STATS_HOST, STATS_PORT) if STATS_PORT else None
 
+    # API calls block while they retry, so they run in threads to keep the stats live
     print("Authenticating to the Youtube API")
-    youtube = get_authenticated_service()
+    youtube = await asyncio.to_thread(get_authenticated_service)
 
-    while True:
-        print(f"\n--- Starting New Stream Cycle ---")
+    print("Finding stream ID by stream key...")
+    stream_id = await asyncio.to_thread(find_stream_id_by_key, youtube, STREAM_KEY)
 
-        print("Finding stream ID by stream key...")
-        stream_id = find_stream_id_by_key(youtube, STREAM_KEY)
+    print("Checking for active broadcasts...")
+    current_broadcast_id = await asyncio.to_thread(find_broadcast_id_by_stream_id, youtube, stream_id)
+    next_rollover = get_next_rollover_time(TIMEZONE)
 
-        print("Checking for active broadcasts...")
-        current_broadcast_id = find_broadcast_id_by_stream_id(youtube, stream_id)
-        next_rollover = get_next_rollover_time(TIMEZONE)
+    active_broadcast = None
 
-        active_broadcast = None
+    if current_broadcast_id:
+        broadcast_status = await asyncio.to_thread(is_broadcast_streaming, youtube, current_broadcast_id)
+        if broadcast_status in ["live", "ready"]:
+            print(f"Found existing broadcast ({current_broadcast_id}) in '{broadcast_status}' state.")
+            print("Skipping teardown. Resuming ffmpeg into the existing stream...")
+            active_broadcast = current_broadcast_id
+        else:
+            print(f"Existing broadcast ({current_broadcast_id}) is in '{broadcast_status}' state. Tearing it down...")
+            try:
+                await asyncio.to_thread(stop_broadcast_by_id, youtube, current_broadcast_id)
+                await asyncio.to_thread(unbind_stream_from_broadcast, youtube, current_broadcast_id)
+            except Exception as e:
+                print(f"Warning: Failed to cleanly tear down old broadcast: {e}")
 
-        if current_broadcast_id:
-            broadcast_status = is_broadcast_streaming(youtube, current_broadcast_id)
-            if broadcast_status in ["live", "ready"]:
-                print(f"Found existing broadcast ({current_broadcast_id}) in '{broadcast_status}' state.")
-                print("Skipping teardown. Resuming ffmpeg into the existing stream...")
-                active_broadcast = current_broadcast_id
-            else:
-                print(f"Existing broadcast ({current_broadcast_id}) is in '{broadcast_status}' state. Tearing it down...")
-                try:
-                    stop_broadcast_by_id(youtube, current_broadcast_id)
-                    unbind_stream_from_broadcast(youtube, current_broadcast_id)
-                except Exception as e:
-                    print(f"Warning: Failed to cleanly tear down old broadcast: {e}")
+    if not active_broadcast:
+        print("Creating new broadcast...")
+        active_broadcast = await asyncio.to_thread(start_new_broadcast, youtube, next_rollover)
+        print(f"Broadcast started with ID: {active_broadcast}")
 
-        if not active_broadcast:
-            print("Creating new broadcast...")
-            active_broadcast = start_new_broadcast(youtube, next_rollover)
-            print(f"Broadcast started with ID: {active_broadcast}")
+        print("Binding stream ID to broadcast ID...")
+        await asyncio.to_thread(bind_stream_to_broadcast, youtube, stream_id, active_broadcast)
 
-            print("Binding stream ID to broadcast ID...")
-            bind_stream_to_broadcast(youtube, stream_id, active_broadcast)
+    # The ingest runs straight through rollovers; only the broadcast it feeds is swapped
+    ingest = asyncio.create_task(run_ffmpeg(CAMERA_RTSP_URL, STREAM_KEY, stats))
+    try:
+        await run_rollovers(youtube, stream_id, active_broadcast, stats,
+                            lambda after=None: get_next_rollover_time(TIMEZONE, after),
+                            ROLLOVER_PREPARE_AHEAD)
+    finally:
+        ingest.cancel()
+        await asyncio.gather(ingest, return_exceptions=True)
+        if stats_logger:
+            stats_logger.cancel()
+            await asyncio.gather(stats_logger, return_exceptions=True)
+        if stats_server:
+            stats_server.close()
+            await stats_server.wait_closed()
 
-        print(f"Daemon will run ffmpeg until exact rollover at: {next_rollover.strftime('%Y-%m-%d %H:%M:%S %Z')}")
-        run_ffmpeg_until(CAMERA_RTSP_URL, STREAM_KEY, next_rollover, TIMEZONE)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dunedin-Live YouTube daemon")
+    parser.add_argument("--stall-test", action="store_true",
+                        help="measure stall recovery against a local source that hangs, then exit")
+    parser.add_argument("--duration", type=int, default=60, help="stall test duration (seconds)")
+    parser.add_argument("--stall-after", type=int, default=10, help="seconds before the test source hangs")
+    parser.add_argument("--port", type=int, default=18090, help="port for the test source or API")
+    parser.add_argument("--rollover-test", action="store_true",
+                        help="measure the gap between broadcasts at rollover against a local stand-in API, then exit")
+    parser.add_argument("--rollovers", type=int, default=3, help="rollovers to run in the rollover test")
+    parser.add_argument("--interval", type=int, default=10, help="seconds between rollovers in the rollover test")
+    parser.add_argument("--latency", type=float, default=0.3, help="API latency in the rollover test (seconds)")
+    args = parser.parse_args()
 
-        # This code only executes once the exact rollover time hits
-        print("\n*** Scheduled rollover time reached! ***")
-        print("Tearing down the broadcast to prepare for the next cycle...")
-        try:
-            stop_broadcast_by_id(youtube, active_broadcast)
-            unbind_stream_from_broadcast(youtube, active_broadcast)
-        except Exception as e:
-            print(f"Warning: Failed to cleanly tear down broadcast during rollover: {e}")
+    if args.stall_test:
+        asyncio.run(run_stall_test(args.duration, args.stall_after, args.port))
+        raise SystemExit(0)
+    if args.rollover_test:
+        asyncio.run(run_rollover_test(args.rollovers, args.interval, args.latency, args.port))
+        raise SystemExit(0)
 
-if __name__ == "__main__":
-    main()
+    asyncio.run(main())